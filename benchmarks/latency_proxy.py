@@ -0,0 +1,50 @@
+"""
+TCP proxy that adds latency, to benchmark against a remote-like database
+
+Every chunk of data is held back for the given delay in both directions, so
+each round trip to Postgres costs about twice the delay, as it would over a
+network.
+
+Run it with:
+    python -m benchmarks.latency_proxy [listen port] [target host:port] [delay seconds]
+and point DATABASE_URI at the listen port.
+"""
+import sys
+import asyncio
+
+
+async def pipe(reader, writer, delay: float):
+    """ Copies reader to writer, delaying every chunk """
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            await asyncio.sleep(delay)
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def main():
+    """ Accepts connections and forwards them to the target """
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5433
+    host, target_port = (sys.argv[2] if len(sys.argv) > 2 else "localhost:5432").split(":")
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0.002
+
+    async def forward(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection(host, int(target_port))
+        await asyncio.gather(
+            pipe(client_reader, server_writer, delay), pipe(server_reader, client_writer, delay)
+        )
+
+    server = await asyncio.start_server(forward, "localhost", port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
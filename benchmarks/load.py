@@ -0,0 +1,117 @@
+"""
+Load benchmark of a running Customer Service
+
+Opens concurrency keep-alive connections to the service and, on each of
+them, reads a customer, searches by postal code and lists a page of 100
+customers in a loop for the given number of seconds, then reports the
+throughput and latency percentiles.
+
+Start the service under the worker class to measure, e.g.:
+    GUNICORN_WORKER_CLASS=gthread gunicorn --config=gunicorn.conf.py "service:create_app()"
+and run:
+    python -m benchmarks.load [url] [concurrency] [seconds]
+
+It seeds 1000 customers first when the service holds fewer than that.
+"""
+import sys
+import json
+import time
+import random
+import threading
+import http.client
+from urllib.parse import urlsplit
+
+SEED_CUSTOMERS = 1000
+
+
+class Client():
+    """ One keep-alive connection to the service """
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+
+    def request(self, method: str, path: str, body=None) -> tuple:
+        """ Returns the status and body of a request """
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        self.conn.request(method, path, body=body and json.dumps(body), headers=headers)
+        response = self.conn.getresponse()
+        return response.status, response.read()
+
+
+def seed(url: str) -> list:
+    """ Returns the ids and postal codes of the customers, creating them if needed """
+    client = Client(url)
+    _, body = client.request("GET", f"/customers?limit={SEED_CUSTOMERS}")
+    customers = json.loads(body)
+    if len(customers) < SEED_CUSTOMERS:
+        batch = [
+            {
+                "name": f"load{number}", "first_name": "Load", "last_name": f"Test{number}",
+                "email": f"load{number}@example.com", "phone_number": "555-0100",
+                "account_status": "active",
+                "addresses": [{
+                    "customer_id": None, "name": "home", "street": f"{number} Main St", "city": "Springfield",
+                    "state": "IL", "postalcode": f"{62700 + number % 50}",
+                }],
+            }
+            for number in range(SEED_CUSTOMERS - len(customers))
+        ]
+        status, body = client.request("POST", "/customers:batch", batch)
+        assert status == 201, body
+        customers += json.loads(body)
+    return [
+        (customer["id"], customer["addresses"][0]["postalcode"] if customer["addresses"] else "62700")
+        for customer in customers
+    ]
+
+
+def worker(url: str, customers: list, deadline: float, latencies: list, errors: list):
+    """ Sends the request mix until the deadline """
+    client = Client(url)
+    while time.perf_counter() < deadline:
+        customer_id, postalcode = random.choice(customers)
+        for path in (
+            f"/customers/{customer_id}",
+            f"/customers?postalcode={postalcode}",
+            "/customers?limit=100",
+        ):
+            start = time.perf_counter()
+            try:
+                status, _ = client.request("GET", path)
+            except (OSError, http.client.HTTPException):
+                client = Client(url)
+                status = None
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+
+
+def main():
+    """ Runs the benchmark and prints the results """
+    url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8080"
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+    customers = seed(url)
+    latencies, errors = [], []
+    deadline = time.perf_counter() + seconds
+    threads = [
+        threading.Thread(target=worker, args=(url, customers, deadline, latencies, errors))
+        for _ in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+
+    print(f"{len(latencies)} requests from {concurrency} connections in {seconds:.0f}s")
+    print(f"throughput: {len(latencies) / seconds:8.1f} req/s   errors: {len(errors)}")
+    print(f"latency ms: p50 {percentile(0.50):.1f}   p95 {percentile(0.95):.1f}   p99 {percentile(0.99):.1f}")
+
+
+if __name__ == "__main__":
+    main()
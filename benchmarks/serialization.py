@@ -0,0 +1,89 @@
+"""
+Benchmark of serializing a page of Customers for GET /customers
+
+Compares the CPU time per row of the old read path, which loaded ORM
+objects, serialized them, marshalled the result through flask-restx and
+encoded it with json, with the column tuple path the list endpoints use now.
+
+Run it with:
+    python -m benchmarks.serialization [customers] [repeat]
+
+It uses a throwaway SQLite file unless DATABASE_URI is set. Only point
+DATABASE_URI at a scratch database: the benchmark seeds it with Customers
+and removes them again afterwards.
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+
+os.environ.setdefault("DATABASE_URI", f"sqlite:///{tempfile.gettempdir()}/customer-benchmark.sqlite3")
+
+# pylint: disable=wrong-import-position
+import orjson
+from flask_restx import marshal
+from service import app
+from service.models import Customer, Address, db, init_db
+from service.routes import customer_model
+from tests.factories import CustomerFactory, AddressFactory
+
+
+def seed(count: int) -> list:
+    """ Creates count Customers with two Addresses each """
+    customers = []
+    for _ in range(count):
+        customer = CustomerFactory()
+        customer.addresses = [AddressFactory(), AddressFactory()]
+        customers.append(customer)
+    Customer.bulk_create(customers)
+    return [customer.id for customer in customers]
+
+
+def orm_path(limit: int) -> bytes:
+    """ The old read path: ORM objects, serialize(), marshal() and json """
+    customers, _ = Customer.paginate(Customer.embed(Customer.query), limit)
+    results = [customer.serialize() for customer in customers]
+    return json.dumps(marshal(results, customer_model)).encode("utf-8")
+
+
+def column_path(limit: int) -> bytes:
+    """ The current read path: column tuples, serialize_rows() and orjson """
+    rows, _ = Customer.paginate(Customer.columns(Customer.query), limit)
+    return orjson.dumps(Customer.serialize_rows(rows))
+
+
+def measure(path, limit: int, repeat: int) -> float:
+    """ Returns the best CPU time per row in microseconds """
+    best = None
+    for _ in range(repeat):
+        db.session.expire_all()
+        start = time.process_time()
+        path(limit)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / limit * 1e6
+
+
+def main(count: int = 1000, repeat: int = 10):
+    """ Seeds the database, runs both paths and prints the results """
+    with app.app_context():
+        init_db(app)
+        ids = seed(count)
+        try:
+            assert json.loads(orm_path(count)) == json.loads(column_path(count))
+            before = measure(orm_path, count, repeat)
+            after = measure(column_path, count, repeat)
+        finally:
+            db.session.rollback()
+            Address.query.filter(Address.customer_id.in_(ids)).delete(synchronize_session=False)
+            Customer.query.filter(Customer.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+    print(f"{count} customers with 2 addresses each, best of {repeat} runs")
+    print(f"ORM objects + marshal + json: {before:8.1f} us/row")
+    print(f"column tuples + orjson:       {after:8.1f} us/row")
+    print(f"speedup:                      {before / after:8.1f}x")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
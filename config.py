@@ -18,7 +18,86 @@ if 'VCAP_SERVICES' in os.environ:
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-SQLALCHEMY_POOL_SIZE = 2
+
+# Connection pool of each worker process, see service/pool.py
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "2")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "3")),
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "yes", "1"),
+}
+
+# Apply the pending migrations in create_app(), or leave them to "flask db upgrade"
+DB_UPGRADE_ON_START = os.getenv("DB_UPGRADE_ON_START", "true").lower() in ("true", "yes", "1")
+# Open the connections of the pool in the background as soon as the app is created
+DB_POOL_WARM_UP = os.getenv("DB_POOL_WARM_UP", "true").lower() in ("true", "yes", "1")
+
+# Read replicas for GET requests, comma separated URIs, none by default
+DATABASE_REPLICA_URIS = [uri.strip() for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri.strip()]
+# Seconds between health checks of the replicas, and the lag at which one is skipped
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+
+# More databases to shard the Customers over by id, comma separated URIs after
+# DATABASE_URI, which is shard 0; none by default
+DATABASE_SHARD_URIS = [uri.strip() for uri in os.getenv("DATABASE_SHARD_URIS", "").split(",") if uri.strip()]
+
+# Keyset pagination for the list endpoints
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Allow DELETE /customers without any filter to wipe every Customer, never set it in production
+ALLOW_DELETE_ALL = os.getenv("ALLOW_DELETE_ALL", "false").lower() in ("true", "yes", "1")
+
+# Largest number of Customers, and of bytes, accepted by one POST /customers:batch
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_BYTES", str(10 * 1024 * 1024)))
+
+# Rows fetched per round trip from the server-side cursor of an export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+
+# Customers loaded per transaction by flask customers import
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "5000"))
+
+# Seconds between reads of the outbox by a change stream, and of silence before a keep-alive
+CHANGE_POLL_INTERVAL = float(os.getenv("CHANGE_POLL_INTERVAL", "1"))
+CHANGE_HEARTBEAT = float(os.getenv("CHANGE_HEARTBEAT", "15"))
+# Seconds a change stream stays open, 0 to close it once it sent what changed, which
+# gunicorn.conf.py enforces for sync workers since an open stream holds the whole worker
+CHANGE_STREAM_TIMEOUT = float(os.getenv("CHANGE_STREAM_TIMEOUT", "25"))
+# Seconds a missing outbox id is waited for before it is taken to be a rollback
+OUTBOX_GAP_TIMEOUT = float(os.getenv("OUTBOX_GAP_TIMEOUT", "10"))
+# Days of changes kept by flask db prune-outbox
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+
+# Read-through cache of serialized Customers and Addresses (memory, disk or none),
+# gunicorn.conf.py defaults it to disk when there is more than one worker
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_DIR = os.getenv("CACHE_DIR", "/tmp")
+# Share one query between identical reads that are in flight at the same time in a worker
+COALESCE_READS = os.getenv("COALESCE_READS", "true").lower() in ("true", "yes", "1")
+
+# Compress responses of at least COMPRESS_MIN_SIZE bytes, level 1 (fast) to 9 (small)
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "5"))
+STATIC_COMPRESS_LEVEL = int(os.getenv("STATIC_COMPRESS_LEVEL", "9"))
+
+# Retries of transient database errors, never running past RETRY_DEADLINE seconds into a request
+RETRY_COUNT = int(os.getenv("RETRY_COUNT", "3"))
+RETRY_DELAY = float(os.getenv("RETRY_DELAY", "0.1"))
+RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", "2"))
+RETRY_DEADLINE = float(os.getenv("RETRY_DEADLINE", "5"))
+
+# Fail fast for BREAKER_RESET seconds after BREAKER_FAILURES failed database calls in a row,
+# each counted once however often it was retried
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))
+
+# Log a warning for requests that run more SQL statements than this
+QUERY_COUNT_WARNING = int(os.getenv("QUERY_COUNT_WARNING", "20"))
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
@@ -31,24 +31,13 @@ from compare import expect
 def step_impl(context):
     """ Delete all Customers and load new ones """
     headers = {'Content-Type': 'application/json'}
-    # list all of the customers and delete them one by one
-    # context.resp = requests.get(context.base_url + '/customers', headers=headers)
-    # expect(context.resp.status_code).to_equal(200)
-    # for customer in context.resp.json():
-    #     context.resp = requests.delete(context.base_url + '/customers/' + str(customer["id"]), headers=headers)
-    #     expect(context.resp.status_code).to_equal(204)
+    # delete all of the customers, and their addresses with them, in one request
+    context.resp = requests.delete(context.base_url + '/customers', headers=headers)
+    expect(context.resp.status_code).to_equal(204)
 
-    context.resp = requests.get(context.base_url + '/customers', headers=headers)
-    expect(context.resp.status_code).to_equal(200)
-    for customer in context.resp.json():
-        context.resp = requests.get(context.base_url + '/customers/' + str(customer["id"]) + '/addresses', headers=headers)
-        for address in context.resp.json():
-            context.resp = requests.delete(context.base_url + '/customers/' + str(customer["id"]) + '/addresses/' + str(address["id"]))
-        context.resp = requests.delete(context.base_url + '/customers/' + str(customer["id"]), headers=headers)
-        expect(context.resp.status_code).to_equal(204)
-    
-    # load the database with new customers
-    create_url = context.base_url + '/customers'
+    # load the database with new customers in one batch
+    create_url = context.base_url + '/customers:batch'
+    batch = []
     for row in context.table:
         data = {
             "name": row['name'],
@@ -59,6 +48,7 @@ def step_impl(context):
             "account_status": row['account_status'],
             "addresses": row['addresses']
         }
-        payload = json.dumps(data)
-        context.resp = requests.post(create_url, data=payload, headers=headers)
-        expect(context.resp.status_code).to_equal(201)
\ No newline at end of file
+        batch.append(data)
+    payload = json.dumps(batch)
+    context.resp = requests.post(create_url, data=payload, headers=headers)
+    expect(context.resp.status_code).to_equal(201)
\ No newline at end of file
@@ -0,0 +1,173 @@
+"""
+Gunicorn configuration for the Customer Service
+
+Read by gunicorn from the current directory when it starts. Everything can
+be tuned from the environment:
+
+GUNICORN_WORKER_CLASS - sync (the default), gthread or gevent; sync workers
+    close a change stream as soon as it has sent what changed
+GUNICORN_WORKERS / WEB_CONCURRENCY - number of worker processes; with more
+    than one the cache defaults to the disk backend they all share
+GUNICORN_THREADS - threads per gthread worker
+GUNICORN_WORKER_CONNECTIONS - concurrent requests per gevent worker
+GUNICORN_WORKER_MEMORY - memory budget of one worker, in MB
+GUNICORN_TIMEOUT - seconds before a silent worker is restarted
+GUNICORN_PRELOAD - create the app once in the master before forking the workers
+
+The number of workers defaults to 2 * CPUs + 1, capped so that they all
+fit in the memory limit of the container. Both limits are read from the
+cgroup, or MEMORY_LIMIT on Cloud Foundry, so the same configuration suits a
+laptop and a 512M instance. See benchmarks/load.py for how the worker
+classes compare on this service.
+
+Point gunicorn at service:create_app(). With GUNICORN_PRELOAD the master
+applies the migrations and loads the static files once, and every worker
+fills its own connection pool after the fork.
+"""
+import os
+import re
+import sys
+import shutil
+import multiprocessing
+
+# every worker writes its Prometheus samples here so /metrics can merge them
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/customer-service-metrics")
+
+# imported up front, child_exit runs in a signal handler where a first import can re-enter
+from prometheus_client import multiprocess  # pylint: disable=wrong-import-position
+
+UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30}
+
+
+def read_file(path: str) -> str:
+    """ Returns the stripped content of a file, or None if it cannot be read """
+    try:
+        with open(path, encoding="ascii") as file:
+            return file.read().strip()
+    except (OSError, ValueError):
+        return None
+
+
+def cpu_limit() -> int:
+    """ Returns the number of CPUs this container may use """
+    quota = read_file("/sys/fs/cgroup/cpu.max")  # cgroup v2: "<quota> <period>"
+    if quota and not quota.startswith("max"):
+        quota, period = quota.split()
+    else:  # cgroup v1
+        quota = read_file("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        period = read_file("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+    if quota and period and int(quota) > 0:
+        return max(1, min(cpus, int(quota) // int(period)))
+    return cpus
+
+
+def memory_limit() -> int:
+    """ Returns the memory limit of this container in bytes, or None when there is none """
+    match = re.fullmatch(r"(\d+)([kmg]?)b?", os.getenv("MEMORY_LIMIT", "").lower())
+    if match:  # set by Cloud Foundry, e.g. 512M
+        return int(match.group(1)) * UNITS[match.group(2)]
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        limit = read_file(path)
+        # cgroup v1 reports a huge number instead of "max" when there is no limit
+        if limit and limit.isdigit() and int(limit) < 1 << 60:
+            return int(limit)
+    return None
+
+
+def worker_count(cpus: int, memory: int) -> int:
+    """ Returns 2 * CPUs + 1 workers, or as many as fit in memory """
+    workers = 2 * cpus + 1
+    if memory:
+        worker_memory = int(os.getenv("GUNICORN_WORKER_MEMORY", "128")) << 20
+        workers = min(workers, memory // worker_memory)
+    return max(1, workers)
+
+
+######################################################################
+#  S E R V E R   S E T T I N G S
+######################################################################
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+workers = int(
+    os.getenv("GUNICORN_WORKERS") or os.getenv("WEB_CONCURRENCY") or worker_count(cpu_limit(), memory_limit())
+)
+threads = int(os.getenv("GUNICORN_THREADS", "4")) if worker_class == "gthread" else 1
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = timeout
+# the Cloud Foundry router keeps connections open, so keep them alive a bit longer than 1s
+keepalive = 5
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() in ("true", "yes", "1")
+# heartbeat files on tmpfs so a slow disk cannot get workers killed
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# every thread or greenlet may hold a connection, so size the pool of each worker to match
+if worker_class == "gthread":
+    os.environ.setdefault("DB_POOL_SIZE", str(threads))
+elif worker_class == "gevent":
+    os.environ.setdefault("DB_POOL_SIZE", str(min(worker_connections, 10)))
+
+# a change stream would hold a sync worker, and the whole API with it when there is only one,
+# so there it sends what has changed and closes at once, and EventSource polls by reconnecting
+if worker_class == "sync":
+    os.environ["CHANGE_STREAM_TIMEOUT"] = "0"
+
+# an entry cached in the memory of one worker outlives a change made through another, so
+# several workers share the disk cache unless CACHE_BACKEND says otherwise
+if workers > 1:
+    os.environ.setdefault("CACHE_BACKEND", "disk")
+
+# connections the master opened would be dropped by every worker, so they warm up their own
+if preload_app:
+    os.environ["DB_POOL_WARM_UP"] = "false"
+
+
+######################################################################
+#  S E R V E R   H O O K S
+######################################################################
+def on_starting(server):
+    """ Clears the metrics left over from a previous run """
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    server.log.info(
+        "Starting %s %s worker(s) with %s thread(s) each",
+        server.cfg.workers, server.cfg.worker_class_str, server.cfg.threads,
+    )
+
+
+def post_fork(server, worker):
+    """ Makes the new worker safe to use the database """
+    if server.cfg.worker_class_str == "gevent":
+        # let psycopg2 yield to other greenlets while it waits for Postgres
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    service = sys.modules.get("service")
+    if service is not None:
+        # the app was preloaded: forget the connections the master opened, to
+        # every shard and replica, without closing them, since the master still
+        # owns the sockets
+        from service.models import engines
+        with service.app.app_context():
+            for engine in engines():
+                engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    """ Fills the connection pools of a worker forked from a preloaded app """
+    if worker.cfg.preload_app:
+        from service import app
+        from service.models import engines
+        from service.pool import warm_up
+        with app.app_context():
+            for engine in engines():
+                warm_up(engine)
+
+
+def child_exit(server, worker):
+    """ Stops reporting the live metrics of a worker that exited """
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,12 +1,15 @@
 """
 Package: service
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+This module creates the Flask app and registers the routes, which is all that
+importing it does. create_app() sets up the logging, the SQL database and the
+static files, so run the service with:
+    gunicorn service:create_app()
 """
-import os
 import sys
+import time
 import logging
+import threading
 from flask import Flask
 
 # Create Flask application
@@ -14,31 +17,70 @@ app = Flask(__name__)
 app.config.from_object("config")
 
 # Import the routes After the Flask app is created
-from service import routes, models, error_handlers
-
-# Set up logging for production
-if __name__ != "__main__":
-    gunicorn_logger = logging.getLogger("gunicorn.error")
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
-    app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
-    app.logger.info("Logging handler established")
-
-app.logger.info(70 * "*")
-app.logger.info("  M Y   S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
-
-try:
-    models.init_db(app)  # make our sqlalchemy tables
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
-
-app.logger.info("Service initialized!")
+from service import routes, models, error_handlers, commands, metrics, compression, pool
+
+# create_app() runs once, even when the first requests race for it
+_create_lock = threading.Lock()
+# set by create_app() once it is done, so no request sees the service half initialized
+_ready = False
+
+
+def initialized() -> bool:
+    """ Returns True once create_app() has initialized the service """
+    return _ready
+
+
+def create_app() -> Flask:
+    """
+    Initializes the service and returns its Flask app
+
+    Only the first call does the work, later ones return the same app, so a
+    gunicorn master with preload_app can create it once before forking. The
+    engine connects when the migrations are applied (DB_UPGRADE_ON_START) and
+    the connection pool is filled on a background thread (DB_POOL_WARM_UP).
+    """
+    global _ready
+    with _create_lock:
+        if _ready:
+            return app
+        start = time.perf_counter()
+        # Set up logging for production
+        if __name__ != "__main__":
+            gunicorn_logger = logging.getLogger("gunicorn.error")
+            app.logger.handlers = gunicorn_logger.handlers
+            app.logger.setLevel(gunicorn_logger.level)
+            app.logger.propagate = False
+            # Make all log formats consistent
+            formatter = logging.Formatter(
+                "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
+            )
+            for handler in app.logger.handlers:
+                handler.setFormatter(formatter)
+            app.logger.info("Logging handler established")
+
+        app.logger.info(70 * "*")
+        app.logger.info("  M Y   S E R V I C E   R U N N I N G  ".center(70, "*"))
+        app.logger.info(70 * "*")
+
+        try:
+            models.init_db(app, app.config["DB_UPGRADE_ON_START"])  # make our sqlalchemy tables
+        except Exception as error:
+            app.logger.critical("%s: Cannot continue", error)
+            # gunicorn requires exit code 4 to stop spawning workers when they die
+            sys.exit(4)
+        compression.assets.load()
+        if app.config["DB_POOL_WARM_UP"]:
+            for engine in models.engines():
+                pool.warm_up(engine)
+
+        app.logger.info("Service initialized in %.3fs!", time.perf_counter() - start)
+        _ready = True
+    return app
+
+
+@app.before_request
+def initialize():
+    """ Initializes the service on the first request when it was served as service:app """
+    # the tests and the flask commands set up the database with models.init_db() themselves
+    if not initialized() and not models.initialized(app):
+        create_app()
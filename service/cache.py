@@ -0,0 +1,237 @@
+"""
+Module: cache
+Read-through cache for serialized Customers and Addresses
+
+The cache holds the dictionaries returned by serialize() so that repeated
+reads of the same hot records skip the database entirely. Entries expire
+after CACHE_TTL seconds and the least recently used ones are evicted once
+there are more than CACHE_MAX_ENTRIES of them.
+
+Backends (CACHE_BACKEND):
+------------------------
+memory - a dictionary private to each worker process (the default)
+disk - a SQLite file under CACHE_DIR shared by every worker on the host, the
+       default under gunicorn.conf.py with more than one worker
+none - no caching at all
+
+The models invalidate the entries of a record whenever it is created,
+updated or deleted through PersistentBase. With the memory backend the other
+workers would only see that change once their own entry expires, serving a
+stale or deleted record until then, which is why several workers default to
+the disk backend.
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+
+######################################################################
+#  B A C K E N D S
+######################################################################
+class NullBackend():
+    """ Backend that never holds anything """
+
+    def __init__(self):
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns the value stored under key, or None """
+        return None
+
+    def set(self, key, value):
+        """ Stores value under key """
+
+    def delete(self, key):
+        """ Removes the value stored under key """
+
+    def clear(self):
+        """ Removes every value """
+
+    def __len__(self):
+        return 0
+
+
+class MemoryBackend(NullBackend):
+    """ LRU dictionary private to the process """
+
+    def __init__(self, max_entries: int, ttl: float):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskBackend(NullBackend):
+    """ LRU table in a SQLite file that every worker on the host shares """
+
+    def __init__(self, path: str, max_entries: int, ttl: float):
+        super().__init__()
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        """ Returns the connection of this thread, opening a new one after a fork """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + self.ttl, now),
+        )
+        evicted = conn.execute(
+            "DELETE FROM cache WHERE key IN "
+            "(SELECT key FROM cache ORDER BY accessed LIMIT max(0, (SELECT count(*) FROM cache) - ?))",
+            (self.max_entries,),
+        ).rowcount
+        self.evictions += max(evicted, 0)
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        self._connect().execute("DELETE FROM cache")
+
+    def __len__(self):
+        return self._connect().execute("SELECT count(*) FROM cache").fetchone()[0]
+
+
+######################################################################
+#  R E A D - T H R O U G H   C A C H E
+######################################################################
+class Cache():
+    """ Read-through cache in front of a pluggable backend """
+
+    def __init__(self):
+        self.backend = NullBackend()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        """ Selects the backend from the configuration of the Flask app """
+        name = app.config.get("CACHE_BACKEND", "memory")
+        max_entries = app.config.get("CACHE_MAX_ENTRIES", 10000)
+        ttl = app.config.get("CACHE_TTL", 30)
+        if name == "memory":
+            self.backend = MemoryBackend(max_entries, ttl)
+        elif name == "disk":
+            directory = app.config.get("CACHE_DIR", "/tmp")
+            os.makedirs(directory, exist_ok=True)
+            self.backend = DiskBackend(os.path.join(directory, "customer-cache.sqlite3"), max_entries, ttl)
+        elif name == "none":
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f"Unknown CACHE_BACKEND '{name}'")
+        self.hits = 0
+        self.misses = 0
+        logger.info("Using the %s cache backend", name)
+
+    def get(self, key: str):
+        """ Returns the value stored under key, or None without loading it """
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def get_or_load(self, key: str, loader):
+        """ Returns the value stored under key, calling loader to fill it on a miss
+
+        Nothing is stored when loader returns None, so lookups of records
+        that do not exist always go to the database.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = loader()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+    def invalidate(self, *keys):
+        """ Removes the values stored under keys """
+        for key in keys:
+            self.backend.delete(key)
+
+    def clear(self):
+        """ Removes every value """
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        """ Returns the counters of this worker """
+        return {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions,
+            "entries": len(self.backend),
+        }
+
+
+# The cache used by the models, configured later in init_db()
+cache = Cache()
@@ -0,0 +1,62 @@
+"""
+Module: changes
+Server-Sent Events stream of the changes to Customers and Addresses
+
+The stream polls the outbox every poll_interval seconds and sends each change
+as an event whose id is the id of the change, so a browser that reconnects
+sends it back in Last-Event-ID and resumes where it left off. A comment line
+is sent after heartbeat seconds without any change, so proxies do not close
+an idle connection, and the stream ends after timeout seconds to give the
+worker back; EventSource reconnects on its own after RETRY milliseconds.
+With a timeout of 0, as with sync workers, the stream sends the changes there
+are and ends, and the reconnects of EventSource poll for more.
+"""
+import json
+import time
+
+MIMETYPE = "text/event-stream"
+
+# milliseconds a client waits before reconnecting once the stream ends
+RETRY = 1000
+
+
+def format_event(event: dict) -> str:
+    """ Returns one change as a Server-Sent Event """
+    return f"id: {event['id']}\nevent: {event['operation']}\ndata: {json.dumps(event)}\n\n"
+
+
+def generate_events(read, after: int, poll_interval: float, heartbeat: float, timeout: float,
+                    clock=time.monotonic, sleep=time.sleep):
+    """ Yields the changes after an event id as they are committed
+
+    :param read: returns the serialized changes after an event id
+    :type read: callable
+    :param after: the id of the last change the client has seen
+    :type after: int
+    :param poll_interval: the seconds to wait between reads that found nothing
+    :type poll_interval: float
+    :param heartbeat: the seconds of silence before a keep-alive comment
+    :type heartbeat: float
+    :param timeout: the seconds after which the stream ends
+    :type timeout: float
+    """
+    yield f"retry: {RETRY}\n\n"
+    deadline = clock() + timeout
+    last_sent = clock()
+    while True:
+        events = read(after)
+        for event in events:
+            yield format_event(event)
+            after = event["id"]
+        now = clock()
+        if events:
+            last_sent = now
+        if now >= deadline:
+            return
+        if events:
+            # read the rest of a backlog without waiting
+            continue
+        if now - last_sent >= heartbeat:
+            yield ": keep-alive\n\n"
+            last_sent = now
+        sleep(min(poll_interval, deadline - now))
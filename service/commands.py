@@ -0,0 +1,110 @@
+"""
+Module: commands
+Flask CLI commands for managing the Customer Service
+
+flask db upgrade [--to VERSION] - apply the pending schema migrations to every shard
+flask db current - show the schema version of every shard
+flask db prune-outbox [--days DAYS] - delete the changes older than OUTBOX_RETENTION_DAYS
+flask customers export [--format ndjson|csv] [--output FILE] - dump all Customers
+flask customers import FILE [--format ndjson|csv] [--rejects FILE] - load Customers in bulk
+"""
+import json
+from datetime import timedelta
+import click
+from flask.cli import AppGroup
+from service import migrations, export, importer
+from service.models import ChangeEvent, Customer, shards, utcnow
+from . import app
+
+db_cli = AppGroup("db", help="Manage the database schema")
+customers_cli = AppGroup("customers", help="Manage the Customers in bulk")
+
+
+@db_cli.command("upgrade")
+@click.option("--to", "target", type=int, default=None, help="Version to upgrade to")
+def upgrade(target):
+    """ Applies the pending schema migrations """
+    for shard, engine in shards.binds().items():
+        prefix = f"Shard {shard}: " if shards.enabled else ""
+        applied = migrations.upgrade(engine, target)
+        if not applied:
+            click.echo(f"{prefix}Database is up to date")
+        for version in applied:
+            click.echo(f"{prefix}Applied migration {version:04d}")
+
+
+@db_cli.command("current")
+def current():
+    """ Shows the schema version of the database """
+    for shard, engine in shards.binds().items():
+        prefix = f"Shard {shard}: " if shards.enabled else ""
+        click.echo(f"{prefix}{migrations.current_version(engine):04d} (head {migrations.head():04d})")
+
+
+@db_cli.command("prune-outbox")
+@click.option("--days", type=int, default=None, help="Days of changes to keep, OUTBOX_RETENTION_DAYS by default")
+def prune_outbox(days):
+    """ Deletes the changes older than the retention period from the outbox """
+    days = app.config["OUTBOX_RETENTION_DAYS"] if days is None else days
+    count = ChangeEvent.prune(utcnow() - timedelta(days=days))
+    click.echo(f"Pruned {count} changes older than {days} days")
+
+
+@customers_cli.command("export")
+@click.option("--format", "export_format", type=click.Choice(sorted(export.FORMATS)), default="ndjson")
+@click.option("--output", type=click.File("w"), default="-", help="File to write to, stdout by default")
+def export_customers(export_format, output):
+    """ Streams every Customer with its addresses as NDJSON or CSV """
+    generate = export.FORMATS[export_format][0]
+    for chunk in generate(Customer.stream(app.config["EXPORT_BATCH_SIZE"])):
+        output.write(chunk)
+
+
+@customers_cli.command("import")
+@click.argument("input_file", type=click.File("r"))
+@click.option("--format", "import_format", type=click.Choice(sorted(importer.READERS)), default=None,
+              help="Format of the file, taken from its extension by default")
+@click.option("--rejects", "rejects_path", type=click.Path(dir_okay=False, writable=True), default=None,
+              help="File to write the rejected Customers to as NDJSON, FILE.rejects by default")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=None,
+              help="Customers loaded per transaction, IMPORT_CHUNK_SIZE by default")
+def import_customers(input_file, import_format, rejects_path, chunk_size):
+    """ Loads the Customers of an NDJSON or CSV export, with new ids """
+    if import_format is None:
+        import_format = "csv" if input_file.name.lower().endswith(".csv") else "ndjson"
+    if rejects_path is None:
+        rejects_path = "rejects.ndjson" if input_file.name == "<stdin>" else input_file.name + ".rejects"
+    rejects = []
+
+    def reject(number, data, error):
+        if not rejects:
+            rejects.append(open(rejects_path, "w", encoding="utf-8"))
+        rejects[0].write(json.dumps({"line": number, "error": error, "record": data}) + "\n")
+
+    def progress(counts):
+        click.echo(
+            f"Loaded {counts['customers']} Customers "
+            f"({counts['customers'] / max(counts['seconds'], 1e-9):.0f}/s)", err=True
+        )
+
+    try:
+        counts = importer.import_customers(
+            importer.READERS[import_format](input_file),
+            reject,
+            chunk_size or app.config["IMPORT_CHUNK_SIZE"],
+            progress,
+        )
+    finally:
+        for rejects_file in rejects:
+            rejects_file.close()
+    rate = counts["customers"] / max(counts["seconds"], 1e-9)
+    click.echo(
+        f"Imported {counts['customers']} Customers with {counts['addresses']} addresses "
+        f"in {counts['seconds']:.2f}s ({rate:.0f} Customers/s)"
+    )
+    if counts["rejected"]:
+        click.echo(f"Rejected {counts['rejected']} Customers, see {rejects_path}")
+
+
+app.cli.add_command(db_cli)
+app.cli.add_command(customers_cli)
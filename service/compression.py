@@ -0,0 +1,199 @@
+"""
+Module: compression
+Compressed responses and fingerprinted static assets
+
+API responses of a compressible type that are at least COMPRESS_MIN_SIZE
+bytes long are compressed with Brotli or gzip, whichever the client prefers
+in Accept-Encoding (Brotli on a tie). Streamed responses such as the export
+are left alone. Strong ETags become weak ones, since the bytes on the wire
+now depend on the encoding.
+
+The files under service/static are read, hashed and compressed with both
+encodings once, when create_app() runs or on the first request for one of
+them. Every asset can be fetched under a
+fingerprinted name that has the first characters of its hash before the
+extension, e.g. static/js/rest_api.3f2a9c1d7e4b.js, and those are cached by
+browsers for a year. The HTML pages are rewritten to reference the
+fingerprinted names, so a new release is picked up as soon as the page is
+revalidated, which it always is (Cache-Control: no-cache).
+"""
+import os
+import re
+import gzip
+import hashlib
+import logging
+import threading
+import mimetypes
+import brotli
+from flask import Response, abort, request
+from . import app
+
+logger = logging.getLogger("flask.app")
+
+# Content types worth compressing, everything else is sent as is
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/javascript",
+    "application/x-ndjson",
+    "text/css",
+    "text/csv",
+    "text/html",
+    "text/javascript",
+    "text/plain",
+}
+
+FINGERPRINT_LENGTH = 12
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# matches "static/<name>" and '/static/<name>' in the HTML pages
+STATIC_REFERENCE = re.compile(r"""(["'])(/?static/)([^"'?#]+)\1""")
+
+
+def compress(data: bytes, encoding: str, quality: int) -> bytes:
+    """ Compresses data with the encoding, quality 1 (fast) to 9 (small) """
+    if encoding == "br":
+        return brotli.compress(data, quality=quality)
+    return gzip.compress(data, compresslevel=quality, mtime=0)
+
+
+def negotiate_encoding() -> str:
+    """ Returns the encoding the client prefers, br or gzip, or None for identity """
+    accepted = request.accept_encodings
+    brotli_quality, gzip_quality = accepted.quality("br"), accepted.quality("gzip")
+    if brotli_quality and brotli_quality >= gzip_quality:
+        return "br"
+    if gzip_quality:
+        return "gzip"
+    return None
+
+
+######################################################################
+#  S T A T I C   A S S E T S
+######################################################################
+class StaticAsset():
+    """ A static file with its hash and compressed forms """
+
+    def __init__(self, filename: str, data: bytes):
+        self.filename = filename
+        self.mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        self.data = data
+        self.etag = hashlib.sha1(data).hexdigest()
+        root, extension = os.path.splitext(filename)
+        self.fingerprinted = f"{root}.{self.etag[:FINGERPRINT_LENGTH]}{extension}"
+        self.encoded = {}
+
+    def precompress(self, quality: int):
+        """ Compresses the asset with every encoding ahead of the first request """
+        if self.mimetype in COMPRESSIBLE_TYPES:
+            self.encoded = {encoding: compress(self.data, encoding, quality) for encoding in ("br", "gzip")}
+
+
+class StaticAssets():
+    """ The files of the static folder, served precompressed from memory """
+
+    def __init__(self):
+        self.assets = {}
+        self.folder = None
+        self.quality = 9
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Serves the static folder of the app, which is only read by load() """
+        self.assets = {}
+        self.folder = app.static_folder
+        self.quality = app.config.get("STATIC_COMPRESS_LEVEL", 9)
+        app.view_functions["static"] = self.send
+
+    def load(self):
+        """ Loads, fingerprints and compresses every file of the static folder once """
+        if self.assets:
+            return
+        with self._lock:
+            if self.assets:
+                return
+            assets = {}
+            for directory, _, files in os.walk(self.folder):
+                for name in files:
+                    path = os.path.join(directory, name)
+                    filename = os.path.relpath(path, self.folder).replace(os.sep, "/")
+                    with open(path, "rb") as file:
+                        assets[filename] = StaticAsset(filename, file.read())
+            pages = [asset for asset in assets.values() if asset.mimetype == "text/html"]
+            for page in pages:
+                # the pages reference the other assets, so they are hashed once rewritten
+                data = self.rewrite(page.data.decode("utf-8"), assets).encode("utf-8")
+                assets[page.filename] = StaticAsset(page.filename, data)
+            fingerprinted = {}
+            for asset in assets.values():
+                asset.precompress(self.quality)
+                fingerprinted[asset.fingerprinted] = asset
+            assets.update(fingerprinted)
+            self.assets = assets
+        logger.info("Serving %d static files precompressed", len(fingerprinted))
+
+    def url(self, filename: str) -> str:
+        """ Returns the fingerprinted name of a static file """
+        self.load()
+        asset = self.assets.get(filename)
+        return asset.fingerprinted if asset else filename
+
+    @staticmethod
+    def rewrite(html: str, assets: dict) -> str:
+        """ Replaces the references to static files in a page by their fingerprinted names """
+        def fingerprint(match):
+            quote, prefix, filename = match.groups()
+            asset = assets.get(filename)
+            return f"{quote}{prefix}{asset.fingerprinted if asset else filename}{quote}"
+        return STATIC_REFERENCE.sub(fingerprint, html)
+
+    def send(self, filename: str) -> Response:
+        """ Sends a static file in the encoding the client prefers """
+        self.load()
+        asset = self.assets.get(filename)
+        if asset is None:
+            abort(404)
+        encoding = negotiate_encoding() if asset.encoded else None
+        response = Response(asset.encoded.get(encoding, asset.data), mimetype=asset.mimetype)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        if asset.encoded:
+            response.vary.add("Accept-Encoding")
+        if filename == asset.fingerprinted:
+            response.headers["Cache-Control"] = IMMUTABLE
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        response.set_etag(asset.etag, weak=bool(encoding))
+        return response.make_conditional(request)
+
+
+# The static files of the service, loaded by create_app() or on first use
+assets = StaticAssets()
+assets.init_app(app)
+
+
+######################################################################
+#  R E S P O N S E   C O M P R E S S I O N
+######################################################################
+@app.after_request
+def compress_response(response):
+    """ Compresses large API responses in the encoding the client prefers """
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code in (204, 304)
+        or response.status_code < 200
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_TYPES
+        or (response.content_length or 0) < app.config["COMPRESS_MIN_SIZE"]
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+    response.set_data(compress(response.get_data(), encoding, app.config["COMPRESS_LEVEL"]))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,77 @@
+"""
+Module: export
+Encoders that stream Customers out as NDJSON or CSV
+
+The encoders take an iterable of Customers and yield the encoded text in
+chunks of about CHUNK_SIZE characters, so a whole table can be written out
+without ever holding more than one chunk of it in memory.
+
+NDJSON has one Customer per line with its addresses nested, exactly as
+returned by GET /customers/{id}. CSV has one row per address with the columns
+of its Customer repeated; a Customer without addresses gets one row with the
+address columns left empty.
+"""
+import io
+import csv
+import json
+
+CHUNK_SIZE = 64 * 1024
+
+CUSTOMER_COLUMNS = ["id", "name", "first_name", "last_name", "email", "phone_number", "account_status"]
+ADDRESS_COLUMNS = ["address_id", "address_name", "street", "city", "state", "postalcode"]
+CSV_COLUMNS = CUSTOMER_COLUMNS + ADDRESS_COLUMNS
+
+
+def generate_ndjson(customers):
+    """ Yields the Customers as newline delimited JSON """
+    return _chunked(json.dumps(customer.serialize()) + "\n" for customer in customers)
+
+
+def generate_csv(customers):
+    """ Yields the Customers as CSV with a header row """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def lines():
+        writer.writerow(CSV_COLUMNS)
+        for customer in customers:
+            for row in csv_rows(customer):
+                writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    return _chunked(lines())
+
+
+def csv_rows(customer) -> list:
+    """ Returns the CSV rows of one Customer """
+    columns = [getattr(customer, column) for column in CUSTOMER_COLUMNS]
+    if not customer.addresses:
+        return [columns + [None] * len(ADDRESS_COLUMNS)]
+    return [
+        columns + [address.id, address.name, address.street, address.city, address.state, address.postalcode]
+        for address in customer.addresses
+    ]
+
+
+# format name -> (encoder, mimetype, file extension)
+FORMATS = {
+    "ndjson": (generate_ndjson, "application/x-ndjson", "ndjson"),
+    "csv": (generate_csv, "text/csv", "csv"),
+}
+
+
+def _chunked(lines):
+    """ Joins lines of text into chunks of about CHUNK_SIZE characters """
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield "".join(chunk)
@@ -0,0 +1,145 @@
+"""
+Module: importer
+Readers that load Customers in bulk from the NDJSON or CSV of an export
+
+The readers stream a file one Customer at a time, so a file of any size is
+read without holding more than one chunk of it in memory. Every Customer is
+validated by Customer.deserialize() exactly as a POST would be, plus the
+column lengths the database would otherwise reject a whole chunk for, and
+the valid ones are loaded chunk_size at a time with Customer.bulk_load().
+
+A Customer that is not valid is handed to reject() with its line number and
+the error, and the import carries on with the next one.
+
+NDJSON has one Customer per line with its addresses nested. CSV has one row
+per address with the columns of its Customer repeated; consecutive rows with
+the same id are one Customer, and a row with empty address columns is a
+Customer without addresses. The ids in the file are not kept, every Customer
+and Address is given a new one.
+"""
+import csv
+import json
+import time
+from functools import lru_cache
+from service.export import CUSTOMER_COLUMNS
+from service.models import Customer, DataValidationError
+
+# CSV column -> field of the Address
+ADDRESS_FIELDS = {
+    "address_name": "name", "street": "street", "city": "city", "state": "state", "postalcode": "postalcode"
+}
+
+
+def read_ndjson(lines):
+    """ Yields (line number, Customer dict, error) for every line of NDJSON """
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line), None
+        except ValueError:
+            yield number, line.rstrip("\n"), f"Invalid Customer: line {number} is not valid JSON"
+
+
+def read_csv(lines):
+    """ Yields (line number, Customer dict, error) for the rows of each Customer in CSV """
+    reader = csv.DictReader(lines)
+    customer, first_line, key = None, None, None
+    for row in reader:
+        row_key = row.get("id") or None
+        if customer is None or row_key is None or row_key != key:
+            if customer is not None:
+                yield first_line, customer, None
+            customer = {column: row[column] or None for column in CUSTOMER_COLUMNS if column in row}
+            customer["addresses"] = []
+            first_line, key = reader.line_num, row_key
+        address = {field: row.get(column) or None for column, field in ADDRESS_FIELDS.items()}
+        if any(address.values()):
+            customer["addresses"].append(address)
+    if customer is not None:
+        yield first_line, customer, None
+
+
+# format name -> reader
+READERS = {
+    "ndjson": read_ndjson,
+    "csv": read_csv,
+}
+
+
+def validate(data) -> Customer:
+    """ Returns a new Customer with its addresses deserialized from data
+
+    The customer_id of the addresses is ignored, they belong to the Customer
+    they are nested in.
+    """
+    if not isinstance(data, dict):
+        raise DataValidationError("Invalid Customer: body of request contained bad or no data")
+    if isinstance(data.get("addresses"), list):
+        data = dict(data, addresses=[
+            dict(address, customer_id=None) if isinstance(address, dict) else address
+            for address in data["addresses"]
+        ])
+    customer = Customer().deserialize(data)
+    _check_lengths(customer)
+    for address in customer.addresses:
+        _check_lengths(address)
+    return customer
+
+
+def import_customers(records, reject, chunk_size: int, progress=None) -> dict:
+    """ Validates and loads the Customers of a reader chunk_size at a time
+
+    :param records: the (line number, Customer dict, error) of a reader
+    :param reject: called with the line number, the data and the error of
+        every Customer that is not valid
+    :param chunk_size: the number of Customers loaded per transaction
+    :param progress: called with the counts after every chunk
+
+    :return: the counts of customers, addresses and rejected records, and
+        the seconds the import took
+    :rtype: dict
+    """
+    counts = {"customers": 0, "addresses": 0, "rejected": 0, "seconds": 0.0}
+    start = time.perf_counter()
+    chunk = []
+
+    def load():
+        counts["addresses"] += Customer.bulk_load(chunk)
+        counts["customers"] += len(chunk)
+        counts["seconds"] = time.perf_counter() - start
+        chunk.clear()
+        if progress:
+            progress(counts)
+
+    for number, data, error in records:
+        if error is None:
+            try:
+                chunk.append(validate(data))
+            except DataValidationError as validation_error:
+                error = str(validation_error)
+        if error is not None:
+            counts["rejected"] += 1
+            reject(number, data, error)
+        if len(chunk) >= chunk_size:
+            load()
+    if chunk:
+        load()
+    counts["seconds"] = time.perf_counter() - start
+    return counts
+
+
+def _check_lengths(record):
+    """ Raises DataValidationError if a string is longer than its column """
+    for name, length in _string_lengths(record.__table__):
+        value = getattr(record, name)
+        if isinstance(value, str) and len(value) > length:
+            raise DataValidationError(f"Invalid {type(record).__name__}: {name} is longer than {length} characters")
+
+
+@lru_cache(maxsize=None)
+def _string_lengths(table) -> tuple:
+    """ Returns the (name, length) of the columns of a table that have a length """
+    return tuple(
+        (column.name, column.type.length) for column in table.columns if getattr(column.type, "length", None)
+    )
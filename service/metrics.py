@@ -0,0 +1,165 @@
+"""
+Module: metrics
+Prometheus metrics of the requests served by this service
+
+Every request is counted and timed per handler, which is the flask-restx
+resource and method that served it (e.g. CustomerResource.get), or the
+endpoint name for plain Flask routes. Error counts come from the status
+label of http_requests_total.
+
+Under gunicorn each worker writes its samples to files in
+PROMETHEUS_MULTIPROC_DIR (set by gunicorn.conf.py) and GET /metrics merges
+the files of all workers, so the numbers are the same whichever worker
+answers the scrape.
+
+The statements each request runs are counted as well. The count and the
+database time are returned in a Server-Timing header, and a warning is
+logged when a request runs more than QUERY_COUNT_WARNING statements, which
+is how N+1 query patterns show up.
+"""
+import os
+import time
+from collections import Counter as StatementCounter
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from . import app
+
+REQUEST_COUNT = Counter(
+    "http_requests_total", "Requests served", ["handler", "method", "status"]
+)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time spent serving a request", ["handler", "method"]
+)
+RESPONSE_SIZE = Histogram(
+    "http_response_size_bytes", "Size of the response body", ["handler", "method"],
+    buckets=(100, 1000, 10000, 100000, 1000000, 10000000),
+)
+DB_TIME = Histogram(
+    "http_request_db_duration_seconds", "Time spent in the database while serving a request", ["handler", "method"]
+)
+
+
+def handler_name() -> str:
+    """ Returns the name of the resource method that serves the current request """
+    if request.url_rule is None:
+        return "none"
+    view = app.view_functions.get(request.endpoint)
+    view_class = getattr(view, "view_class", None)
+    if view_class is not None:
+        return f"{view_class.__name__}.{request.method.lower()}"
+    return request.endpoint
+
+
+def server_timing(total: float, db_time: float, queries: int) -> str:
+    """ Returns the Server-Timing header value for a request, durations in seconds """
+    return f'db;dur={db_time * 1000:.2f};desc="{queries} queries", total;dur={total * 1000:.2f}'
+
+
+def render() -> tuple:
+    """ Returns the metrics of every worker in the Prometheus text format """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+@app.before_request
+def start_timer():
+    """ Starts timing the request and its database work """
+    g.request_start_time = time.perf_counter()
+    g.db_time = 0.0
+    g.db_queries = 0
+    g.db_statements = StatementCounter()
+
+
+@app.after_request
+def record_request(response):
+    """ Records the latency, size and database work of the request """
+    start = g.get("request_start_time")
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    handler = handler_name()
+    method = request.method
+    REQUEST_COUNT.labels(handler, method, str(response.status_code)).inc()
+    REQUEST_LATENCY.labels(handler, method).observe(elapsed)
+    DB_TIME.labels(handler, method).observe(g.db_time)
+    if response.content_length is not None:
+        RESPONSE_SIZE.labels(handler, method).observe(response.content_length)
+    response.headers["Server-Timing"] = server_timing(elapsed, g.db_time, g.db_queries)
+    if g.db_queries > app.config.get("QUERY_COUNT_WARNING", 20):
+        statement, repeats = g.db_statements.most_common(1)[0]
+        app.logger.warning(
+            "%s %s ran %d queries, %d of them: %s",
+            method, handler, g.db_queries, repeats, " ".join(statement.split())[:200]
+        )
+    return response
+
+
+######################################################################
+#  D A T A B A S E   H O O K S
+######################################################################
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    """ Notes when a statement was sent to the database """
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    """ Adds the time of a statement to the request that ran it """
+    elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+    if has_request_context() and "db_time" in g:
+        g.db_time += elapsed
+        g.db_queries += 1
+        g.db_statements[statement] += 1
+
+
+@event.listens_for(Engine, "handle_error")
+def discard_query_timer(context):
+    """ Forgets the start time of a statement that failed """
+    starts = context.connection.info.get("query_start_time") if context.connection else None
+    if starts:
+        starts.pop()
+
+
+class QueryCount():
+    """ The statements run inside a count_queries() block """
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self) -> int:
+        """ The number of statements that were run """
+        return len(self.statements)
+
+
+@contextmanager
+def count_queries():
+    """ Counts the statements run inside the with block (use for testing)
+
+    with count_queries() as queries:
+        client.get("/customers")
+    assert queries.count == 2
+    """
+    queries = QueryCount()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        queries.statements.append(statement)
+
+    event.listen(Engine, "after_cursor_execute", record)
+    try:
+        yield queries
+    finally:
+        event.remove(Engine, "after_cursor_execute", record)
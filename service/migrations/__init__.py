@@ -0,0 +1,97 @@
+"""
+Package: migrations
+Versioned schema migrations for the Customer Service
+
+Every module in this package named vNNNN_<description>.py is one migration
+with an upgrade(connection) function. The versions that have been applied to
+a database are recorded in the schema_version table, so upgrade() only runs
+the migrations that are still pending, in version order.
+
+Migrations must not import the models: they describe the schema as it was
+when they were written, not as it is now.
+"""
+import re
+import logging
+import pkgutil
+import importlib
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, func, inspect, select, text
+
+logger = logging.getLogger("flask.app")
+
+MODULE_PATTERN = re.compile(r"^v(\d{4})_(\w+)$")
+
+# arbitrary key for the Postgres advisory lock that serializes upgrades
+ADVISORY_LOCK_KEY = 7212001
+
+metadata = MetaData()
+schema_version = Table(
+    "schema_version",
+    metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String(128), nullable=False),
+    Column("applied_at", DateTime, nullable=False, server_default=func.now()),
+)
+
+
+def migrations() -> list:
+    """ Returns all of the migrations as (version, description, module) sorted by version """
+    found = []
+    for module_info in pkgutil.iter_modules(__path__):
+        match = MODULE_PATTERN.match(module_info.name)
+        if not match:
+            continue
+        module = importlib.import_module(f"{__name__}.{module_info.name}")
+        found.append((int(match.group(1)), match.group(2).replace("_", " "), module))
+    return sorted(found, key=lambda migration: migration[0])
+
+
+def head() -> int:
+    """ Returns the version of the newest migration """
+    return migrations()[-1][0]
+
+
+def current_version(engine) -> int:
+    """ Returns the newest version applied to the database, 0 if none """
+    with engine.connect() as conn:
+        return _current_version(conn)
+
+
+def upgrade(engine, target: int = None) -> list:
+    """ Applies all of the pending migrations up to and including target
+
+    All of the pending migrations run in one transaction so a failed
+    migration leaves the schema untouched. On Postgres an advisory lock makes
+    concurrent workers wait for the first one to finish instead of racing it.
+
+    :param engine: the engine of the database to upgrade
+    :param target: the version to stop at, defaults to the newest one
+
+    :return: the versions that were applied
+    :rtype: list
+    """
+    applied = []
+    with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": ADVISORY_LOCK_KEY})
+        metadata.create_all(conn, checkfirst=True)
+        current = _current_version(conn)
+        for version, description, module in migrations():
+            if version <= current or (target is not None and version > target):
+                continue
+            logger.info("Applying migration %04d: %s", version, description)
+            module.upgrade(conn)
+            conn.execute(schema_version.insert().values(version=version, description=description))
+            applied.append(version)
+    return applied
+
+
+def drop(engine):
+    """ Removes the version history so the next upgrade starts over (use for testing) """
+    metadata.drop_all(engine, checkfirst=True)
+
+
+def _current_version(conn) -> int:
+    """ Returns the newest version applied using an open connection """
+    if not inspect(conn).has_table(schema_version.name):
+        return 0
+    return conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
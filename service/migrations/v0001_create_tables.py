@@ -0,0 +1,35 @@
+"""
+Migration 0001: create the customer and address tables
+
+Uses checkfirst so databases that were created by db.create_all() before
+migrations existed are adopted as they are.
+"""
+from sqlalchemy import MetaData, Table, Column, Integer, String, ForeignKey
+
+
+def upgrade(conn):
+    """ Creates the customer and address tables """
+    metadata = MetaData()
+    Table(
+        "customer",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String(64)),
+        Column("first_name", String(64)),
+        Column("last_name", String(64)),
+        Column("email", String(64)),
+        Column("phone_number", String(32), nullable=True),
+        Column("account_status", String(64)),
+    )
+    Table(
+        "address",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("customer_id", Integer, ForeignKey("customer.id"), nullable=False),
+        Column("name", String(64)),
+        Column("street", String(64)),
+        Column("city", String(64)),
+        Column("state", String(2)),
+        Column("postalcode", String(16)),
+    )
+    metadata.create_all(conn, checkfirst=True)
@@ -0,0 +1,25 @@
+"""
+Migration 0002: index the columns the Customer searches filter on
+
+Covers every find_by_* query of Customer, the street and postal code
+searches through the addresses, and address.customer_id which is used to
+load the addresses of a Customer.
+"""
+from sqlalchemy import text
+
+INDEXES = [
+    ("ix_customer_name", "customer", "name"),
+    ("ix_customer_first_name", "customer", "first_name"),
+    ("ix_customer_last_name", "customer", "last_name"),
+    ("ix_customer_email", "customer", "email"),
+    ("ix_customer_phone_number", "customer", "phone_number"),
+    ("ix_address_customer_id", "address", "customer_id"),
+    ("ix_address_street", "address", "street"),
+    ("ix_address_postalcode", "address", "postalcode"),
+]
+
+
+def upgrade(conn):
+    """ Creates the search indexes """
+    for name, table, column in INDEXES:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({column})"))
@@ -0,0 +1,57 @@
+"""
+Migration 0003: delete the addresses of a Customer together with it
+
+Recreates the foreign key of address.customer_id with ON DELETE CASCADE, so
+a Customer, or many of them, can be deleted in a single statement. SQLite
+cannot alter a constraint, so there the address table is rebuilt with the
+new key and its indexes are recreated.
+"""
+from sqlalchemy import MetaData, Table, Column, Integer, String, ForeignKey, inspect, text
+
+CONSTRAINT = "address_customer_id_fkey"
+
+
+def upgrade(conn):
+    """ Adds ON DELETE CASCADE to the foreign key of address.customer_id """
+    if conn.dialect.name == "sqlite":
+        _rebuild_address(conn)
+        return
+    for foreign_key in inspect(conn).get_foreign_keys("address"):
+        if foreign_key["referred_table"] == "customer":
+            conn.execute(text(f"ALTER TABLE address DROP CONSTRAINT {foreign_key['name']}"))
+    conn.execute(text(
+        f"ALTER TABLE address ADD CONSTRAINT {CONSTRAINT} "
+        "FOREIGN KEY (customer_id) REFERENCES customer (id) ON DELETE CASCADE"
+    ))
+
+
+def _rebuild_address(conn):
+    """ Copies the address table into one with the cascading foreign key """
+    indexes = inspect(conn).get_indexes("address")
+    metadata = MetaData()
+    Table(
+        "address_new",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column(
+            "customer_id", Integer,
+            ForeignKey("customer.id", name=CONSTRAINT, ondelete="CASCADE"), nullable=False
+        ),
+        Column("name", String(64)),
+        Column("street", String(64)),
+        Column("city", String(64)),
+        Column("state", String(2)),
+        Column("postalcode", String(16)),
+    )
+    Table("customer", metadata, Column("id", Integer, primary_key=True))
+    metadata.tables["address_new"].create(conn)
+    conn.execute(text(
+        "INSERT INTO address_new (id, customer_id, name, street, city, state, postalcode) "
+        "SELECT id, customer_id, name, street, city, state, postalcode FROM address"
+    ))
+    conn.execute(text("DROP TABLE address"))
+    conn.execute(text("ALTER TABLE address_new RENAME TO address"))
+    for index in indexes:
+        columns = ", ".join(index["column_names"])
+        unique = "UNIQUE " if index["unique"] else ""
+        conn.execute(text(f"CREATE {unique}INDEX {index['name']} ON address ({columns})"))
@@ -0,0 +1,45 @@
+"""
+Migration 0004: track when and how often every record changes
+
+Adds updated_at and a row version to the customer and address tables, with
+an index on (updated_at, id) for the ?updated_since= delta queries, and
+creates the outbox table that every change writes an event to in the same
+transaction.
+
+Existing rows start at version 1, updated when the migration ran. SQLite
+cannot add a column with a non-constant default, so there the column starts
+at the epoch and is set in a second statement.
+"""
+from sqlalchemy import MetaData, Table, Column, Integer, String, Text, DateTime, text
+
+
+def upgrade(conn):
+    """ Adds the updated_at and version columns and creates the outbox """
+    for table in ("customer", "address"):
+        if conn.dialect.name == "postgresql":
+            conn.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP NOT NULL "
+                "DEFAULT (now() AT TIME ZONE 'utc')"
+            ))
+        else:
+            conn.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT '1970-01-01 00:00:00'"
+            ))
+            conn.execute(text(f"UPDATE {table} SET updated_at = CURRENT_TIMESTAMP"))
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+        conn.execute(text(f"CREATE INDEX ix_{table}_updated_at ON {table} (updated_at, id)"))
+
+    metadata = MetaData()
+    Table(
+        "outbox",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("entity", String(16), nullable=False),
+        Column("entity_id", Integer, nullable=True),
+        Column("customer_id", Integer, nullable=True),
+        Column("operation", String(16), nullable=False),
+        Column("version", Integer, nullable=True),
+        Column("payload", Text, nullable=True),
+        Column("created_at", DateTime, nullable=False),
+    )
+    metadata.create_all(conn, checkfirst=True)
@@ -28,41 +28,86 @@ last name
 email
 phone number
 """
-import os
+import io
+import re
+import json
+import heapq
 import logging
-from retry import retry
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from requests import HTTPError, ConnectionError
+import threading
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from operator import attrgetter
+from flask import Flask, _app_ctx_stack
+from sqlalchemy import and_, bindparam, event, select, text
+from sqlalchemy.orm import noload, selectinload
+from service import migrations
+from service.cache import cache
+from service.replicas import router
+from service.resilience import DatabaseConnectionError, policy
+from service.shards import ShardedSQLAlchemy, shards
+from service.singleflight import flights
 
 logger = logging.getLogger("flask.app")
 
-# global variables for retry (must be int)
-RETRY_COUNT = int(os.environ.get("RETRY_COUNT", 10))
-RETRY_DELAY = int(os.environ.get("RETRY_DELAY", 1))
-RETRY_BACKOFF = int(os.environ.get("RETRY_BACKOFF", 2))
+
+def session_scope():
+    """ Returns the key of the session to use: one per app context, or per thread outside of one
+
+    Every request pushes an app context of its own, so two requests never
+    share a session even when the same thread or greenlet serves both, and
+    Flask-SQLAlchemy removes the session when the context is torn down.
+    Threads started by the service must push an app context to get theirs.
+    """
+    context = _app_ctx_stack.top
+    if context is not None:
+        return id(context)
+    # gevent patches get_ident() to tell its greenlets apart
+    return threading.get_ident()
+
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = ShardedSQLAlchemy(session_options={"scopefunc": session_scope})
 
-def init_db(app):
+# the app whose database init_db() last set up all the way
+_initialized_app = None
+
+def init_db(app, upgrade: bool = True):
     """Initialize the SQLAlchemy app"""
-    Customer.init_db(app)
-    Address.init_db(app)
+    global _initialized_app
+    _initialized_app = None
+    Customer.init_db(app, upgrade)
+    Address.init_db(app, upgrade)
+    _initialized_app = app
+
+def initialized(app) -> bool:
+    """ Returns whether init_db() finished setting up the database of the app """
+    return _initialized_app is app
 
-class DatabaseConnectionError(Exception):
-    """ Custom exception when database connection fails"""
+def engines() -> list:
+    """ Returns the engine of every database the models connect to, shards and read replicas """
+    return list(shards.binds().values()) + [replica.engine for replica in router.replicas]
 
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
     pass
 
+
+def utcnow() -> datetime:
+    """ Returns the current time in UTC without a timezone, as the timestamp columns store it """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def format_timestamp(value: datetime) -> str:
+    """ Returns a timestamp column in ISO 8601, marked as UTC """
+    return value.isoformat() + "Z" if value is not None else None
+
 ######################################################################
 #  P E R S I S T E N T   B A S E   M O D E L
 ######################################################################
 class PersistentBase():
     """ Base class added persistent methods """
 
+    @policy.write
     def create(self):
         """ 
         Creates a Customer to the database
@@ -71,77 +116,112 @@ class PersistentBase():
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
         db.session.commit()
+        cache.invalidate(*self.cache_keys())
 
+    @classmethod
+    @policy.write
+    def bulk_create(cls, records: list) -> list:
+        """
+        Creates many records in the database in one transaction
+
+        The inserts are batched into multi-row statements when the session
+        is flushed, so this costs a handful of round trips instead of one
+        commit per record. Nothing is saved if any of the inserts fails.
+
+        :return: the records serialized after the inserts, since the commit
+            expires them and serializing them later would read each one again
+        :rtype: list
+        """
+        logger.info("Creating %d %s records", len(records), cls.__name__)
+        for record in records:
+            record.id = None  # id must be none to generate next primary key
+        db.session.add_all(records)
+        try:
+            db.session.flush()
+            serialized = [record.serialize() for record in records]
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return serialized
+
+    @policy.write
     def update(self):
         """ 
         Updates a Customer to the database
         """
         logger.info("Saving %s", self.id)
+        keys = self.cache_keys()
         db.session.commit()
+        cache.invalidate(*keys, *self.cache_keys())
 
+    @policy.write
     def delete(self):
         """ 
         Removes an Account from the data store 
         """
         logger.info("Deleting %s", self.id)
+        keys = self.cache_keys()
         db.session.delete(self)
         db.session.commit()
+        cache.invalidate(*keys)
 
     @classmethod
-    @retry(
-        HTTPError, 
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
-    def init_db(cls, app: Flask):
+    def cache_key(cls, by_id) -> str:
+        """ Returns the key the serialized record with the id is cached under """
+        return f"{cls.__tablename__}:{by_id}"
+
+    def cache_keys(self) -> list:
+        """ Returns the keys of every cached record that embeds this one """
+        return [self.cache_key(self.id)]
+
+    @classmethod
+    def init_db(cls, app: Flask, upgrade: bool = True):
         """Initializes the database session
 
+        The engine is only created on first use and connects on the first
+        query, so nothing touches the database unless upgrade is set.
+
         :param app: the Flask app
         :type data: Flask
+        :param upgrade: whether to apply the pending schema migrations
+        :type upgrade: bool
 
         """
         logger.info("Initializing database")
         # This is where we initialize SQLAlchemy from the Flask app
         cls.app = app
         db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        # the session finds the app without a pushed context outside of requests
+        db.app = app
+        cache.init_app(app)
+        flights.init_app(app)
+        policy.init_app(app, db.session)
+        router.init_app(app, db)
+        shards.init_app(app, db)
+        _outbox_ids.reset()
+        if upgrade:
+            # the upgrade is idempotent, so it is safe to retry while the database starts
+            for engine in shards.binds().values():
+                policy.read(migrations.upgrade)(engine)  # make or upgrade our sqlalchemy tables
 
     @classmethod
-    @retry(
-        HTTPError, 
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
+    @policy.write
     def remove_all(cls):
-        """ Removes all documents from the database (use for testing) """
-        db.drop_all()
+        """ Removes all documents from the database, and every shard of it (use for testing) """
+        for engine in shards.binds().values():
+            db.Model.metadata.drop_all(bind=engine)
+            migrations.drop(engine)
 
     @classmethod
-    @retry(
-        HTTPError, 
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
+    @policy.read
     def all(cls) -> list:
         """Returns all of the Customers in the database"""
         logger.info("Processing all Records")
         return cls.query.all()
 
     @classmethod
-    @retry(
-        HTTPError, 
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
+    @policy.read
     def find(cls, by_id: int):
         """ Finds a Record by it's ID
 
@@ -156,13 +236,7 @@ class PersistentBase():
         return cls.query.get(by_id)
 
     @classmethod
-    @retry(
-        HTTPError, 
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
+    @policy.read
     def find_or_404(cls, customer_id: int):
         """Find a Customer by it's id or 404
         
@@ -175,6 +249,196 @@ class PersistentBase():
         logger.info("Processing lookup or 404 for id %s...", customer_id)
         return cls.query.get_or_404(customer_id)
 
+    @classmethod
+    @policy.read
+    def paginate(cls, query, limit: int, after: int = None) -> tuple:
+        """Returns one page of a query using keyset pagination on the id
+
+        :param query: the query to return a page of
+        :type query: Query
+        :param limit: the maximum number of records on the page
+        :type limit: int
+        :param after: the id of the last record of the previous page
+        :type after: int
+
+        :return: the records on the page and the id to continue after,
+            or None if this is the last page
+        :rtype: tuple
+        """
+        logger.info("Processing page of %s records after id %s ...", limit, after)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        records = query.order_by(cls.id).limit(limit + 1).all()
+        if len(records) > limit:
+            return records[:limit], records[limit - 1].id
+        return records, None
+
+    @classmethod
+    def parse_fields(cls, value: str):
+        """ Parses a comma separated list of fields to return, as given in ?fields=
+
+        :param value: the names of the fields, e.g. "id,email,account_status"
+        :type value: str
+
+        :return: the requested fields, or None to return all of them
+        :rtype: tuple
+        """
+        if not value:
+            return None
+        fields = tuple(dict.fromkeys(field.strip() for field in value.split(",") if field.strip()))
+        unknown = set(fields).difference(cls.FIELDS)
+        if unknown:
+            raise DataValidationError("Invalid fields: " + ", ".join(sorted(unknown)))
+        return fields or None
+
+    @staticmethod
+    def project(record: dict, fields: tuple) -> dict:
+        """ Returns a serialized Record with only the given fields """
+        if fields is None:
+            return record
+        return {field: value for field, value in record.items() if field in fields}
+
+    @classmethod
+    def selected_fields(cls, fields: tuple = None) -> tuple:
+        """ Returns the columns to select for the given fields, always including the id """
+        if fields is None:
+            return cls.SERIALIZED_FIELDS
+        return tuple(field for field in cls.SERIALIZED_FIELDS if field == "id" or field in fields)
+
+    @classmethod
+    def columns(cls, query, fields: tuple = None):
+        """ Returns a query of Records that selects only the serialized columns
+
+        The rows come back as plain tuples without building an ORM object
+        for each one, ready for serialize_rows(). The id is always selected
+        because paging and grouping need it.
+
+        :param query: a query of Records
+        :type query: Query
+        :param fields: the fields to select, or None for SERIALIZED_FIELDS
+        :type fields: tuple
+
+        :return: the query selecting only those columns
+        :rtype: Query
+        """
+        return query.with_entities(*(getattr(cls, field) for field in cls.selected_fields(fields)))
+
+    @classmethod
+    def serialize_rows(cls, rows, fields: tuple = None) -> list:
+        """ Serializes the rows of a columns() query into the dictionaries serialize() returns
+
+        :param rows: the rows selected by a columns() query
+        :type rows: list
+        :param fields: the fields the rows were selected with
+        :type fields: tuple
+
+        :return: a dictionary holding the fields of each row
+        :rtype: list
+        """
+        selected = cls.selected_fields(fields)
+        records = [cls.serialize_row(row, selected) for row in rows]
+        if fields is not None and "id" not in fields:
+            for record in records:
+                del record["id"]
+        return records
+
+    @classmethod
+    def serialize_row(cls, row, selected: tuple = None) -> dict:
+        """ Serializes one row of the selected columns, SERIALIZED_FIELDS by default """
+        record = dict(zip(selected or cls.SERIALIZED_FIELDS, row))
+        if "updated_at" in record:
+            record["updated_at"] = format_timestamp(record["updated_at"])
+        return record
+
+    @classmethod
+    def find_serialized(cls, by_id: int, fields: tuple = None):
+        """ Finds a Record by it's ID and returns it serialized, through the cache
+
+        When only some fields are wanted they are taken from the cached
+        Record if there is one, and otherwise only those columns are read
+        from the database, leaving the cache untouched. A client that has just
+        written, and so reads from the primary, skips the cache altogether, and
+        a read from a replica that lags does not fill it.
+        Lookups of the same Record that miss the cache at the same time share
+        one query.
+
+        :param by_id: the ID of the Record to find
+        :type by_id: int
+        :param fields: the fields to return, or None for all of them
+        :type fields: tuple
+
+        :return: the serialized Record or None if not found
+        :rtype: dict
+
+        """
+        # as a number, so "01" and 1 share the entry that writes invalidate
+        key = cls.cache_key(int(by_id))
+        # a replica may have filled the cache before it replayed the write of this client
+        after_write = db.session.info.get("primary", False)
+        if fields is not None:
+            record = cache.get(key) if not after_write else None
+            if record is not None:
+                return cls.project(record, fields)
+            if after_write:
+                return cls.find_fields(by_id, fields)
+            return flights.do((key, fields), lambda: cls.find_fields(by_id, fields))
+
+        def load():
+            record = cls.find(by_id)
+            return record.serialize() if record else None
+        if after_write:
+            return load()
+        if not router.cacheable(db.session()):
+            # a replica that lags may still have the record as it was before a write
+            record = cache.get(key)
+            return record if record is not None else flights.do((key, "lagging"), load)
+        return cache.get_or_load(key, lambda: flights.do(key, load))
+
+    @classmethod
+    def find_page(cls, query, key: tuple, limit: int, after: int = None, fields: tuple = None, **options) -> tuple:
+        """ Returns one page of a search serialized, sharing it with identical searches in flight
+
+        :param query: a query of Records, e.g. from find_by_filters()
+        :type query: Query
+        :param key: what tells the search apart from the others of the Records, e.g. its filters
+        :type key: tuple
+        :param limit: the maximum number of records on the page
+        :type limit: int
+        :param after: the id of the last record of the previous page
+        :type after: int
+        :param fields: the fields to return, or None for all of them
+        :type fields: tuple
+
+        :return: the serialized records on the page and the id to continue after,
+            or None if this is the last page
+        :rtype: tuple
+        """
+        def load():
+            rows, last_id = cls.paginate(cls.columns(query, fields), limit, after)
+            return cls.serialize_rows(rows, fields, **options), last_id
+        # a client that has just written reads from the primary, so it shares no page of a replica
+        if db.session.info.get("primary", False):
+            return load()
+        return flights.do((cls.__tablename__, key, limit, after, fields, tuple(sorted(options.items()))), load)
+
+    @classmethod
+    @policy.read
+    def find_fields(cls, by_id: int, fields: tuple):
+        """ Reads only the given fields of the Record with the ID
+
+        :param by_id: the ID of the Record to find
+        :type by_id: int
+        :param fields: the fields to return
+        :type fields: tuple
+
+        :return: the serialized Record or None if not found
+        :rtype: dict
+        """
+        logger.info("Processing lookup of %s for id %s ...", ", ".join(fields), by_id)
+        rows = cls.columns(cls.query.filter(cls.id == by_id), fields).all()
+        records = cls.serialize_rows(rows, fields)
+        return records[0] if records else None
+
 ######################################################################
 #  A D D R E S S   M O D E L
 ######################################################################
@@ -190,12 +454,27 @@ class Address(db.Model, PersistentBase):
     # Table Schema
     ##################################################
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
+    customer_id = db.Column(
+        db.Integer, db.ForeignKey('customer.id', ondelete='CASCADE'), nullable=False, index=True
+    )
     name = db.Column(db.String(64)) # e.g., work, home, vacation, etc.
-    street = db.Column(db.String(64))
+    street = db.Column(db.String(64), index=True)
     city = db.Column(db.String(64))
     state = db.Column(db.String(2))
-    postalcode = db.Column(db.String(16))
+    postalcode = db.Column(db.String(16), index=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow, onupdate=utcnow)
+    # incremented by every UPDATE, which fails if another one got there first
+    version = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (db.Index("ix_address_updated_at", "updated_at", "id"),)
+    __mapper_args__ = {"version_id_col": version}
+
+    # The columns returned by serialize(), in order
+    SERIALIZED_FIELDS = (
+        "id", "customer_id", "name", "street", "city", "state", "postalcode", "updated_at", "version"
+    )
+    # The fields that can be asked for with ?fields=
+    FIELDS = SERIALIZED_FIELDS
 
     ##################################################
     # INSTANCE METHODS
@@ -206,6 +485,10 @@ class Address(db.Model, PersistentBase):
     def __str__(self):
         return "%s: %s, %s, %s %s" % (self.name, self.street, self.city, self.state, self.postalcode)
 
+    def cache_keys(self) -> list:
+        """ Returns the keys of this Address and of the Customer that embeds it """
+        return [self.cache_key(self.id), Customer.cache_key(self.customer_id)]
+
     def serialize(self):
         """ Serializes an Address into a dictionary """
         return {
@@ -215,7 +498,9 @@ class Address(db.Model, PersistentBase):
             "street": self.street,
             "city": self.city,
             "state": self.state,
-            "postalcode": self.postalcode
+            "postalcode": self.postalcode,
+            "updated_at": format_timestamp(self.updated_at),
+            "version": self.version,
         }
     
     def deserialize(self, data):
@@ -239,6 +524,19 @@ class Address(db.Model, PersistentBase):
             )
         return self
 
+    @classmethod
+    def find_by_customer_id(cls, customer_id: int):
+        """ Returns all of the Addresses of a Customer
+
+        :param customer_id: the id of the Customer the Addresses belong to
+        :type customer_id: int
+
+        :return: a query of the Addresses of that Customer
+        :rtype: Query
+        """
+        logger.info("Processing address query for customer %s ...", customer_id)
+        return cls.query.filter(cls.customer_id == customer_id)
+
 ######################################################################
 #  C U S T O M E R   M O D E L
 ######################################################################
@@ -254,13 +552,36 @@ class Customer(db.Model, PersistentBase):
     # Table Schema
     ##################################################
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(64)) # Username
-    first_name = db.Column(db.String(64))
-    last_name = db.Column(db.String(64))
-    email = db.Column(db.String(64))
-    phone_number = db.Column(db.String(32), nullable=True)  # phone # is optional
+    name = db.Column(db.String(64), index=True) # Username
+    first_name = db.Column(db.String(64), index=True)
+    last_name = db.Column(db.String(64), index=True)
+    email = db.Column(db.String(64), index=True)
+    phone_number = db.Column(db.String(32), nullable=True, index=True)  # phone # is optional
     account_status = db.Column(db.String(64)) #create a column for customer status
-    addresses = db.relationship('Address', backref='customer', lazy=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow, onupdate=utcnow)
+    # incremented by every UPDATE, which fails if another one got there first
+    version = db.Column(db.Integer, nullable=False)
+    # addresses are loaded for all Customers of a query in one extra SELECT, in id order,
+    # and deleted with their Customer by the database (ON DELETE CASCADE)
+    addresses = db.relationship(
+        'Address', backref='customer', lazy='selectin', order_by='Address.id',
+        cascade='save-update, merge, delete', passive_deletes=True
+    )
+
+    __table_args__ = (db.Index("ix_customer_updated_at", "updated_at", "id"),)
+    __mapper_args__ = {"version_id_col": version}
+
+    # fields that find_by_filters() can match on
+    FILTER_FIELDS = ("name", "first_name", "last_name", "email", "phone_number", "account_status")
+    ADDRESS_FILTER_FIELDS = ("street", "city", "state", "postalcode")
+
+    # The columns returned by serialize(), in order
+    SERIALIZED_FIELDS = (
+        "id", "name", "first_name", "last_name", "email", "phone_number", "account_status",
+        "updated_at", "version"
+    )
+    # The fields that can be asked for with ?fields=
+    FIELDS = SERIALIZED_FIELDS + ("addresses",)
 
     ##################################################
     # INSTANCE METHODS
@@ -268,8 +589,16 @@ class Customer(db.Model, PersistentBase):
     def __repr__(self):
         return "<Customer %r id=[%s]>" % (self.name, self.id)
 
-    def serialize(self) -> dict:
-        """ Serializes a Customer into a dictionary """
+    def cache_keys(self) -> list:
+        """ Returns the keys of this Customer and of the Addresses it embeds """
+        return [self.cache_key(self.id)] + [Address.cache_key(address.id) for address in self.addresses]
+
+    def serialize(self, addresses: bool = True) -> dict:
+        """ Serializes a Customer into a dictionary
+
+        :param addresses: whether to include the addresses of the Customer
+        :type addresses: bool
+        """
         customer = {
             "id": self.id,
             "name": self.name,
@@ -278,10 +607,11 @@ class Customer(db.Model, PersistentBase):
             "email": self.email,
             "phone_number": self.phone_number,
             "account_status": self.account_status,
-            "addresses": []
+            "updated_at": format_timestamp(self.updated_at),
+            "version": self.version,
         }
-        for address in self.addresses:
-            customer['addresses'].append(address.serialize())
+        if addresses:
+            customer["addresses"] = [address.serialize() for address in self.addresses]
         return customer
 
     def deserialize(self, data: dict):
@@ -313,13 +643,319 @@ class Customer(db.Model, PersistentBase):
         return self
     
     @classmethod
-    @retry(
-        HTTPError, 
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
+    def embed(cls, query, addresses: bool = True):
+        """ Sets how the addresses of the Customers in a query are loaded
+
+        :param query: a query of Customers
+        :type query: Query
+        :param addresses: load the addresses in one batched SELECT when True,
+            otherwise skip loading them entirely
+        :type addresses: bool
+
+        :return: the query with the loader option applied
+        :rtype: Query
+        """
+        if addresses:
+            return query.options(selectinload(cls.addresses))
+        return query.options(noload(cls.addresses))
+
+    @classmethod
+    @policy.read
+    def serialize_rows(cls, rows, fields: tuple = None, addresses: bool = True) -> list:
+        """ Serializes the rows of a columns() query with their addresses
+
+        The addresses of every Customer on the page are read in one SELECT
+        of plain tuples and grouped by customer in a single pass. When they
+        are not embedded, addresses is None, which is how the API has always
+        rendered a Customer without them. When only some fields are wanted,
+        the addresses are read only if "addresses" is one of them.
+
+        :param rows: the rows selected by a columns() query
+        :type rows: list
+        :param fields: the fields the rows were selected with
+        :type fields: tuple
+        :param addresses: whether to include the addresses of the Customers
+        :type addresses: bool
+
+        :return: a dictionary for each row
+        :rtype: list
+        """
+        keep = fields if fields is None or "id" in fields else fields + ("id",)
+        customers = super().serialize_rows(rows, keep)
+        if fields is not None:
+            addresses = addresses and "addresses" in fields
+        if addresses:
+            embedded = {}
+            for customer in customers:
+                customer["addresses"] = embedded[customer["id"]] = []
+            if embedded:
+                query = Address.columns(Address.query.filter(Address.customer_id.in_(embedded)))
+                for address in Address.serialize_rows(query.order_by(Address.id)):
+                    embedded[address["customer_id"]].append(address)
+        elif fields is None:
+            for customer in customers:
+                customer["addresses"] = None
+        if keep is not fields:
+            for customer in customers:
+                del customer["id"]
+        return customers
+
+    @classmethod
+    def stream(cls, batch_size: int = 500):
+        """ Yields every Customer in id order with its addresses
+
+        The rows are read through a server-side cursor batch_size at a time
+        and the addresses are loaded once per batch, so memory stays bounded
+        no matter how large the table is. Every shard streams its own
+        Customers in id order and the streams are merged into one.
+
+        :param batch_size: the number of Customers fetched per round trip
+        :type batch_size: int
+        """
+        logger.info("Processing stream of all Customers ...")
+        query = cls.embed(cls.query).order_by(cls.id)
+        query = query.execution_options(stream_results=True).yield_per(batch_size)
+        if not shards.enabled:
+            return query
+        return heapq.merge(
+            *(query.execution_options(_sa_shard_id=shard) for shard in shards.ids()), key=attrgetter("id")
+        )
+
+    @classmethod
+    def find_by_filters(cls, updated_since: datetime = None, **filters):
+        """ Returns all Customers matching every one of the given filters
+
+        Any combination of FILTER_FIELDS and ADDRESS_FILTER_FIELDS may be
+        given; the address fields must all match the same address. Filters
+        that are None are ignored.
+
+        :param updated_since: only return the Customers updated after this time,
+            a change to one of their Addresses included
+        :type updated_since: datetime
+
+        :return: a query of the Customers matching all of the filters
+        :rtype: Query
+        """
+        filters = {field: value for field, value in filters.items() if value is not None}
+        logger.info("Processing filter query for %s ...", filters)
+        criterion = cls._compile_filters(frozenset(filters))
+        query = cls.query
+        if criterion is not None:
+            params = {f"filter_{field}": value for field, value in filters.items()}
+            query = query.filter(criterion).params(**params)
+        if updated_since is not None:
+            if updated_since.tzinfo is not None:
+                updated_since = updated_since.astimezone(timezone.utc).replace(tzinfo=None)
+            query = query.filter(cls.updated_at > updated_since)
+        return query
+
+    @classmethod
+    @policy.write
+    def change_status(cls, by_id: int, account_status: str):
+        """ Sets the account_status of a Customer in one conditional UPDATE
+
+        Nothing is read first, so of two concurrent changes to the same status
+        only one succeeds, and a Customer that already has the status is left
+        alone. On Postgres the new columns come back with RETURNING. The
+        change is written to the outbox in the same transaction.
+
+        :param by_id: the ID of the Customer to change
+        :type by_id: int
+        :param account_status: the status to set
+        :type account_status: str
+
+        :return: the SERIALIZED_FIELDS of the updated Customer, or None when there
+            is no such Customer or it already had the status
+        :rtype: Row
+        """
+        logger.info("Setting the status of %s to %s", by_id, account_status)
+        table = cls.__table__
+        columns = [table.c[field] for field in cls.SERIALIZED_FIELDS]
+        statement = table.update().where(
+            table.c.id == by_id, table.c.account_status.is_distinct_from(account_status)
+        ).values(account_status=account_status, version=table.c.version + 1)
+        shard = {"shard_id": shards.shard_of(by_id)}
+        if db.engine.dialect.full_returning:
+            row = db.session.execute(statement.returning(*columns), bind_arguments=shard).first()
+        else:
+            # the UPDATE holds the write lock of SQLite until the commit
+            updated = db.session.execute(statement, bind_arguments=shard).rowcount
+            row = db.session.execute(
+                select(*columns).where(table.c.id == by_id), bind_arguments=shard
+            ).first() if updated else None
+        if row is not None:
+            record = cls.serialize_row(row)
+            ChangeEvent.record(db.session.connection(bind_arguments=shard), [
+                ChangeEvent.describe("customer", by_id, by_id, "updated", record["version"], record)
+            ])
+        db.session.commit()
+        if row is not None:
+            cache.invalidate(cls.cache_key(by_id))
+        return row
+
+    @classmethod
+    @policy.write
+    def bulk_load(cls, customers: list) -> int:
+        """ Inserts validated Customers with their addresses and events in one transaction
+
+        This is the fast path for imports: no ORM flush, and on Postgres the
+        ids are reserved from the sequences in one SELECT and every table is
+        loaded with COPY. Elsewhere the rows go in as multi-row INSERTs. The
+        Customers are given new ids, whatever ids they had before, and are
+        dealt out to the shards in turn.
+
+        :param customers: deserialized Customers that are not in a session
+        :type customers: list
+
+        :return: the number of addresses loaded with the Customers
+        :rtype: int
+        """
+        on_shards = {}
+        for customer in customers:
+            shard = shards.choose() if shards.enabled else None
+            on_shards.setdefault(shard, []).append(customer)
+        updated_at = utcnow()
+        count = 0
+        for shard, customers_of_shard in on_shards.items():
+            count += cls._load_shard(shard, customers_of_shard, updated_at)
+        db.session.commit()
+        logger.info("Loaded %d Customers with %d addresses", len(customers), count)
+        return count
+
+    @classmethod
+    def _load_shard(cls, shard, customers: list, updated_at: datetime) -> int:
+        """ Inserts the rows of Customers, their addresses and events on one shard """
+        connection = db.session.connection(bind_arguments={"shard_id": shard})
+        addresses = [address for customer in customers for address in customer.addresses]
+        customer_ids = _reserve_ids(connection, cls.__table__, len(customers), shard)
+        address_ids = iter(_reserve_ids(connection, Address.__table__, len(addresses), shard))
+        events = []
+        for customer, customer_id in zip(customers, customer_ids):
+            customer.id, customer.updated_at, customer.version = customer_id, updated_at, 1
+            events.append(ChangeEvent.describe(
+                "customer", customer_id, customer_id, "created", 1, customer.serialize(addresses=False)
+            ))
+            for address in customer.addresses:
+                address.id, address.customer_id = next(address_ids), customer_id
+                address.updated_at, address.version = updated_at, 1
+                events.append(ChangeEvent.describe(
+                    "address", address.id, customer_id, "created", 1, address.serialize()
+                ))
+        _load_rows(connection, cls.__table__, [
+            [getattr(customer, column.name) for column in cls.__table__.columns] for customer in customers
+        ])
+        _load_rows(connection, Address.__table__, [
+            [getattr(address, column.name) for column in Address.__table__.columns] for address in addresses
+        ])
+        rows = ChangeEvent.rows(events, updated_at)
+        _load_rows(connection, ChangeEvent.__table__, [list(row.values()) for row in rows], list(rows[0]))
+        return len(addresses)
+
+    @classmethod
+    @policy.write
+    def delete_by_filters(cls, ids: list = None, **filters) -> int:
+        """ Deletes all Customers matching every one of the given filters in one statement
+
+        Takes the same filters as find_by_filters(), optionally narrowed down to
+        a list of ids. The addresses go with their Customers through ON DELETE
+        CASCADE. The deleted ids come back with RETURNING on Postgres, and are
+        selected first on SQLite, to write a deleted event for each Customer
+        to the outbox; the cache is cleared rather than invalidated key by key.
+
+        :param ids: the ids of the Customers to delete, None for any
+        :type ids: list
+
+        :return: the number of Customers deleted
+        :rtype: int
+        """
+        table = cls.__table__
+        criteria = [criterion for criterion in [cls.filter_criterion(**filters)] if criterion is not None]
+        count = 0
+        for shard in shards.ids():
+            shard_criteria = criteria
+            if ids is not None:
+                # a shard only holds the ids that name it
+                shard_ids = [by_id for by_id in ids if shards.shard_of(by_id) == shard]
+                if not shard_ids and shard is not None:
+                    continue
+                shard_criteria = criteria + [table.c.id.in_(shard_ids)]
+            count += cls._delete_on_shard(shard, shard_criteria)
+        db.session.commit()
+        cache.clear()
+        logger.info("Deleted %d Customers", count)
+        return count
+
+    @classmethod
+    def _delete_on_shard(cls, shard, criteria: list) -> int:
+        """ Deletes the Customers matching the criteria on one shard and writes their events """
+        table = cls.__table__
+        statement = table.delete().where(*criteria)
+        bind = {"shard_id": shard}
+        if db.engine.dialect.full_returning:
+            deleted = db.session.execute(statement.returning(table.c.id, table.c.version), bind_arguments=bind).all()
+        else:
+            deleted = db.session.execute(select(table.c.id, table.c.version).where(*criteria), bind_arguments=bind).all()
+            db.session.execute(statement, bind_arguments=bind)
+        ChangeEvent.record(db.session.connection(bind_arguments=bind), [
+            ChangeEvent.describe("customer", by_id, by_id, "deleted", version) for by_id, version in deleted
+        ])
+        return len(deleted)
+
+    @classmethod
+    @policy.write
+    def delete_all(cls):
+        """ Removes every Customer and Address from every shard, with TRUNCATE on Postgres (use for testing) """
+        logger.info("Deleting all Customers")
+        for shard in shards.ids():
+            bind = {"shard_id": shard}
+            if db.engine.dialect.name == "postgresql":
+                db.session.execute(text("TRUNCATE address, customer"), bind_arguments=bind)
+            else:
+                db.session.execute(cls.__table__.delete(), bind_arguments=bind)
+        # one event for the lot, on the first shard
+        ChangeEvent.record(
+            db.session.connection(bind_arguments={"shard_id": shards.ids()[0]}),
+            [ChangeEvent.describe("customer", None, None, "reset")]
+        )
+        db.session.commit()
+        cache.clear()
+
+    @classmethod
+    def filter_criterion(cls, **filters):
+        """ Returns the WHERE criterion of find_by_filters() with the values bound, or None """
+        filters = {field: value for field, value in filters.items() if value is not None}
+        criterion = cls._compile_filters(frozenset(filters))
+        if criterion is None:
+            return None
+        return criterion.params(**{f"filter_{field}": value for field, value in filters.items()})
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def _compile_filters(cls, fields: frozenset):
+        """ Builds the WHERE criterion for a set of filter fields
+
+        The criterion only holds bind parameters, named filter_<field>, so it
+        is built once per combination of fields and reused for every request
+        with that combination whatever the values.
+        """
+        unknown = fields.difference(cls.FILTER_FIELDS, cls.ADDRESS_FILTER_FIELDS)
+        if unknown:
+            raise DataValidationError("Invalid filter: " + ", ".join(sorted(unknown)))
+        criteria = [
+            getattr(cls, field) == bindparam(f"filter_{field}")
+            for field in cls.FILTER_FIELDS if field in fields
+        ]
+        address_criteria = [
+            getattr(Address, field) == bindparam(f"filter_{field}")
+            for field in cls.ADDRESS_FILTER_FIELDS if field in fields
+        ]
+        if address_criteria:
+            criteria.append(cls.addresses.any(and_(*address_criteria)))
+        if not criteria:
+            return None
+        return and_(*criteria)
+
+    @classmethod
     def find_by_name(cls, name: str) -> list:
         """ Returns all Customers with the given last name
 
@@ -334,13 +970,6 @@ class Customer(db.Model, PersistentBase):
         return cls.query.filter(cls.name == name)
 
     @classmethod
-    @retry(
-        HTTPError, 
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
     def find_by_first_name(cls, first_name: str) -> list:
         """ Returns all Customers with the given first name
 
@@ -355,13 +984,6 @@ class Customer(db.Model, PersistentBase):
         return cls.query.filter(cls.first_name == first_name)
 
     @classmethod
-    @retry(
-        HTTPError, 
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
     def find_by_last_name(cls, last_name: str) -> list:
         """ Returns all Customers with the given last name
 
@@ -375,13 +997,6 @@ class Customer(db.Model, PersistentBase):
         return cls.query.filter(cls.last_name == last_name)
 
     @classmethod
-    @retry(
-        HTTPError, 
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
     def find_by_email(cls, email: str) -> list:
         """ Returns all Customers with the given email
 
@@ -395,13 +1010,6 @@ class Customer(db.Model, PersistentBase):
         return cls.query.filter(cls.email == email)
 
     @classmethod
-    @retry(
-        HTTPError, 
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
     def find_by_phone_number(cls, phone_number: str) -> list:
         """ Returns all Customers with the given phone_number
 
@@ -415,30 +1023,313 @@ class Customer(db.Model, PersistentBase):
         return cls.query.filter(cls.phone_number == phone_number)
 
     @classmethod
-    @retry(
-        HTTPError, 
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
     def find_by_street(cls, street: str) -> list:
         """ Returns all Customers with the given addess
         """
         logger.info("Processing street address query for %s ...", street)
-        q = cls.query.outerjoin(cls.addresses).filter(Address.street == street)
-        return q.all()
+        return cls.query.filter(cls.addresses.any(Address.street == street))
     
     @classmethod
-    @retry(
-        HTTPError, 
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
     def find_by_postalcode(cls, postalcode: str) -> list:
         """ Returns all customers with an address in the given zip code """
         logger.info("Processing postal code query for %s ...", postalcode)
-        q = cls.query.outerjoin(cls.addresses).filter(Address.postalcode == postalcode)
-        return q.all()
+        return cls.query.filter(cls.addresses.any(Address.postalcode == postalcode))
+
+######################################################################
+#  C H A N G E   E V E N T   M O D E L
+######################################################################
+class ChangeEvent(db.Model):
+    """
+    Class that represents one change to a Customer or an Address in the outbox
+
+    Every event is written in the transaction of the change it records, so
+    the outbox holds exactly the committed changes, in the order of its ids.
+    """
+    __tablename__ = "outbox"
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(16), nullable=False)  # customer or address
+    entity_id = db.Column(db.Integer, nullable=True)  # None when every Customer was deleted
+    customer_id = db.Column(db.Integer, nullable=True)
+    operation = db.Column(db.String(16), nullable=False)  # created, updated, deleted or reset
+    version = db.Column(db.Integer, nullable=True)
+    payload = db.Column(db.Text, nullable=True)  # the record after the change, in JSON
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+    def __repr__(self):
+        return "<ChangeEvent %s %s id=[%s]>" % (self.operation, self.entity, self.entity_id)
+
+    def serialize(self) -> dict:
+        """ Serializes a ChangeEvent into a dictionary """
+        return {
+            "id": self.id,
+            "entity": self.entity,
+            "entity_id": self.entity_id,
+            "customer_id": self.customer_id,
+            "operation": self.operation,
+            "version": self.version,
+            "record": json.loads(self.payload) if self.payload else None,
+            "created_at": format_timestamp(self.created_at),
+        }
+
+    @staticmethod
+    def describe(entity: str, entity_id: int, customer_id: int, operation: str,
+                 version: int = None, record: dict = None) -> dict:
+        """ Returns the columns of the event of one change """
+        return {
+            "entity": entity,
+            "entity_id": entity_id,
+            "customer_id": customer_id,
+            "operation": operation,
+            "version": version,
+            "payload": json.dumps(record) if record is not None else None,
+        }
+
+    @classmethod
+    def record(cls, connection, events: list):
+        """ Writes events, as returned by describe(), in the transaction of the connection
+
+        :param connection: the connection the change was made on
+        :type connection: Connection
+        :param events: the columns of each event
+        :type events: list
+        """
+        if events:
+            connection.execute(cls.__table__.insert(), cls.rows(events, utcnow()))
+
+    @classmethod
+    def rows(cls, events: list, created_at: datetime) -> list:
+        """ Returns the rows of the outbox for events, with ids that order them across the shards when sharded """
+        rows = [dict(event, created_at=created_at) for event in events]
+        if shards.enabled:
+            for row, event_id in zip(rows, _outbox_ids.reserve(len(rows))):
+                row["id"] = event_id
+        return rows
+
+    @classmethod
+    @policy.read
+    def after(cls, after_id: int, limit: int, gap_timeout: float = 10) -> list:
+        """ Returns the events that follow an event, in the order they were written
+
+        An id is taken when an event is written, not when it is committed, so
+        an event can become visible while the transaction of an earlier one is
+        still running, on the same shard or on another. The events stop before such a gap until the event after
+        it is gap_timeout seconds old, when the gap is taken to be a rollback.
+
+        :param after_id: the id of the last event already seen, 0 for the first
+        :type after_id: int
+        :param limit: the maximum number of events to return
+        :type limit: int
+        :param gap_timeout: the seconds to wait for a missing id to be committed
+        :type gap_timeout: float
+
+        :return: the events after after_id
+        :rtype: list
+        """
+        events = cls.query.filter(cls.id > after_id).order_by(cls.id).limit(limit).all()
+        settled = utcnow() - timedelta(seconds=gap_timeout)
+        expected = after_id + 1
+        for position, change in enumerate(events):
+            if change.id != expected and change.created_at > settled:
+                return events[:position]
+            expected = change.id + 1
+        return events
+
+    @classmethod
+    @policy.write
+    def prune(cls, before: datetime) -> int:
+        """ Deletes the events written before a time
+
+        :param before: the time to keep the events from
+        :type before: datetime
+
+        :return: the number of events deleted
+        :rtype: int
+        """
+        count = cls.query.filter(cls.created_at < before).delete(synchronize_session=False)
+        db.session.commit()
+        logger.info("Pruned %d events from the outbox", count)
+        return count
+
+
+class OutboxIds():
+    """ Hands out the ids that order the events of every shard as one outbox
+
+    Every shard keeps the events of its changes in its own outbox, in the
+    transaction of the change, but the ids come from one sequence so the
+    changes can be read back in the order they were made. On Postgres it is
+    the outbox sequence of shard 0. SQLite has no sequence, so the ids are
+    counted on from the largest id of any shard, which is only safe with a
+    single process writing, as when trying the shards out locally.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = None
+
+    def reset(self):
+        """ Forgets the count, for the shards of a new app """
+        with self._lock:
+            self._next = None
+
+    def reserve(self, count: int) -> list:
+        """ Takes count new ids for the outbox of any shard """
+        table = ChangeEvent.__table__
+        connection = db.session.connection(bind_arguments={"shard_id": 0})
+        if connection.dialect.name == "postgresql":
+            return _reserve_ids(connection, table, count)
+        with self._lock:
+            if self._next is None:
+                self._next = max(
+                    _reserve_ids(db.session.connection(bind_arguments={"shard_id": shard}), table, 1)[0]
+                    for shard in shards.ids()
+                )
+            start, self._next = self._next, self._next + count
+        return list(range(start, start + count))
+
+
+_outbox_ids = OutboxIds()
+
+
+@event.listens_for(db.session, "before_flush")
+def assign_shards(session, flush_context, instances):
+    """ Gives the new Customers ids on the next shard, and their new Addresses ids on the same one """
+    if not shards.enabled:
+        return
+    customers = [record for record in session.new if isinstance(record, Customer) and record.id is None]
+    _assign_ids(session, Customer, [(shards.choose(), customer) for customer in customers])
+    addresses = []
+    for record in session.new:
+        if isinstance(record, Address) and record.id is None:
+            # an Address added to a Customer only gets its customer_id in the flush
+            customer_id = record.customer_id if record.customer_id is not None else getattr(record.customer, "id", None)
+            if customer_id is not None:
+                addresses.append((shards.shard_of(customer_id), record))
+    _assign_ids(session, Address, addresses)
+
+
+def _assign_ids(session, model, records: list):
+    """ Sets the ids of the (shard, record) pairs from the sequences of their shards """
+    on_shards = {}
+    for shard, record in records:
+        on_shards.setdefault(shard, []).append(record)
+    for shard, records_of_shard in on_shards.items():
+        connection = session.connection(bind_arguments={"shard_id": shard})
+        record_ids = _reserve_ids(connection, model.__table__, len(records_of_shard), shard)
+        for record, record_id in zip(records_of_shard, record_ids):
+            record.id = record_id
+
+
+@event.listens_for(db.session, "after_flush")
+def touch_customers(session, flush_context):
+    """ Moves updated_at of the Customers whose Addresses a flush changed, when it left them alone
+
+    Every GET of a Customer embeds its Addresses, so ?updated_since= has to
+    list it again after one of them changed. Its version stays, that counts
+    the updates of the Customer itself.
+    """
+    changed = {record.id for record in session.new if isinstance(record, Customer)}
+    changed.update(record.id for record in session.deleted if isinstance(record, Customer))
+    changed.update(
+        record.id for record in session.dirty
+        if isinstance(record, Customer) and session.is_modified(record, include_collections=False)
+    )
+    touched = {}
+    for records in (session.new, session.dirty, session.deleted):
+        for record in records:
+            if not isinstance(record, Address) or record.customer_id is None or record.customer_id in changed:
+                continue
+            if records is session.dirty and not session.is_modified(record, include_collections=False):
+                continue
+            touched.setdefault(shards.shard_of(record.customer_id), set()).add(record.customer_id)
+    table = Customer.__table__
+    for shard, customer_ids in touched.items():
+        session.connection(bind_arguments={"shard_id": shard}).execute(
+            table.update().where(table.c.id.in_(sorted(customer_ids))).values(updated_at=utcnow())
+        )
+
+
+@event.listens_for(db.session, "after_flush")
+def record_changes(session, flush_context):
+    """ Writes an event to the outbox of its shard for every Customer and Address a flush changed """
+    on_shards = {}
+    for operation, records in (("created", session.new), ("updated", session.dirty), ("deleted", session.deleted)):
+        for record in records:
+            if isinstance(record, Customer):
+                customer_id, serialized = record.id, record.serialize(addresses=False)
+            elif isinstance(record, Address):
+                customer_id, serialized = record.customer_id, record.serialize()
+            else:
+                continue
+            if operation == "updated" and not session.is_modified(record, include_collections=False):
+                continue
+            on_shards.setdefault(shards.shard_of(record.id), []).append(ChangeEvent.describe(
+                record.__tablename__, record.id, customer_id, operation, record.version,
+                serialized if operation != "deleted" else None
+            ))
+    for shard, events in on_shards.items():
+        ChangeEvent.record(
+            session.connection(bind_arguments={"shard_id": shard}),
+            sorted(events, key=lambda change: (change["entity"] != "customer", change["entity_id"]))
+        )
+
+
+######################################################################
+#  B U L K   L O A D I N G
+######################################################################
+def _reserve_ids(connection, table, count: int, shard: int = None) -> list:
+    """ Takes count new primary keys of a table for rows that are inserted with them
+
+    On a shard the values of its sequence are spaced shards.count apart and
+    offset by the shard, so every id names the shard it was taken on.
+    """
+    if not count:
+        return []
+    spacing, offset = (shards.count, shard) if shard is not None else (1, 0)
+    if connection.dialect.name == "postgresql":
+        rows = connection.execute(
+            text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+            {"table": table.name, "count": count},
+        )
+        return [row[0] * spacing + offset for row in rows]
+    # SQLite hands out max(id) + 1, a concurrent writer makes the insert fail rather than collide
+    start = connection.execute(select(db.func.coalesce(db.func.max(table.c.id), 0))).scalar() // spacing + 1
+    return [(start + number) * spacing + offset for number in range(count)]
+
+
+# the characters the text format of COPY needs escaped
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+COPY_SPECIAL = re.compile(r"[\\\t\n\r]")
+
+
+def _copy_value(value) -> str:
+    """ Returns a value in the text format of COPY """
+    if value is None:
+        return "\\N"
+    text = value if isinstance(value, str) else str(value)
+    if COPY_SPECIAL.search(text):
+        return text.translate(COPY_ESCAPES)
+    return text
+
+
+def _load_rows(connection, table, rows: list, columns: list = None):
+    """ Inserts rows of the given columns, all of them by default, with COPY on Postgres """
+    if not rows:
+        return
+    columns = columns or [column.name for column in table.columns]
+    if connection.dialect.name == "postgresql":
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join(_copy_value(value) for value in row) + "\n")
+        buffer.seek(0)
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN", buffer)
+        return
+    # stay under the 999 bound parameters older SQLite builds allow per statement
+    per_statement = max(1, 999 // len(columns))
+    for start in range(0, len(rows), per_statement):
+        values = [dict(zip(columns, row)) for row in rows[start:start + per_statement]]
+        connection.execute(table.insert().values(values))
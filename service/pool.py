@@ -0,0 +1,148 @@
+"""
+Module: pool
+Instrumented connection pool for the database engine
+
+The pool is sized from SQLALCHEMY_ENGINE_OPTIONS in config.py, which is
+driven by the DB_POOL_* environment variables. Every worker process has its
+own pool, so size it so that workers * (pool_size + max_overflow) stays
+below the max_connections of Postgres.
+
+InstrumentedQueuePool keeps counters of how often and how long requests had
+to wait for a connection, which pool_status() reports together with the
+current state of the pool.
+
+warm_up() opens the connections of a new pool on a background thread, so a
+worker can start serving while they connect and its first requests do not
+pay for the connection setup.
+"""
+import os
+import time
+import logging
+import threading
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger("flask.app")
+
+# options only a QueuePool understands, SQLite runs without one
+QUEUE_POOL_OPTIONS = ("pool_size", "max_overflow", "pool_timeout")
+
+
+class PoolStats():
+    """ Counters of the connection checkouts of one pool """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def record(self, wait_time: float, timed_out: bool = False):
+        """ Records one checkout that waited wait_time seconds """
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+
+    def serialize(self) -> dict:
+        """ Returns the counters as a dictionary """
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_time_total": round(self.wait_time_total, 6),
+                "wait_time_max": round(self.wait_time_max, 6),
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ QueuePool that times how long each checkout waits for a connection """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - start)
+        return connection
+
+
+def enable_foreign_keys(dbapi_connection, connection_record):
+    """ Makes SQLite enforce foreign keys, and so cascade deletes, on a new connection """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+class InstrumentedSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy extension that builds its engines on InstrumentedQueuePool """
+
+    def create_engine(self, sa_url, engine_opts):
+        engine_opts = dict(engine_opts)
+        if sa_url.drivername.startswith("sqlite"):
+            for name in QUEUE_POOL_OPTIONS:
+                engine_opts.pop(name, None)
+            engine = super().create_engine(sa_url, engine_opts)
+            event.listen(engine, "connect", enable_foreign_keys)
+            return engine
+        engine_opts.setdefault("poolclass", InstrumentedQueuePool)
+        return super().create_engine(sa_url, engine_opts)
+
+
+def pool_status(engine) -> dict:
+    """ Returns the state and counters of the connection pool of an engine """
+    pool = engine.pool
+    status = {"pid": os.getpid(), "pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+        )
+    if isinstance(pool, InstrumentedQueuePool):
+        status.update(pool.stats.serialize())
+    return status
+
+
+def warm_up(engine) -> threading.Thread:
+    """ Fills the connection pool of an engine on a background thread
+
+    :param engine: the engine whose pool to fill
+    :type engine: Engine
+
+    :return: the thread, which is already running
+    :rtype: Thread
+
+    """
+    def connect():
+        size = engine.pool.size() if isinstance(engine.pool, QueuePool) else 1
+        start = time.perf_counter()
+        connections = []
+        try:
+            # hold them all at once, so the pool has to open as many as it keeps
+            for _ in range(size):
+                connections.append(engine.connect())
+        except exc.SQLAlchemyError as error:
+            logger.warning("Could not warm up the connection pool: %s", error)
+        finally:
+            for connection in connections:
+                connection.close()
+        logger.info(
+            "Opened %d database connection(s) in %.3fs", len(connections), time.perf_counter() - start
+        )
+
+    thread = threading.Thread(target=connect, name="pool-warm-up", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,243 @@
+"""
+Module: replicas
+Routes the reads of GET requests to read replicas
+
+Every URI in DATABASE_REPLICA_URIS gets an engine and a pool of its own. A
+view decorated with router.read has its session pinned to the next healthy
+replica in round-robin, and everything else, writes included, keeps going to
+SQLALCHEMY_DATABASE_URI, the primary.
+
+A background thread checks every replica each REPLICA_CHECK_INTERVAL
+seconds. A replica that cannot be reached, or that replays more than
+REPLICA_MAX_LAG seconds behind the primary, is skipped until a check passes
+again, and a replica whose connection fails during a request is skipped at
+once so the retry of the read goes elsewhere. With no healthy replica the
+reads go to the primary.
+
+Read-your-writes: a successful write stamps the Flask session cookie of the
+client, and the reads of that client stay on the primary, bypassing the
+cache, for REPLICA_MAX_LAG + REPLICA_CHECK_INTERVAL + CACHE_TTL seconds after
+it, which outlasts anything a lagging replica can have cached meanwhile.
+Clients that do not send the cookie back, such as curl or other services,
+get no such guarantee and may read a replica that has not caught up yet.
+
+Only reads from the primary, or from a replica whose last check found it
+caught up, fill the cache, so a lagging replica never caches a record as it
+was before a write for the other clients.
+"""
+import os
+import time
+import logging
+import threading
+from functools import wraps
+from flask import request, session as client_session
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, exc, orm, text
+from sqlalchemy.engine.url import make_url
+from service.pool import InstrumentedSQLAlchemy, pool_status
+
+logger = logging.getLogger("flask.app")
+
+# seconds the standby replays behind the primary, 0 when it is caught up or not a standby
+POSTGRES_LAG = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class Replica():
+    """ One read replica and what its last check found """
+
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.engine = engine
+        self.healthy = False
+        self.lag = None
+        self.checked_at = None
+        self.error = None
+        self.reads = 0
+
+    def check(self, max_lag: float):
+        """ Connects to the replica and measures its lag """
+        try:
+            with self.engine.connect() as connection:
+                if connection.dialect.name == "postgresql":
+                    self.lag = float(connection.execute(POSTGRES_LAG).scalar() or 0)
+                else:
+                    connection.execute(text("SELECT 1"))
+                    self.lag = 0.0
+        except exc.SQLAlchemyError as error:
+            self.mark_down(error)
+        else:
+            if self.lag > max_lag:
+                self.mark_down(f"replaying {self.lag:.1f}s behind")
+            else:
+                if not self.healthy:
+                    logger.info("Read replica %s is available", self.name)
+                self.healthy, self.error = True, None
+        self.checked_at = time.time()
+
+    def mark_down(self, error):
+        """ Skips the replica until a check passes again """
+        if self.healthy:
+            logger.warning("Read replica %s is unavailable: %s", self.name, error)
+        self.healthy, self.error = False, str(error)
+
+    def serialize(self) -> dict:
+        """ Returns the state of the replica as a dictionary """
+        return {
+            "name": self.name,
+            "healthy": self.healthy,
+            "lag": self.lag,
+            "checked_at": self.checked_at,
+            "error": self.error,
+            "reads": self.reads,
+            "pool": pool_status(self.engine),
+        }
+
+
+class ReplicaRouter():
+    """ Hands out the healthy read replicas in turn """
+
+    def __init__(self):
+        self.replicas = []
+        self.check_interval = 5.0
+        self.max_lag = 5.0
+        self.cache_ttl = 30.0
+        self.db = None
+        self._next = 0
+        self._lock = threading.Lock()
+        self._checker_pid = None
+        self._stop = threading.Event()
+        self._registered = False
+
+    @property
+    def sticky_seconds(self) -> float:
+        """ How long a client reads from the primary after a write, until no stale entry can be cached """
+        return self.max_lag + self.check_interval + self.cache_ttl
+
+    def init_app(self, app, db):
+        """ Creates an engine for every replica of the app, replacing any from before """
+        self.close()
+        self.db = db
+        self.check_interval = app.config["REPLICA_CHECK_INTERVAL"]
+        self.max_lag = app.config["REPLICA_MAX_LAG"]
+        self.cache_ttl = app.config["CACHE_TTL"] if app.config.get("CACHE_BACKEND") != "none" else 0
+        options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+        self.replicas = []
+        for number, uri in enumerate(app.config["DATABASE_REPLICA_URIS"]):
+            url = make_url(uri)
+            replica = Replica(f"replica{number}:{url.host or url.database}", db.create_engine(url, options))
+            event.listen(replica.engine, "handle_error", self._on_error(replica))
+            self.replicas.append(replica)
+        if not self._registered:
+            app.after_request(self.remember_write)
+            self._registered = True
+
+    def close(self):
+        """ Stops the checks and closes the connections of every replica """
+        self._stop.set()
+        for replica in self.replicas:
+            replica.engine.dispose()
+        self.replicas = []
+        self._checker_pid = None
+        self._stop = threading.Event()
+
+    def check(self):
+        """ Checks every replica once """
+        for replica in self.replicas:
+            replica.check(self.max_lag)
+
+    def choose(self):
+        """ Returns the next healthy replica, or None to read from the primary """
+        self._start_checker()
+        with self._lock:
+            for _ in range(len(self.replicas)):
+                replica = self.replicas[self._next % len(self.replicas)]
+                self._next += 1
+                if replica.healthy:
+                    replica.reads += 1
+                    return replica
+        return None
+
+    def route(self, session):
+        """ Pins the session of a read-only request to a replica, unless its client just wrote """
+        if not self.replicas:
+            return
+        if client_session.get("primary_until", 0) > time.time():
+            session.info["primary"] = True
+            return
+        session.info["replica"] = self.choose()
+
+    def read(self, function):
+        """ Decorator for views that only read, so they can be served by a replica """
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            self.route(self.db.session())
+            return function(*args, **kwargs)
+        return wrapper
+
+    def cacheable(self, session) -> bool:
+        """ Returns whether the reads of a session may fill the cache, which is not so on a lagging replica """
+        replica = session.info.get("replica")
+        return replica is None or replica.lag == 0
+
+    def remember_write(self, response):
+        """ Keeps the client that made a successful write on the primary for a while """
+        if self.replicas and request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+            client_session["primary_until"] = time.time() + self.sticky_seconds
+        return response
+
+    def status(self) -> list:
+        """ Returns the state of every replica """
+        return [replica.serialize() for replica in self.replicas]
+
+    def _on_error(self, replica):
+        """ Returns a handle_error listener that skips the replica when it cannot be reached """
+        def handle_error(context):
+            if context.is_disconnect or isinstance(context.sqlalchemy_exception, exc.OperationalError):
+                replica.mark_down(context.original_exception)
+        return handle_error
+
+    def _start_checker(self):
+        """ Starts the thread that checks the replicas, once in every worker process """
+        if self._checker_pid == os.getpid() or not self.replicas:
+            return
+        with self._lock:
+            if self._checker_pid == os.getpid():
+                return
+            self._checker_pid = os.getpid()
+            stop = self._stop
+
+            def run():
+                while True:
+                    self.check()
+                    if stop.wait(self.check_interval):
+                        return
+
+            threading.Thread(target=run, name="replica-check", daemon=True).start()
+
+
+class RoutingSession(SignallingSession):
+    """ Session that reads from the replica its request was pinned to """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        # with one database the shard_id of shards.ids() is None, there is only the primary to bind
+        replica = self.info.get("replica")
+        if replica is not None and not self._flushing:
+            if not replica.healthy:
+                # the replica went away during the request, so retries go elsewhere
+                replica = self.info["replica"] = router.choose()
+            if replica is not None:
+                return replica.engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(InstrumentedSQLAlchemy):
+    """ SQLAlchemy extension whose sessions can be routed to a read replica """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+router = ReplicaRouter()
@@ -0,0 +1,213 @@
+"""
+Module: resilience
+Retry budget and circuit breaker for database calls
+
+Reads that fail with a transient OperationalError (a dropped connection, a
+failover, a deadlock) are retried with exponential backoff, but only while
+the request is inside its RETRY_DEADLINE, so a Postgres brownout can never
+stall a request for longer than that. Any other OperationalError, such as a
+statement timeout or a full disk, would fail the same way again and is
+raised at once. Writes are never retried because the failed transaction has
+already been rolled back.
+
+Every call that fails, after all of its retries, counts once against a
+circuit breaker. After BREAKER_FAILURES failed calls in a row the breaker opens and database calls fail fast with
+DatabaseConnectionError, which the API turns into 503 Service Unavailable,
+until BREAKER_RESET seconds have passed and one trial call is let through.
+"""
+import time
+import logging
+import threading
+from functools import wraps
+from flask import g, has_request_context
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+
+logger = logging.getLogger("flask.app")
+
+
+# serialization failure, deadlock, and the server shutting down or restarting
+TRANSIENT_PGCODES = {"40001", "40P01", "57P01", "57P02", "57P03"}
+
+
+class DatabaseConnectionError(Exception):
+    """ Custom exception when database connection fails"""
+
+
+def is_transient(error: OperationalError) -> bool:
+    """ Returns whether the same call may well work when it is tried again """
+    return error.connection_invalidated or getattr(error.orig, "pgcode", None) in TRANSIENT_PGCODES
+
+
+######################################################################
+#  C I R C U I T   B R E A K E R
+######################################################################
+class CircuitBreaker():
+    """ Stops calling the database after too many failures in a row """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """ The current state of the breaker """
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def before_call(self):
+        """ Raises DatabaseConnectionError unless a call may go through """
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+        raise DatabaseConnectionError("Database unavailable: circuit breaker is open")
+
+    def record_success(self):
+        """ Closes the breaker after a call that worked """
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        """ Counts a failed call, opening the breaker once there are too many """
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.critical("Opening the database circuit breaker after %d failures", self.failures)
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """ Lets another trial call through without counting this one """
+        with self._lock:
+            self._trial_running = False
+
+    def retry_after(self) -> int:
+        """ Returns the seconds until the breaker lets a trial call through """
+        if self.opened_at is None:
+            return 0
+        return max(int(self.reset_timeout - (time.monotonic() - self.opened_at)) + 1, 1)
+
+
+######################################################################
+#  D A T A B A S E   P O L I C Y
+######################################################################
+class DatabasePolicy():
+    """ Decorators that apply the retry budget and circuit breaker """
+
+    def __init__(self):
+        self.retry_count = 3
+        self.retry_delay = 0.1
+        self.retry_backoff = 2.0
+        self.retry_deadline = 5.0
+        self.breaker = CircuitBreaker()
+        self.session = None
+
+    def init_app(self, app, session):
+        """ Reads the policy from the configuration of the Flask app """
+        self.retry_count = app.config.get("RETRY_COUNT", self.retry_count)
+        self.retry_delay = app.config.get("RETRY_DELAY", self.retry_delay)
+        self.retry_backoff = app.config.get("RETRY_BACKOFF", self.retry_backoff)
+        self.retry_deadline = app.config.get("RETRY_DEADLINE", self.retry_deadline)
+        self.breaker = CircuitBreaker(
+            app.config.get("BREAKER_FAILURES", 5), app.config.get("BREAKER_RESET", 30)
+        )
+        self.session = session
+
+    def deadline(self) -> float:
+        """ Returns the time.perf_counter() after which no retry may start """
+        if has_request_context() and "request_start_time" in g:
+            return g.request_start_time + self.retry_deadline
+        return time.perf_counter() + self.retry_deadline
+
+    def read(self, function):
+        """ Retries transient errors of a read within the deadline of the request """
+        @wraps(function)
+        def attempts(*args, **kwargs):
+            deadline = self.deadline()
+            delay = self.retry_delay
+            attempt = 1
+            while True:
+                try:
+                    return function(*args, **kwargs)
+                except OperationalError as error:
+                    if not is_transient(error):
+                        raise
+                    if attempt >= self.retry_count or time.perf_counter() + delay > deadline:
+                        raise
+                    self._rollback(error)
+                    logger.warning("Retrying %s in %.2fs: %s", function.__qualname__, delay, error.orig)
+                    time.sleep(delay)
+                    delay *= self.retry_backoff
+                    attempt += 1
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                return self._call(attempts, *args, **kwargs)
+            except OperationalError as error:
+                raise DatabaseConnectionError(f"Database unavailable: {error.orig}") from error
+        return wrapper
+
+    def write(self, function):
+        """ Fails a write fast when the breaker is open, without retrying it """
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                return self._call(function, *args, **kwargs)
+            except OperationalError as error:
+                raise DatabaseConnectionError(f"Database unavailable: {error.orig}") from error
+        return wrapper
+
+    def _call(self, function, *args, **kwargs):
+        """ Calls function through the breaker, re-raising a transient error after counting it """
+        self.breaker.before_call()
+        counted = False
+        try:
+            result = function(*args, **kwargs)
+            self.breaker.record_success()
+            counted = True
+            return result
+        except OperationalError as error:
+            self._rollback(error)
+            self.breaker.record_failure()
+            counted = True
+            raise
+        except PoolTimeoutError as error:
+            # every connection is busy, which says nothing about the database itself
+            raise DatabaseConnectionError(f"Database unavailable: {error}") from error
+        except Exception:
+            # the database answered, the call failed for some other reason
+            self.breaker.record_success()
+            counted = True
+            raise
+        finally:
+            # a pool timeout, or a gevent Timeout or GreenletExit, must not keep the trial call forever
+            if not counted:
+                self.breaker.release()
+
+    def _rollback(self, error):
+        """ Logs a transient error and rolls the session back """
+        logger.error("Database error: %s", error.orig)
+        if self.session is not None:
+            self.session.rollback()
+
+
+# The policy used by the models, configured later in init_db()
+policy = DatabasePolicy()
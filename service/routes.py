@@ -16,11 +16,17 @@
 Customer Service
 Paths:
 ------
-GET /customers - Returns a list all of the Customers
+GET /customers - Returns a page of the Customers (see limit and cursor below)
+GET /customers/export - Streams all of the Customers as NDJSON or CSV
+GET /customers/changes - Returns the changes to Customers and Addresses after ?after=
+GET /customers/changes/stream - Streams the changes as Server-Sent Events
 GET /customers/{id} - Returns the Customer with a given id number
 POST /customers - creates a new Customer record in the database
+POST /customers:batch - creates many Customer records in one transaction
 PUT /customers/{id} - updates a Customer record in the database
 DELETE /customers/{id} - deletes a Customer record in the database
+DELETE /customers?id=1,2&... - deletes the Customers matching the ids and filters
+DELETE /customers - deletes every Customer when ALLOW_DELETE_ALL is set
 GET /customers/{id}/addresses - Returns a list of all the addresses for a customer
 POST /customers/{id}/addresses - Add an address to a customer
 GET /customers/{id}/addresses/{id} - Get a specific address for a given customer
@@ -30,11 +36,52 @@ Actions:
 --------
 PUT /customers/{id}/suspend - suspend a customer account
 PUT /customers/{id}/restore - restore a suspended customer account
+Paging:
+-------
+The list endpoints return at most ?limit= records ordered by id. When more
+records exist a Link header with rel="next" holds the URL of the next page,
+which carries an opaque ?cursor= that must be passed back unchanged.
+Projection:
+-----------
+Every GET of Customers or Addresses takes ?fields=, a comma separated list
+of the fields to return, e.g. ?fields=id,email,account_status. Only those
+columns are read and the addresses of a Customer are only loaded when
+addresses is one of the fields.
+Caching:
+--------
+GET /customers/{id} and GET /customers/{id}/addresses/{id} return an ETag.
+Sending it back in If-None-Match returns 304 Not Modified with no body while
+the record is unchanged. Identical GETs that run at the same time in a
+worker share one query, see GET /stats/coalescing.
+Changes:
+--------
+Every Customer and Address has an updated_at time and a version that each
+update increments. GET /customers?updated_since= returns only the Customers
+updated after a time, and every change is written to an outbox in the same
+transaction, which GET /customers/changes pages through by event id and
+GET /customers/changes/stream follows live.
+Replicas:
+---------
+The GETs of Customers and Addresses, and the export, read from the replicas
+in DATABASE_REPLICA_URIS when there are any, except for a client that made a
+write in the last few seconds, which keeps reading from the primary.
 """
-from flask import Flask, jsonify, request, url_for, make_response, abort
+import json
+import base64
+import hashlib
+import binascii
+import orjson
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, stream_with_context
 from flask_restx import Api, Resource, fields, reqparse, inputs
-from service.models import Customer, Address, DataValidationError, DatabaseConnectionError
-from . import app, status 
+from werkzeug.http import quote_etag
+from sqlalchemy.orm.exc import StaleDataError
+from service.models import Customer, Address, ChangeEvent, DataValidationError, DatabaseConnectionError, db
+from service.cache import cache
+from service.pool import pool_status
+from service.replicas import router
+from service.resilience import policy
+from service.singleflight import flights
+from . import app, status, export, changes, metrics, compression
 
 ######################################################################
 # Configure the Root route before OpenAPI
@@ -42,14 +89,55 @@ from . import app, status
 @app.route("/")
 def index():
     """Base URL for our service"""
-    return app.send_static_file("index.html")
+    return compression.assets.send("index.html")
 
 ######################################################################
 # CREATE PAGE FOR ADDRESS UI
 ######################################################################
 @app.route("/address")
 def address():
-    return app.send_static_file("address.html")
+    return compression.assets.send("address.html")
+
+######################################################################
+# CACHE STATISTICS
+######################################################################
+@app.route("/stats/cache")
+def cache_stats():
+    """Returns the counters of the read-through cache of this worker"""
+    return jsonify(cache.stats()), status.HTTP_200_OK
+
+######################################################################
+# READ COALESCING STATISTICS
+######################################################################
+@app.route("/stats/coalescing")
+def coalescing_stats():
+    """Returns the counters of the reads coalesced by this worker"""
+    return jsonify(flights.stats()), status.HTTP_200_OK
+
+######################################################################
+# CONNECTION POOL STATISTICS
+######################################################################
+@app.route("/stats/pool")
+def pool_stats():
+    """Returns the state and counters of the connection pool of this worker"""
+    return jsonify(pool_status(db.engine)), status.HTTP_200_OK
+
+######################################################################
+# READ REPLICA STATUS
+######################################################################
+@app.route("/stats/replicas")
+def replica_stats():
+    """Returns the health, lag and pool of every read replica of this worker"""
+    return jsonify(router.status()), status.HTTP_200_OK
+
+######################################################################
+# PROMETHEUS METRICS
+######################################################################
+@app.route("/metrics")
+def prometheus_metrics():
+    """Returns the request metrics of all workers for Prometheus to scrape"""
+    body, content_type = metrics.render()
+    return body, status.HTTP_200_OK, {"Content-Type": content_type}
 
 ######################################################################
 # Configure Swagger before initializing it
@@ -75,7 +163,9 @@ create_model = api.model('Customer', {
 
 customer_model = api.inherit('CustomerModel', create_model, {
     'id': fields.Integer(readOnly=True, description='The unique id assigned internally by service'),
-    'addresses': fields.List(cls_or_instance=fields.Raw, description='collection of all addresses associated with the Customer')
+    'addresses': fields.List(cls_or_instance=fields.Raw, description='collection of all addresses associated with the Customer'),
+    'updated_at': fields.String(readOnly=True, description='When the Customer was last changed, in UTC'),
+    'version': fields.Integer(readOnly=True, description='The number of times the Customer was saved')
 })
 
 create_address_model = api.model('Address', {
@@ -88,7 +178,9 @@ create_address_model = api.model('Address', {
 })
 
 address_model = api.inherit('AddressModel', create_address_model, {
-    'id': fields.Integer(readOnly=True, description='The unique id assigned internally by service')
+    'id': fields.Integer(readOnly=True, description='The unique id assigned internally by service'),
+    'updated_at': fields.String(readOnly=True, description='When the Address was last changed, in UTC'),
+    'version': fields.Integer(readOnly=True, description='The number of times the Address was saved')
 })
 
 ######################################################################
@@ -102,6 +194,42 @@ customer_args.add_argument('email', type=str, location='args', required=False, h
 customer_args.add_argument('phone_number', type=str, location='args', required=False, help='List Customer by Phone Number')
 customer_args.add_argument('postalcode', type=str, location='args', required=False, help='List Customer by Postal Code')
 customer_args.add_argument('street', type=str, location='args', required=False, help='List Customer by Street Address')
+customer_args.add_argument('city', type=str, location='args', required=False, help='List Customer by City')
+customer_args.add_argument('state', type=str, location='args', required=False, help='List Customer by State')
+customer_args.add_argument('account_status', type=str, location='args', required=False, help='List Customer by Account Status')
+customer_args.add_argument('embed', type=str, location='args', required=False, default='addresses', choices=('addresses', 'none'), help='Use none to leave out the addresses of each Customer')
+customer_args.add_argument('limit', type=inputs.int_range(1, app.config['MAX_PAGE_SIZE']), location='args', required=False, help='Maximum number of Customers to return')
+customer_args.add_argument('cursor', type=str, location='args', required=False, help='Cursor of the page to return, taken from the Link header')
+customer_args.add_argument('fields', type=str, location='args', required=False, help='Comma separated fields of each Customer to return: ' + ', '.join(Customer.FIELDS))
+customer_args.add_argument('updated_since', type=inputs.datetime_from_iso8601, location='args', required=False, help='Only list the Customers updated after this ISO 8601 time')
+
+customer_fields_args = reqparse.RequestParser()
+customer_fields_args.add_argument('fields', type=str, location='args', required=False, help='Comma separated fields of the Customer to return: ' + ', '.join(Customer.FIELDS))
+
+def id_list(value: str) -> list:
+    """ Parses a comma separated list of ids """
+    return [int(part) for part in value.split(",") if part.strip()]
+
+# the filters of the list, without its paging and projection, and a list of ids
+delete_args = customer_args.copy()
+for argument in ('embed', 'limit', 'cursor', 'fields', 'updated_since'):
+    delete_args.remove_argument(argument)
+delete_args.add_argument('id', type=id_list, location='args', required=False, help='Comma separated ids of the Customers to delete')
+
+export_args = reqparse.RequestParser()
+export_args.add_argument('format', type=str, location='args', required=False, default='ndjson', choices=tuple(export.FORMATS), help='Format of the export')
+
+changes_args = reqparse.RequestParser()
+changes_args.add_argument('after', type=inputs.natural, location='args', required=False, default=0, help='Id of the last change already seen')
+changes_args.add_argument('limit', type=inputs.int_range(1, app.config['MAX_PAGE_SIZE']), location='args', required=False, help='Maximum number of changes to return')
+
+address_args = reqparse.RequestParser()
+address_args.add_argument('limit', type=inputs.int_range(1, app.config['MAX_PAGE_SIZE']), location='args', required=False, help='Maximum number of Addresses to return')
+address_args.add_argument('cursor', type=str, location='args', required=False, help='Cursor of the page to return, taken from the Link header')
+address_args.add_argument('fields', type=str, location='args', required=False, help='Comma separated fields of each Address to return: ' + ', '.join(Address.FIELDS))
+
+address_fields_args = reqparse.RequestParser()
+address_fields_args.add_argument('fields', type=str, location='args', required=False, help='Comma separated fields of the Address to return: ' + ', '.join(Address.FIELDS))
 
 ######################################################################
 # Special Error Handlers
@@ -126,12 +254,24 @@ def database_connection_error(error):
         'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
         'error': 'Service Unavailable',
         'message': message
-    }, status.HTTP_503_SERVICE_UNAVAILABLE
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': str(max(policy.breaker.retry_after(), 1))}
+
+@api.errorhandler(StaleDataError)
+def stale_data_error(error):
+    """ Handles updates that lost the race against another update of the same record """
+    message = "The record was changed by another request, read it again and retry"
+    app.logger.warning("%s: %s", message, error)
+    db.session.rollback()
+    return {
+        'status_code': status.HTTP_409_CONFLICT,
+        'error': 'Conflict',
+        'message': message
+    }, status.HTTP_409_CONFLICT
 
 ######################################################################
 #  PATH: /customers/{id}
 ######################################################################
-@api.route('/customers/<customer_id>')
+@api.route('/customers/<int:customer_id>')
 @api.param('customer_id', 'The Customer identifier')
 class CustomerResource(Resource):
     """ 
@@ -146,8 +286,12 @@ class CustomerResource(Resource):
     # RETRIEVE A CUSTOMER
     # ------------------------------------------------------------------
     @api.doc('get_customers')
+    @api.expect(customer_fields_args, validate=True)
+    @api.response(200, 'Success', customer_model)
+    @api.response(304, 'Customer not modified')
+    @api.response(400, 'Unknown fields were asked for')
     @api.response(404, 'Customer not found')
-    @api.marshal_with(customer_model)
+    @router.read
     def get(self, customer_id):
         """ 
         Retrieve a single Customer
@@ -155,11 +299,12 @@ class CustomerResource(Resource):
         This endpoint will return a Customer based on its id
         """
         app.logger.info("Request for customer with id: %s", customer_id)
-        customer = Customer.find(customer_id)
+        fields = Customer.parse_fields(customer_fields_args.parse_args()["fields"])
+        customer = Customer.find_serialized(customer_id, fields)
         if not customer:
             abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found.".format(customer_id))
-        app.logger.info("Returning customer: %s", customer.id)
-        return customer.serialize(), status.HTTP_200_OK
+        app.logger.info("Returning customer: %s", customer_id)
+        return conditional_response(customer)
     
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING CUSTOMER
@@ -221,40 +366,58 @@ class CustomerCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc('list_customers')
     @api.expect(customer_args, validate=True)
-    @api.marshal_list_with(customer_model)
+    @api.response(200, 'Success', [customer_model])
+    @router.read
     def get(self):
-        """ Returns all of the Customers """
+        """ Returns a page of the Customers matching all of the given query arguments """
         app.logger.info("Request for Customer List")
-
-        customers = []
-        name = request.args.get("name")
-        first_name = request.args.get("first_name")
-        last_name = request.args.get("last_name")
-        email = request.args.get("email")
-        phone_number = request.args.get("phone_number")
-        postalcode = request.args.get("postalcode")
-        street = request.args.get("street")
-
-        if name:
-            customers = Customer.find_by_name(name)
-        elif first_name:
-            customers = Customer.find_by_first_name(first_name)
-        elif last_name:
-            customers = Customer.find_by_last_name(last_name)
-        elif email:
-            customers = Customer.find_by_email(email)
-        elif phone_number:
-            customers = Customer.find_by_phone_number(phone_number)
-        elif postalcode:
-            customers = Customer.find_by_postalcode(postalcode)
-        elif street:
-            customers = Customer.find_by_street(street)
-        else:
-            customers = Customer.all()
-        
-        results = [customer.serialize() for customer in customers]
+        args = customer_args.parse_args()
+        limit = args["limit"] or app.config["DEFAULT_PAGE_SIZE"]
+        after = decode_cursor(args["cursor"])
+        embed = args["embed"] == "addresses"
+        fields = Customer.parse_fields(args["fields"])
+
+        filters = {
+            field: args[field]
+            for field in Customer.FILTER_FIELDS + Customer.ADDRESS_FILTER_FIELDS
+            if args[field]
+        }
+        query = Customer.find_by_filters(args["updated_since"], **filters)
+        key = (args["updated_since"], tuple(sorted(filters.items())))
+        results, last_id = Customer.find_page(query, key, limit, after, fields, addresses=embed)
         app.logger.info("Request %d customers", len(results))
-        return results, status.HTTP_200_OK
+        return json_response(results, status.HTTP_200_OK, next_page_headers(CustomerCollection, last_id, limit))
+
+    # ------------------------------------------------------------------
+    # DELETE MANY CUSTOMERS
+    # ------------------------------------------------------------------
+    @api.doc('delete_customers_in_bulk')
+    @api.expect(delete_args, validate=True)
+    @api.response(200, 'Customers deleted')
+    @api.response(204, 'All Customers deleted')
+    @api.response(403, 'Deleting all Customers is not allowed')
+    def delete(self):
+        """
+        Delete many Customers
+        This endpoint deletes the Customers matching all of the given ids and filters, with
+        their addresses, in one statement. Without any it deletes every Customer, which is
+        only allowed where ALLOW_DELETE_ALL is set.
+        """
+        args = delete_args.parse_args()
+        filters = {
+            field: args[field]
+            for field in Customer.FILTER_FIELDS + Customer.ADDRESS_FILTER_FIELDS
+            if args[field]
+        }
+        if args["id"] is None and not filters:
+            if not app.config["ALLOW_DELETE_ALL"]:
+                abort(status.HTTP_403_FORBIDDEN, "Deleting all Customers is not allowed here")
+            app.logger.warning("Request to delete all Customers")
+            Customer.delete_all()
+            return "", status.HTTP_204_NO_CONTENT
+        app.logger.info("Request to delete Customers with ids %s and filters %s", args["id"], filters)
+        count = Customer.delete_by_filters(args["id"], **filters)
+        return {"deleted": count}, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # ADD A NEW CUSTOMER
@@ -278,6 +441,143 @@ class CustomerCollection(Resource):
         location_url = api.url_for(CustomerResource, customer_id = customer.id, _external=True)
         return customer.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
 
+######################################################################
+#  PATH: /customers/export
+######################################################################
+@api.route('/customers/export')
+class CustomerExport(Resource):
+    """ Streams every Customer out of the database """
+
+    # ------------------------------------------------------------------
+    # EXPORT ALL CUSTOMERS
+    # ------------------------------------------------------------------
+    @api.doc('export_customers')
+    @api.expect(export_args, validate=True)
+    @api.produces([mimetype for _, mimetype, _ in export.FORMATS.values()])
+    @router.read
+    def get(self):
+        """
+        Export all of the Customers
+        This endpoint streams every Customer with its addresses as NDJSON or CSV
+        """
+        args = export_args.parse_args()
+        app.logger.info("Request to export Customers as %s", args["format"])
+        generate, mimetype, extension = export.FORMATS[args["format"]]
+        customers = Customer.stream(app.config["EXPORT_BATCH_SIZE"])
+        return Response(
+            stream_with_context(generate(customers)),
+            mimetype=mimetype,
+            headers={"Content-Disposition": f'attachment; filename="customers.{extension}"'},
+        )
+
+######################################################################
+#  PATH: /customers/changes
+######################################################################
+@api.route('/customers/changes')
+class CustomerChanges(Resource):
+    """ Pages through the outbox of changes to Customers and Addresses """
+
+    # ------------------------------------------------------------------
+    # LIST THE CHANGES
+    # ------------------------------------------------------------------
+    @api.doc('list_changes')
+    @api.expect(changes_args, validate=True)
+    @api.response(200, 'Success')
+    def get(self):
+        """
+        Returns the changes after an event id
+        Each change has the entity and its id, the operation (created, updated, deleted or
+        reset) and the record after the change. The Link header with rel="next" continues
+        after the last change returned, and is the URL to poll for more.
+        """
+        args = changes_args.parse_args()
+        limit = args["limit"] or app.config["DEFAULT_PAGE_SIZE"]
+        events = read_changes(args["after"], limit)
+        after = events[-1]["id"] if events else args["after"]
+        next_url = api.url_for(CustomerChanges, after=after, limit=limit, _external=True)
+        return json_response(events, status.HTTP_200_OK, {"Link": f'<{next_url}>; rel="next"'})
+
+######################################################################
+#  PATH: /customers/changes/stream
+######################################################################
+@api.route('/customers/changes/stream')
+class CustomerChangeStream(Resource):
+    """ Streams the changes to Customers and Addresses as they are committed """
+
+    # ------------------------------------------------------------------
+    # STREAM THE CHANGES
+    # ------------------------------------------------------------------
+    @api.doc('stream_changes')
+    @api.expect(changes_args, validate=True)
+    @api.produces(['text/event-stream'])
+    def get(self):
+        """
+        Stream the changes as Server-Sent Events
+        The stream starts after the Last-Event-ID header that browsers send when they
+        reconnect, or else after ?after=, and ends after CHANGE_STREAM_TIMEOUT seconds.
+        """
+        args = changes_args.parse_args()
+        after = request.headers.get("Last-Event-ID", args["after"], type=int)
+        limit = args["limit"] or app.config["DEFAULT_PAGE_SIZE"]
+        app.logger.info("Request to stream the changes after %s", after)
+        events = changes.generate_events(
+            lambda last: read_changes(last, limit),
+            after,
+            poll_interval=app.config["CHANGE_POLL_INTERVAL"],
+            heartbeat=app.config["CHANGE_HEARTBEAT"],
+            timeout=app.config["CHANGE_STREAM_TIMEOUT"],
+        )
+        return Response(
+            stream_with_context(events),
+            mimetype=changes.MIMETYPE,
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+######################################################################
+#  PATH: /customers:batch
+######################################################################
+@api.route('/customers:batch')
+class CustomerBatch(Resource):
+    """ Handles creating many Customers at once """
+
+    # ------------------------------------------------------------------
+    # ADD A BATCH OF NEW CUSTOMERS
+    # ------------------------------------------------------------------
+    @api.doc('batch_create_customers')
+    @api.response(400, 'The posted data was not valid')
+    @api.response(413, 'The batch holds too many Customers')
+    @api.response(415, 'The body is not JSON or NDJSON')
+    @api.expect([create_model])
+    def post(self):
+        """
+        Create a batch of Customers
+        This endpoint takes a JSON array, or newline delimited JSON, of Customers with their
+        addresses. Either all of them are created in one transaction, or none are and the
+        errors are returned for each Customer that was not valid.
+        """
+        app.logger.info("Request to create a batch of Customers")
+        payload = read_batch_payload()
+
+        customers = []
+        errors = []
+        for index, data in enumerate(payload):
+            try:
+                customers.append(Customer().deserialize(data))
+            except DataValidationError as error:
+                errors.append({"index": index, "message": str(error)})
+        if errors:
+            app.logger.error("Rejected batch of %d Customers with %d errors", len(payload), len(errors))
+            return {
+                'status_code': status.HTTP_400_BAD_REQUEST,
+                'error': 'Bad Request',
+                'message': f"{len(errors)} of {len(payload)} Customers are not valid",
+                'errors': errors
+            }, status.HTTP_400_BAD_REQUEST
+
+        results = Customer.bulk_create(customers)
+        app.logger.info("Created a batch of %d Customers", len(customers))
+        return results, status.HTTP_201_CREATED
+
 ######################################################################
 #  PATH: /customers/{id}/suspend
 ######################################################################
@@ -291,18 +591,12 @@ class SuspendResource(Resource):
     def put(self, customer_id):
         """
         Suspending a Customer
-        This endpoint will suspend a Customer based on customer_id
+        This endpoint will suspend a Customer based on customer_id, no body is needed
         """
         app.logger.info(f"Request to suspend customer with id {customer_id}")
-        customer = Customer.find(customer_id)
-        if not customer:
-            abort(status.HTTP_404_NOT_FOUND,
-                  "Customer with id '{}' was not found.".format(customer_id))
-        customer.deserialize(api.payload)
-        customer.account_status = "suspended"
-        customer.update()
-        app.logger.info("Customer with ID [%s] updated.", customer.id)
-        return customer.serialize(), status.HTTP_200_OK
+        customer = change_status(customer_id, "suspended")
+        app.logger.info("Customer with ID [%s] suspended.", customer_id)
+        return customer, status.HTTP_200_OK
 
 ######################################################################
 #  PATH: /customers/{id}/restore
@@ -317,19 +611,12 @@ class RestoreResource(Resource):
     def put(self, customer_id):
         """ 
         Restoring a customer 
-        This endpoint will restore a customer based on customer_id
+        This endpoint will restore a customer based on customer_id, no body is needed
         """
         app.logger.info("Request to restore customer with id: %s", customer_id)
-        check_content_type("application/json")
-        customer = Customer.find(customer_id)
-        if not customer:
-            abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found.".format(customer_id))
-        customer.deserialize(api.payload)
-        customer.account_status = 'active'
-        customer.update()
-
-        app.logger.info("Customer with ID [%s] updated.", customer.id)
-        return customer.serialize(), status.HTTP_200_OK
+        customer = change_status(customer_id, "active")
+        app.logger.info("Customer with ID [%s] restored.", customer_id)
+        return customer, status.HTTP_200_OK
 
 ######################################################################
 #  PATH: /customers/{customer_id}/addresses/{address_id}
@@ -350,8 +637,12 @@ class CustomerAddressResource(Resource):
     # RETRIEVE AN ADDRESS
     # ------------------------------------------------------------------
     @api.doc('get_addresses')
+    @api.expect(address_fields_args, validate=True)
+    @api.response(200, 'Success', address_model)
+    @api.response(304, 'Address not modified')
+    @api.response(400, 'Unknown fields were asked for')
     @api.response(404, 'Address not found')
-    @api.marshal_with(address_model)
+    @router.read
     def get(self, customer_id, address_id):
         """ 
         Get a Customer Address
@@ -359,11 +650,12 @@ class CustomerAddressResource(Resource):
         This endpoint will return an address based on its id and its customers's id
         """
         app.logger.info("Request to retrieve Customer Address %s for Customer id %s", (address_id, customer_id))
-        address = Address.find(address_id)
+        fields = Address.parse_fields(address_fields_args.parse_args()["fields"])
+        address = Address.find_serialized(address_id, fields)
         if not address:
             abort(status.HTTP_404_NOT_FOUND, f"Customer with id '{customer_id}' and address is '{address_id}' could not be found.")
         
-        return address.serialize(), status.HTTP_200_OK
+        return conditional_response(address)
 
     # ------------------------------------------------------------------
     # UPDATE AN ADDRESS
@@ -422,17 +714,24 @@ class CustomerAddressCollection(Resource):
     # LIST ALL ADDRESSES
     # ------------------------------------------------------------------
     @api.doc('list_addresses')
-    @api.marshal_list_with(address_model)
+    @api.expect(address_args, validate=True)
+    @api.response(200, 'Success', [address_model])
+    @router.read
     def get(self, customer_id):
-        """ Returns all of the Addresses for a Customer """
+        """ Returns a page of the Addresses for a Customer """
         app.logger.info("Request for all Address for Customer with id: %s", customer_id)
+        args = address_args.parse_args()
+        limit = args["limit"] or app.config["DEFAULT_PAGE_SIZE"]
+        after = decode_cursor(args["cursor"])
+        fields = Address.parse_fields(args["fields"])
 
-        customer = Customer.find(customer_id)
-        if not customer:
+        if not Customer.find_serialized(customer_id, ("id",)):
             abort(status.HTTP_404_NOT_FOUND, f"Order with id '{customer_id}' could not be found.")
 
-        results = [address.serialize() for address in customer.addresses]
-        return results, status.HTTP_200_OK
+        query = Address.find_by_customer_id(customer_id)
+        results, last_id = Address.find_page(query, (customer_id,), limit, after, fields)
+        headers = next_page_headers(CustomerAddressCollection, last_id, limit, customer_id=customer_id)
+        return json_response(results, status.HTTP_200_OK, headers)
 
     # ------------------------------------------------------------------
     # ADD A NEW ADDRESS
@@ -469,13 +768,6 @@ def abort(error_code: int, message: str):
     app.logger.error(message)
     api.abort(error_code, message)
 
-@app.before_first_request
-def init_db():
-    """ Initializes the SQLAlchemy app """
-    global app
-    Customer.init_db(app)
-    Address.init_db(app)
-
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers["Content-Type"] == content_type:
@@ -483,12 +775,132 @@ def check_content_type(content_type):
     app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
     abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, f"Content-Type must be {content_type}")
 
+def conditional_response(body: dict):
+    """ Returns a serialized record with its ETag, or 304 if the client already has it
+
+    The ETag is a hash of the content so it only changes when the record does.
+    Cache-Control: no-cache makes browsers revalidate with If-None-Match
+    instead of downloading the record again.
+    """
+    etag = hashlib.sha1(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest()
+    headers = {"ETag": quote_etag(etag), "Cache-Control": "no-cache"}
+    if request.if_none_match.contains_weak(etag):
+        return make_response("", status.HTTP_304_NOT_MODIFIED, headers)
+    return body, status.HTTP_200_OK, headers
+
+def json_response(body, code: int, headers: dict = None) -> Response:
+    """ Returns body encoded with orjson, bypassing flask-restx marshalling
+
+    The list endpoints serialize straight from column tuples into the exact
+    shape of the marshalled models, so running them through the marshaller
+    again would only convert every row a second time.
+    """
+    return Response(orjson.dumps(body), code, headers, mimetype="application/json")
+
+def read_changes(after: int, limit: int) -> list:
+    """ Returns the serialized changes after an event id and gives the connection back
+
+    Streams poll for a long time, so the session is closed after every read
+    instead of holding a pooled connection between polls.
+    """
+    try:
+        events = ChangeEvent.after(after, limit, app.config["OUTBOX_GAP_TIMEOUT"])
+        return [event.serialize() for event in events]
+    finally:
+        db.session.close()
+
+def read_batch_payload() -> list:
+    """ Reads the list of items posted as a JSON array or as NDJSON
+
+    A body longer than MAX_BATCH_BYTES is refused with 413, before any of it
+    is read when it has a Content-Length, and as soon as it passes the limit
+    when it is chunked. NDJSON stops being parsed at the first item past
+    MAX_BATCH_SIZE.
+    """
+    max_bytes = app.config["MAX_BATCH_BYTES"]
+    max_size = app.config["MAX_BATCH_SIZE"]
+    if request.content_length is not None and request.content_length > max_bytes:
+        abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, f"A batch can hold at most {max_bytes} bytes")
+    content_type = request.headers.get("Content-Type", "").split(";")[0].strip()
+    if content_type == "application/json":
+        body = b"".join(read_body_lines(max_bytes))
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise DataValidationError("Invalid batch: body of request is not valid JSON")
+        if not isinstance(payload, list):
+            raise DataValidationError("Invalid batch: body of request must be a JSON array")
+        if len(payload) > max_size:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, f"A batch can hold at most {max_size} Customers")
+        return payload
+    if content_type == "application/x-ndjson":
+        payload = []
+        for number, line in enumerate(read_body_lines(max_bytes), start=1):
+            if not line.strip():
+                continue
+            if len(payload) == max_size:
+                abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, f"A batch can hold at most {max_size} Customers")
+            try:
+                payload.append(json.loads(line))
+            except ValueError:
+                raise DataValidationError(f"Invalid batch: line {number} is not valid JSON")
+        return payload
+    app.logger.error("Invalid Content-Type: %s", content_type)
+    abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be application/json or application/x-ndjson")
+
+def read_body_lines(max_bytes: int):
+    """ Yields the lines of the body of the request, aborting with 413 once they pass max_bytes """
+    read = 0
+    while True:
+        # never more than one byte past the limit, even from a single endless line
+        line = request.stream.readline(max_bytes - read + 1)
+        if not line:
+            return
+        read += len(line)
+        if read > max_bytes:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, f"A batch can hold at most {max_bytes} bytes")
+        yield line
+
+def encode_cursor(last_id: int) -> str:
+    """ Encodes the id of the last record on a page as an opaque cursor """
+    token = json.dumps({"after": last_id}).encode("utf-8")
+    return base64.urlsafe_b64encode(token).decode("ascii")
+
+def decode_cursor(cursor: str):
+    """ Decodes a cursor back into the id to continue after """
+    if not cursor:
+        return None
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))["after"]
+    except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError):
+        raise DataValidationError(f"Invalid cursor: '{cursor}'")
+    if not isinstance(after, int):
+        raise DataValidationError(f"Invalid cursor: '{cursor}'")
+    return after
+
+def next_page_headers(resource, last_id: int, limit: int, **kwargs) -> dict:
+    """ Builds the Link header pointing at the page after last_id """
+    if last_id is None:
+        return {}
+    params = request.args.to_dict()
+    params.update(kwargs, cursor=encode_cursor(last_id), limit=limit)
+    url = api.url_for(resource, _external=True, **params)
+    return {"Link": f'<{url}>; rel="next"'}
+
+def change_status(customer_id: int, account_status: str) -> dict:
+    """ Sets the status of a Customer, aborting unless it exists and had another status """
+    row = Customer.change_status(customer_id, account_status)
+    if row is None:
+        if Customer.find_fields(customer_id, ("id",)) is None:
+            abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found.".format(customer_id))
+        abort(status.HTTP_409_CONFLICT, "Customer with id '{}' is already {}.".format(customer_id, account_status))
+    return Customer.serialize_rows([row])[0]
+
 # load sample data
 def data_load(payload):
     """ Loads a Customer into the database """
-    customer = Customer(payload['name'], payload['first_name'], payload['last_name'], payload['email'], payload['phone_number'], payload['account_status'], payload['addresses'])
-    customer.create()
+    Customer().deserialize(payload).create()
 
 def data_reset():
     """ Removes all Customers from the database """
-    Customer.remove_all()
\ No newline at end of file
+    Customer.delete_all()
\ No newline at end of file
@@ -0,0 +1,246 @@
+"""
+Module: shards
+Spreads the Customers and their Addresses over several databases by customer id
+
+SQLALCHEMY_DATABASE_URI is shard 0 and every URI in DATABASE_SHARD_URIS adds
+one more shard, with an engine and a pool of its own. Of N shards, a Customer
+lives on shard id % N and its Addresses live with it: an Address is given an
+id on the shard of its Customer, so its id names the shard just the same. A
+new Customer goes to the next shard in round-robin and takes its id from the
+sequence of that shard spaced N apart, so no shard ever asks another for one.
+
+A query whose WHERE pins a customer id, or the id of an Address, runs on the
+shards of those ids alone. Any other query runs on every shard, and when it
+is ordered or limited the rows are merged back into order and cut to the
+limit, so keyset pagination on the id pages through all the shards as it
+does through one database; a count() adds up the counts of the shards.
+
+Every shard commits a transaction of its own, there is no two-phase commit,
+so a bulk write that spans shards can be left half done if one of them
+fails. Reads are not routed to the read replicas while sharding is on, and
+the Customers of a database that was not sharded have to be moved to the
+shards of their ids before it becomes shard 0.
+
+With one database, the default, sessions are not sharded at all.
+"""
+import threading
+from operator import attrgetter
+from sqlalchemy import event, exc, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.sql import functions, operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList, UnaryExpression
+from service.replicas import RoutingSession, RoutingSQLAlchemy
+
+# table -> the columns whose values name the shard of a row
+SHARD_KEYS = {
+    "customer": ("id",),
+    "address": ("id", "customer_id"),
+}
+
+
+class ShardRouter():
+    """ Knows the shards and which one holds a Customer """
+
+    def __init__(self):
+        self.db = None
+        self.engines = []  # of the shards after the first, which is the engine of the app
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        """ The number of shards, 1 when there is only the one database """
+        return len(self.engines) + 1
+
+    @property
+    def enabled(self) -> bool:
+        """ Whether the Customers are spread over more than one database """
+        return bool(self.engines)
+
+    def init_app(self, app, db):
+        """ Creates an engine for every shard of the app after the first, replacing any from before """
+        self.close()
+        self.db = db
+        options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+        self.engines = [db.create_engine(make_url(uri), options) for uri in app.config["DATABASE_SHARD_URIS"]]
+
+    def close(self):
+        """ Closes the connections of every shard but the first """
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = []
+
+    def ids(self) -> list:
+        """ Returns the id of every shard, or [None] for the one database """
+        if not self.enabled:
+            return [None]
+        return list(range(self.count))
+
+    def binds(self) -> dict:
+        """ Returns the engine of every shard by its id """
+        return dict(enumerate([self.db.engine] + self.engines))
+
+    def shard_of(self, record_id: int):
+        """ Returns the shard of a Customer or Address id, or None for the one database """
+        if not self.enabled:
+            return None
+        return int(record_id) % self.count
+
+    def choose(self) -> int:
+        """ Returns the shard of the next new Customer, in round-robin """
+        with self._lock:
+            shard = self._next % self.count
+            self._next += 1
+        return shard
+
+    ##################################################
+    # Choosers of the sharded session
+    ##################################################
+
+    def shard_for_instance(self, mapper, instance, clause=None) -> int:
+        """ Returns the shard a record is written to, which its id names """
+        if instance is not None and getattr(instance, "id", None) is not None:
+            return self.shard_of(instance.id)
+        raise exc.InvalidRequestError(
+            f"Cannot tell the shard of {instance if instance is not None else clause}, pass a shard_id"
+        )
+
+    def shards_for_identity(self, query, identity) -> list:
+        """ Returns the shards a record with a primary key can be on """
+        entity = query.column_descriptions[0]["entity"]
+        if getattr(entity, "__tablename__", None) in SHARD_KEYS:
+            return [self.shard_of(identity[0])]
+        return self.ids()
+
+    def shards_for_statement(self, orm_context) -> list:
+        """ Returns the shards a statement has to run on, all of them unless its WHERE pins the ids """
+        if orm_context.lazy_loaded_from is not None and orm_context.lazy_loaded_from.identity_token is not None:
+            return [orm_context.lazy_loaded_from.identity_token]
+        found = None
+        for values in _pinned_keys(getattr(orm_context.statement, "whereclause", None), orm_context.parameters):
+            pinned = {self.shard_of(value) for value in values}
+            found = pinned if found is None else found & pinned
+        if found is None:
+            return self.ids()
+        # keys of different shards match no row, but the statement still has to run somewhere
+        return sorted(found) or [0]
+
+
+def _pinned_keys(whereclause, parameters) -> list:
+    """ Returns the sets of shard key values the WHERE requires a row to have one of """
+    if isinstance(parameters, (list, tuple)):
+        parameters = parameters[0] if len(parameters) == 1 else {}
+    pinned = []
+    for criterion in _conjuncts(whereclause):
+        if not isinstance(criterion, BinaryExpression) or not isinstance(criterion.right, BindParameter):
+            continue
+        table = getattr(criterion.left, "table", None)
+        if getattr(criterion.left, "name", None) not in SHARD_KEYS.get(getattr(table, "name", None), ()):
+            continue
+        if criterion.operator not in (operators.eq, operators.in_op):
+            continue
+        value = (parameters or {}).get(criterion.right.key, criterion.right.value)
+        values = set(value) if isinstance(value, (list, tuple, set)) else {value}
+        if None not in values:
+            pinned.append(values)
+    return pinned
+
+
+def _conjuncts(clause) -> list:
+    """ Returns the criteria a WHERE joins with AND """
+    if clause is None:
+        return []
+    if isinstance(clause, BooleanClauseList) and clause.operator is operators.and_:
+        return [criterion for inner in clause.clauses for criterion in _conjuncts(inner)]
+    return [clause]
+
+
+def merge_shards(orm_context):
+    """ Puts the rows of a query that ran on several shards back into order, and adds up counts
+
+    Each shard has already sorted and limited its own rows, so the rows of
+    the first page of all the shards are among them. Streamed queries are
+    left alone, they come back one shard after the other.
+    """
+    if not orm_context.is_select or _on_one_shard(orm_context):
+        return None
+    statement = orm_context.statement
+    columns = list(statement.selected_columns)
+    counting = len(columns) == 1 and isinstance(columns[0], functions.count)
+    order_by, limit = statement._order_by_clauses, statement._limit
+    if orm_context.execution_options.get("stream_results") or not (counting or order_by or limit is not None):
+        return None
+    frozen = orm_context.invoke_statement().freeze()
+    rows = frozen.rewrite_rows()
+    if counting:
+        rows = [[sum(row[0] for row in rows)]]
+    else:
+        keys = list(frozen.metadata.keys)
+        # sorting is stable, so sorting by the last column first orders by all of them
+        for clause in reversed(order_by):
+            descending = isinstance(clause, UnaryExpression) and clause.modifier is operators.desc_op
+            column = clause.element if isinstance(clause, UnaryExpression) else clause
+            rows.sort(key=_sort_key(keys, column), reverse=descending)
+        if limit is not None:
+            rows = rows[:limit]
+    return frozen.with_new_rows(rows)()
+
+
+def _on_one_shard(orm_context) -> bool:
+    """ Returns whether a statement runs on a single shard """
+    options = orm_context.load_options
+    if options._refresh_identity_token is not None:
+        return True
+    if "_sa_shard_id" in orm_context.execution_options or "shard_id" in orm_context.bind_arguments:
+        return True
+    return len(orm_context.session.execute_chooser(orm_context)) <= 1
+
+
+def _sort_key(keys: list, column):
+    """ Returns the sort key of a row for a column, selected by itself or an attribute of the entity """
+    if column.key in keys:
+        position = keys.index(column.key)
+        return lambda row: row[position]
+    value = attrgetter(column.key)
+    return lambda row: value(row[0])
+
+
+class ShardedRoutingSession(ShardedSession, RoutingSession):
+    """ Session that reads and writes the Customers on their shards """
+
+    def __init__(self, db, **options):
+        super().__init__(
+            shard_chooser=shards.shard_for_instance,
+            id_chooser=shards.shards_for_identity,
+            execute_chooser=shards.shards_for_statement,
+            shards=shards.binds(),
+            db=db,
+            **options,
+        )
+        # ahead of the listener of ShardedSession, which runs the statement on each shard
+        event.listen(self, "do_orm_execute", merge_shards, retval=True, insert=True)
+
+
+class ShardingSessionMaker(orm.sessionmaker):
+    """ Session factory that makes sharded sessions while there is more than one shard """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # a subclass of the class of the factory, so it gets the listeners of db.session
+        self.sharded_class = type(self.class_.__name__, (ShardedRoutingSession, self.class_), {})
+
+    def __call__(self, **local_kw):
+        if not shards.enabled:
+            return super().__call__(**local_kw)
+        return self.sharded_class(**dict(self.kw, **local_kw))
+
+
+class ShardedSQLAlchemy(RoutingSQLAlchemy):
+    """ SQLAlchemy extension whose sessions can be sharded by customer id """
+
+    def create_session(self, options):
+        return ShardingSessionMaker(class_=RoutingSession, db=self, **options)
+
+
+shards = ShardRouter()
@@ -0,0 +1,111 @@
+"""
+Module: singleflight
+Coalesces identical reads that run at the same time into one query
+
+When a hot Customer drops out of the cache, or a popular search is asked for
+by many clients at once, every one of those requests would run the same
+query. Under SingleFlight the first of them runs it and the others that
+arrive while it is in flight wait for its result instead, so the database
+sees one query per key however many requests are waiting on it.
+
+A caller waits for the call in flight for at most RETRY_DEADLINE seconds,
+the time a read may take with all of its retries. If that call is still not
+back by then, it is stuck behind a connection that hangs, so the caller runs
+the function itself rather than hang with it.
+
+Only calls that overlap are coalesced, nothing is kept once the first call
+returns, which is what the cache is for. Every caller gets the very same
+object, so callers must not change it, and an exception of the call is
+raised in every one of them. Calls are shared by the threads or greenlets of
+one worker process, never between workers.
+
+Set COALESCE_READS to false to run every call on its own.
+"""
+import logging
+import threading
+
+logger = logging.getLogger("flask.app")
+
+
+class Flight():
+    """ One call in progress and what it came to """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    """ Runs one call at a time per key and shares its result with the calls that overlap it """
+
+    def __init__(self):
+        self.enabled = True
+        self.timeout = 5.0
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Reads the configuration of the Flask app and resets the counters """
+        self.enabled = app.config.get("COALESCE_READS", True)
+        self.timeout = app.config.get("RETRY_DEADLINE", self.timeout)
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        logger.info("Coalescing of identical reads is %s", "on" if self.enabled else "off")
+
+    def do(self, key, function):
+        """ Returns function(), or the result of the call under the same key already in flight
+
+        :param key: what tells identical calls apart from others, any hashable value
+        :param function: the call to make when none is in flight for the key
+
+        :return: what the call returned
+        """
+        if not self.enabled:
+            return function()
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            if not flight.done.wait(self.timeout):
+                with self._lock:
+                    self.timeouts += 1
+                logger.warning("Call of %s still in flight after %.1fs, making another", key, self.timeout)
+                return function()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            # calls made from now on start a flight of their own
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self) -> dict:
+        """ Returns the counters of this worker """
+        return {
+            "enabled": self.enabled,
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "timeouts": self.timeouts,
+            "in_flight": len(self._flights),
+        }
+
+
+# The coalescing of the reads of the models, configured later in init_db()
+flights = SingleFlight()
@@ -164,17 +164,22 @@ $(function () {
         if (id) {
             queryString = '/' + id
         };
+        // the filters are combined so every one of them must match
+        let filters = {};
         if (name) {
-            queryString += '?name=' + name
+            filters.name = name
         };
         if (first_name) {
-            queryString += '?first_name=' + first_name
+            filters.first_name = first_name
         };
         if (last_name) {
-            queryString += '?last_name=' + last_name
+            filters.last_name = last_name
         };
         if (email) {
-            queryString += '?email=' + email
+            filters.email = email
+        };
+        if (!$.isEmptyObject(filters)) {
+            queryString += '?' + $.param(filters)
         };
         // if (phone_number) {
         //     queryString += 'phone_number=' + phone_number
@@ -223,26 +228,10 @@ $(function () {
     // *******************************************************
     $("#suspend-btn").click(function () {
         let customer_id = $("#customer_id").val();
-        let name = $("#customer_name").val();
-        let first_name = $("#customer_first_name").val();
-        let last_name = $("#customer_last_name").val();
-        let email = $("#customer_email").val();
-        let phone_number = $("#customer_phone_number").val();
-        let data = {
-            "name": name,
-            "first_name": first_name,
-            "last_name": last_name,
-            "email": email,
-            "phone_number": phone_number,
-            "addresses": [],
-            "account_status": "suspended"
-        };
         $("#flash_message").empty();
         let ajax = $.ajax({
                 type: "PUT",
-                url: `/customers/${customer_id}/suspend`,
-                contentType: "application/json",
-                data: JSON.stringify(data)
+                url: `/customers/${customer_id}/suspend`
             });
         ajax.done(function(res){
             flash_message("Success");
@@ -257,26 +246,10 @@ $(function () {
     // *******************************************************
     $("#restore-btn").click(function () {
         let customer_id = $("#customer_id").val();
-        let name = $("#customer_name").val();
-        let first_name = $("#customer_first_name").val();
-        let last_name = $("#customer_last_name").val();
-        let email = $("#customer_email").val();
-        let phone_number = $("#customer_phone_number").val();
-        let data = {
-            "name": name,
-            "first_name": first_name,
-            "last_name": last_name,
-            "email": email,
-            "phone_number": phone_number,
-            "addresses": [],
-            "account_status": "suspended"
-        };
         $("#flash_message").empty();
         let ajax = $.ajax({
                 type: "PUT",
-                url: `/customers/${customer_id}/restore`,
-                contentType: "application/json",
-                data: JSON.stringify(data)
+                url: `/customers/${customer_id}/restore`
             });
         ajax.done(function(res){
             flash_message("Success");
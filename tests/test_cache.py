@@ -0,0 +1,108 @@
+"""
+Test cases for the read-through cache
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+
+While debugging just these tests it's convenient to use this:
+    nosetests --stop tests/test_cache.py:TestCache
+
+"""
+import time
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from flask import Flask
+from service.cache import Cache, MemoryBackend, DiskBackend, NullBackend
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestCache(unittest.TestCase):
+    """Test Cases for the read-through cache"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """This runs after each test"""
+        shutil.rmtree(self.directory)
+
+    def _backends(self, max_entries=2, ttl=60):
+        """ Returns one of each real backend """
+        return [
+            MemoryBackend(max_entries, ttl),
+            DiskBackend(f"{self.directory}/cache.sqlite3", max_entries, ttl),
+        ]
+
+    def test_get_set_delete(self):
+        """ Store and remove values """
+        for backend in self._backends():
+            backend.set("customer:1", {"id": 1})
+            self.assertEqual(backend.get("customer:1"), {"id": 1})
+            backend.delete("customer:1")
+            self.assertIsNone(backend.get("customer:1"))
+            backend.set("customer:2", {"id": 2})
+            backend.clear()
+            self.assertEqual(len(backend), 0)
+
+    def test_lru_eviction(self):
+        """ Evict the least recently used value """
+        for backend in self._backends(max_entries=2):
+            backend.set("customer:1", {"id": 1})
+            time.sleep(0.01)
+            backend.set("customer:2", {"id": 2})
+            time.sleep(0.01)
+            backend.get("customer:1")
+            time.sleep(0.01)
+            backend.set("customer:3", {"id": 3})
+            self.assertEqual(backend.get("customer:1"), {"id": 1})
+            self.assertIsNone(backend.get("customer:2"))
+            self.assertEqual(backend.evictions, 1)
+            self.assertEqual(len(backend), 2)
+
+    def test_ttl_expiry(self):
+        """ Expire values after the ttl """
+        for backend in self._backends(ttl=0.05):
+            backend.set("customer:1", {"id": 1})
+            self.assertEqual(backend.get("customer:1"), {"id": 1})
+            time.sleep(0.1)
+            self.assertIsNone(backend.get("customer:1"))
+
+    def test_read_through(self):
+        """ Load only on a miss and count hits and misses """
+        cache = Cache()
+        cache.backend = MemoryBackend(10, 60)
+        loader = MagicMock(return_value={"id": 1})
+        self.assertEqual(cache.get_or_load("customer:1", loader), {"id": 1})
+        self.assertEqual(cache.get_or_load("customer:1", loader), {"id": 1})
+        loader.assert_called_once()
+        cache.invalidate("customer:1")
+        cache.get_or_load("customer:1", loader)
+        self.assertEqual(loader.call_count, 2)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 2, 1))
+
+    def test_read_through_not_found(self):
+        """ Do not cache records that do not exist """
+        cache = Cache()
+        cache.backend = MemoryBackend(10, 60)
+        loader = MagicMock(return_value=None)
+        self.assertIsNone(cache.get_or_load("customer:1", loader))
+        self.assertIsNone(cache.get_or_load("customer:1", loader))
+        self.assertEqual(loader.call_count, 2)
+
+    def test_init_app(self):
+        """ Select the backend from the configuration """
+        app = Flask(__name__)
+        cache = Cache()
+        for name, backend in [("memory", MemoryBackend), ("disk", DiskBackend), ("none", NullBackend)]:
+            app.config.update(CACHE_BACKEND=name, CACHE_DIR=self.directory)
+            cache.init_app(app)
+            self.assertIsInstance(cache.backend, backend)
+        app.config["CACHE_BACKEND"] = "redis"
+        self.assertRaises(ValueError, cache.init_app, app)
@@ -0,0 +1,90 @@
+"""
+Test cases for the sizing logic of gunicorn.conf.py
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+
+While debugging just these tests it's convenient to use this:
+    nosetests --stop tests/test_gunicorn_conf.py:TestGunicornConf
+
+"""
+import os
+import runpy
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py")
+
+
+def load_config(**environ) -> dict:
+    """ Runs gunicorn.conf.py with the given environment and returns its settings """
+    with patch.dict(os.environ, environ):
+        return runpy.run_path(CONFIG_FILE)
+
+
+######################################################################
+#  G U N I C O R N   C O N F I G   T E S T   C A S E S
+######################################################################
+class TestGunicornConf(unittest.TestCase):
+    """Test Cases for the gunicorn configuration"""
+
+    def test_worker_count(self):
+        """ Size workers from the CPUs and the memory limit """
+        config = load_config()
+        self.assertEqual(config["worker_count"](2, None), 5)
+        self.assertEqual(config["worker_count"](4, 512 << 20), 4)
+        self.assertEqual(config["worker_count"](4, 64 << 20), 1)
+
+    def test_memory_limit(self):
+        """ Read the memory limit Cloud Foundry sets """
+        config = load_config()
+        with patch.dict(os.environ, {"MEMORY_LIMIT": "512M"}):
+            self.assertEqual(config["memory_limit"](), 512 << 20)
+        with patch.dict(os.environ, {"MEMORY_LIMIT": "2g"}):
+            self.assertEqual(config["memory_limit"](), 2 << 30)
+
+    def test_worker_classes(self):
+        """ Configure threads and the pool for each worker class """
+        config = load_config(GUNICORN_WORKER_CLASS="sync", GUNICORN_WORKERS="2")
+        self.assertEqual(config["workers"], 2)
+        self.assertEqual(config["threads"], 1)
+        with patch.dict(os.environ, {"GUNICORN_WORKER_CLASS": "gthread", "GUNICORN_THREADS": "8"}):
+            os.environ.pop("DB_POOL_SIZE", None)
+            config = runpy.run_path(CONFIG_FILE)
+            self.assertEqual(config["threads"], 8)
+            self.assertEqual(os.environ["DB_POOL_SIZE"], "8")
+            self.assertNotEqual(os.environ.get("CHANGE_STREAM_TIMEOUT"), "0")
+        with patch.dict(os.environ, {"GUNICORN_WORKER_CLASS": "sync", "CHANGE_STREAM_TIMEOUT": "25"}):
+            runpy.run_path(CONFIG_FILE)
+            self.assertEqual(os.environ["CHANGE_STREAM_TIMEOUT"], "0")
+        config = load_config(PORT="9000", GUNICORN_WORKER_CLASS="gevent")
+        self.assertEqual(config["worker_class"], "gevent")
+        self.assertEqual(config["bind"], "0.0.0.0:9000")
+
+    def test_cache_backend(self):
+        """ Share the disk cache between several workers """
+        for workers, backend in (("1", None), ("3", "disk")):
+            with patch.dict(os.environ, {"GUNICORN_WORKERS": workers}):
+                os.environ.pop("CACHE_BACKEND", None)
+                runpy.run_path(CONFIG_FILE)
+                self.assertEqual(os.environ.get("CACHE_BACKEND"), backend)
+        # a backend that was asked for is kept
+        with patch.dict(os.environ, {"GUNICORN_WORKERS": "3", "CACHE_BACKEND": "none"}):
+            runpy.run_path(CONFIG_FILE)
+            self.assertEqual(os.environ["CACHE_BACKEND"], "none")
+
+    def test_forked_workers_drop_every_pool(self):
+        """ Forget the connections of every shard and replica in a worker forked from a preloaded app """
+        import service  # a preloaded app, imported by the master before the fork
+        config = load_config()
+        engines = [MagicMock(), MagicMock(), MagicMock()]
+        cfg = SimpleNamespace(worker_class_str="sync", preload_app=True)
+        with patch("service.models.engines", return_value=engines):
+            config["post_fork"](SimpleNamespace(cfg=cfg), None)
+            for engine in engines:
+                engine.dispose.assert_called_once_with(close=False)
+            with patch("service.pool.warm_up") as warm_up:
+                config["post_worker_init"](SimpleNamespace(cfg=cfg))
+        self.assertEqual([call.args[0] for call in warm_up.call_args_list], engines)
@@ -27,7 +27,12 @@ from ctypes import addressof
 import os
 import logging
 import unittest
-from service.models import Customer, Address, DataValidationError, db
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import event
+from sqlalchemy.orm.exc import StaleDataError
+from service.models import Customer, Address, ChangeEvent, DataValidationError, db, utcnow
+from service.cache import cache
+from service.metrics import count_queries
 from service import app
 from .factories import CustomerFactory, AddressFactory
 
@@ -64,6 +69,7 @@ class TestCustomerModel(unittest.TestCase):
         db.session.query(Address).delete()
         db.session.query(Customer).delete()
         db.session.commit()
+        cache.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -181,6 +187,40 @@ class TestCustomerModel(unittest.TestCase):
         customers = Customer.all()
         self.assertEqual(len(customers), 0)
 
+    def test_delete_customer_with_addresses(self):
+        """ Delete the addresses of a Customer together with it """
+        customer = self._create_customer(addresses=[self._create_address(), self._create_address()])
+        customer.create()
+        Customer.find(customer.id).delete()
+        self.assertEqual(Customer.all(), [])
+        self.assertEqual(Address.all(), [])
+
+    def test_delete_by_filters(self):
+        """ Delete the Customers matching ids and filters in one statement, plus the outbox insert """
+        customers = [self._create_customer(addresses=[self._create_address()]) for _ in range(4)]
+        Customer.bulk_create(customers)
+        customers[0].last_name = customers[1].last_name = "Doe"
+        customers[0].update()
+        customers[1].update()
+        ids = [customer.id for customer in customers]
+        with count_queries() as queries:
+            count = Customer.delete_by_filters(ids=[ids[1], ids[2]], last_name="Doe")
+        self.assertEqual(count, 1)
+        # SQLite has no RETURNING, so the deleted ids are selected first
+        self.assertEqual(queries.count, 2 if db.engine.dialect.full_returning else 3)
+        self.assertTrue(queries.statements[-2].startswith("DELETE FROM customer"))
+        self.assertTrue(queries.statements[-1].startswith("INSERT INTO outbox"))
+        self.assertEqual(sorted(customer.id for customer in Customer.all()), [ids[0], ids[2], ids[3]])
+        self.assertEqual(len(Address.all()), 3)
+        self.assertEqual(Customer.delete_by_filters(ids=[]), 0)
+
+    def test_delete_all(self):
+        """ Remove every Customer and Address """
+        Customer.bulk_create([self._create_customer(addresses=[self._create_address()]) for _ in range(3)])
+        Customer.delete_all()
+        self.assertEqual(Customer.all(), [])
+        self.assertEqual(Address.all(), [])
+
     def test_list_all_customers(self):
         """ List all Customers in the database """
         customers = Customer.all()
@@ -192,6 +232,86 @@ class TestCustomerModel(unittest.TestCase):
         customers = Customer.all()
         self.assertEqual(len(customers), 5)
 
+    def test_paginate_customers(self):
+        """ Page through Customers by id """
+        for _ in range(5):
+            customer = self._create_customer()
+            customer.create()
+        first, after = Customer.paginate(Customer.query, 3)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(after, first[-1].id)
+        second, after = Customer.paginate(Customer.query, 3, after)
+        self.assertEqual(len(second), 2)
+        self.assertIsNone(after)
+        ids = [customer.id for customer in first + second]
+        self.assertEqual(ids, sorted(customer.id for customer in Customer.all()))
+
+    def test_list_customers_loads_addresses_in_one_query(self):
+        """ List Customers with their Addresses without an N+1 """
+        for _ in range(3):
+            customer = self._create_customer(addresses=[self._create_address()])
+            customer.create()
+        db.session.expunge_all()
+
+        statements = []
+        def count(*args):
+            statements.append(args)
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            customers = Customer.all()
+            serialized = [customer.serialize() for customer in customers]
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+        self.assertEqual(len(statements), 2)
+        self.assertEqual([len(customer["addresses"]) for customer in serialized], [1, 1, 1])
+
+    def test_embed_without_addresses(self):
+        """ Skip loading Addresses when they are not embedded """
+        customer = self._create_customer(addresses=[self._create_address()])
+        customer.create()
+        name = customer.name
+        db.session.expunge_all()
+
+        found = Customer.embed(Customer.find_by_name(name), addresses=False).all()
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0].addresses, [])
+        self.assertNotIn("addresses", found[0].serialize(addresses=False))
+
+    def test_serialize_rows(self):
+        """ Serialize column tuples exactly like serialize() """
+        first = self._create_customer(addresses=[self._create_address(), self._create_address()])
+        first.create()
+        second = self._create_customer()
+        second.create()
+        expected = [customer.serialize() for customer in Customer.query.order_by(Customer.id)]
+
+        rows, _ = Customer.paginate(Customer.columns(Customer.query), 10)
+        self.assertEqual(Customer.serialize_rows(rows), expected)
+        customers = Customer.serialize_rows(rows, addresses=False)
+        self.assertEqual([customer["addresses"] for customer in customers], [None, None])
+        self.assertEqual(Customer.serialize_rows([]), [])
+
+        rows, _ = Address.paginate(Address.columns(Address.find_by_customer_id(first.id)), 10)
+        self.assertEqual(Address.serialize_rows(rows), expected[0]["addresses"])
+
+    def test_parse_fields(self):
+        """ Parse the fields asked for with ?fields= """
+        self.assertIsNone(Customer.parse_fields(None))
+        self.assertIsNone(Customer.parse_fields(" , "))
+        self.assertEqual(Customer.parse_fields("email, id,email"), ("email", "id"))
+        self.assertEqual(Customer.parse_fields("addresses"), ("addresses",))
+        self.assertRaises(DataValidationError, Customer.parse_fields, "id,secret")
+        self.assertRaises(DataValidationError, Address.parse_fields, "addresses")
+
+    def test_find_serialized_fields(self):
+        """ Find only some fields of a Customer """
+        customer = self._create_customer(addresses=[self._create_address()])
+        customer.create()
+        found = Customer.find_serialized(customer.id, ("email", "addresses"))
+        self.assertEqual(found, {"email": customer.email, "addresses": [customer.addresses[0].serialize()]})
+        self.assertEqual(Customer.find_serialized(customer.id, ("id",)), {"id": customer.id})
+        self.assertIsNone(Customer.find_serialized(0, ("id",)))
+
     def test_find_or_404(self):
         """ Find or throw 404 error """
         customer = self._create_customer()
@@ -243,6 +363,40 @@ class TestCustomerModel(unittest.TestCase):
         self.assertEqual(same_customer.id, customer.id)
         self.assertEqual(same_customer.phone_number, customer.phone_number)
 
+    def test_find_by_filters(self):
+        """ Find by any combination of filters """
+        customer = self._create_customer()
+        address = self._create_address()
+        customer.addresses.append(address)
+        customer.create()
+        other = self._create_customer()
+        other.first_name = customer.first_name
+        other.last_name = customer.last_name + "X"
+        other.create()
+
+        found = Customer.find_by_filters(first_name=customer.first_name).all()
+        self.assertEqual(len(found), 2)
+        found = Customer.find_by_filters(first_name=customer.first_name, last_name=customer.last_name).all()
+        self.assertEqual(found, [customer])
+        found = Customer.find_by_filters(
+            first_name=customer.first_name, street=address.street, postalcode=address.postalcode
+        ).all()
+        self.assertEqual(found, [customer])
+        found = Customer.find_by_filters(street=address.street, postalcode=address.postalcode + "X").all()
+        self.assertEqual(found, [])
+        self.assertEqual(len(Customer.find_by_filters(email=None).all()), 2)
+
+    def test_find_by_filters_reuses_compiled_shape(self):
+        """ Build the criterion once per combination of filters """
+        Customer.find_by_filters(last_name="A", account_status="active")
+        hits = Customer._compile_filters.cache_info().hits
+        Customer.find_by_filters(account_status="suspended", last_name="B")
+        self.assertEqual(Customer._compile_filters.cache_info().hits, hits + 1)
+
+    def test_find_by_unknown_filter(self):
+        """ Find by a filter that does not exist """
+        self.assertRaises(DataValidationError, Customer.find_by_filters, password="secret")
+
     def test_serialize_a_customer(self):
         """ Serialize a customer """
         address = self._create_address()
@@ -391,3 +545,109 @@ class TestCustomerModel(unittest.TestCase):
 
         same_customer = Customer.find_by_postalcode(address.postalcode)
         self.assertEqual(same_customer[0], customer)
+
+    ######################################################################
+    #  C H A N G E   T R A C K I N G   T E S T   C A S E S
+    ######################################################################
+
+    def _changes_since(self, after_id: int) -> list:
+        """ Returns (operation, entity, entity_id) of the events written after an id """
+        events = ChangeEvent.query.filter(ChangeEvent.id > after_id).order_by(ChangeEvent.id)
+        return [(event.operation, event.entity, event.entity_id) for event in events]
+
+    def _last_event_id(self) -> int:
+        """ Returns the id of the newest event in the outbox """
+        last = ChangeEvent.query.order_by(ChangeEvent.id.desc()).first()
+        return last.id if last else 0
+
+    def test_version_and_updated_at(self):
+        """ Stamp every save of a Customer with the time and a new version """
+        before = utcnow()
+        customer = self._create_customer(addresses=[self._create_address()])
+        customer.create()
+        self.assertEqual(customer.version, 1)
+        self.assertGreaterEqual(customer.updated_at, before)
+        created_at = customer.updated_at
+        customer.email = "changed@example.com"
+        customer.update()
+        self.assertEqual(customer.version, 2)
+        self.assertGreaterEqual(customer.updated_at, created_at)
+        self.assertEqual(customer.addresses[0].version, 1)
+        serialized = customer.serialize()
+        self.assertEqual(serialized["version"], 2)
+        self.assertTrue(serialized["updated_at"].endswith("Z"))
+
+    def test_update_stale_customer(self):
+        """ Fail to save a Customer that another update changed in the meantime """
+        customer = self._create_customer()
+        customer.create()
+        db.session.execute(Customer.__table__.update().values(version=Customer.__table__.c.version + 1))
+        customer.email = "lost@example.com"
+        self.assertRaises(StaleDataError, customer.update)
+        db.session.rollback()
+
+    def test_changes_written_to_outbox(self):
+        """ Write an event for every change in the transaction of the change """
+        last = self._last_event_id()
+        customer = self._create_customer(addresses=[self._create_address()])
+        customer.create()
+        address_id = customer.addresses[0].id
+        customer.first_name = "Changed"
+        customer.update()
+        Customer.change_status(customer.id, "suspended")
+        customer = Customer.find(customer.id)
+        customer.delete()
+        self.assertEqual(self._changes_since(last), [
+            ("created", "customer", customer.id),
+            ("created", "address", address_id),
+            ("updated", "customer", customer.id),
+            ("updated", "customer", customer.id),
+            ("deleted", "customer", customer.id),
+            ("deleted", "address", address_id),
+        ])
+        # the events of earlier tests may have been pruned, leaving a gap before these
+        events = [event.serialize() for event in ChangeEvent.after(last, 10, gap_timeout=0)]
+        self.assertEqual(events[2]["record"]["first_name"], "Changed")
+        self.assertEqual(events[3]["record"]["account_status"], "suspended")
+        self.assertEqual([event["version"] for event in events[:4]], [1, 1, 2, 3])
+        self.assertIsNone(events[4]["record"])
+
+    def test_bulk_deletes_written_to_outbox(self):
+        """ Write an event for every Customer deleted by filters, and one for a reset """
+        customers = [self._create_customer() for _ in range(3)]
+        Customer.bulk_create(customers)
+        ids = sorted(customer.id for customer in customers)
+        last = self._last_event_id()
+        self.assertEqual(Customer.delete_by_filters(ids=ids[:2]), 2)
+        Customer.delete_all()
+        self.assertEqual(sorted(self._changes_since(last)[:2]), [
+            ("deleted", "customer", ids[0]), ("deleted", "customer", ids[1])
+        ])
+        self.assertEqual(self._changes_since(last)[2:], [("reset", "customer", None)])
+
+    def test_changes_stop_at_gap(self):
+        """ Hold back the events after an id that may still be committed """
+        last = self._last_event_id()
+        table = ChangeEvent.__table__
+        db.session.execute(table.insert(), [
+            {"id": last + 1, "entity": "customer", "operation": "created", "created_at": utcnow()},
+            {"id": last + 3, "entity": "customer", "operation": "created", "created_at": utcnow()},
+        ])
+        db.session.commit()
+        self.assertEqual([event.id for event in ChangeEvent.after(last, 10)], [last + 1])
+        self.assertEqual([event.id for event in ChangeEvent.after(last, 10, gap_timeout=0)], [last + 1, last + 3])
+        count = ChangeEvent.query.count()
+        self.assertEqual(ChangeEvent.prune(utcnow() - timedelta(days=1)), 0)
+        self.assertEqual(ChangeEvent.prune(utcnow() + timedelta(seconds=1)), count)
+        self.assertEqual(ChangeEvent.query.count(), 0)
+
+    def test_find_updated_since(self):
+        """ Find the Customers updated after a time """
+        old, new = self._create_customer(), self._create_customer()
+        old.create()
+        since = utcnow()
+        new.create()
+        self.assertEqual([customer.id for customer in Customer.find_by_filters(since)], [new.id])
+        aware = since.replace(tzinfo=timezone.utc).astimezone(timezone(timedelta(hours=-5)))
+        self.assertEqual([customer.id for customer in Customer.find_by_filters(aware)], [new.id])
+        self.assertEqual(Customer.find_by_filters(datetime(2100, 1, 1)).count(), 0)
@@ -11,15 +11,21 @@ While debugging just these tests it's convenient to use this:
 """
 
 from http.client import responses
+import io
+import csv
 import os
 import logging
 import unittest
 import json
 
 # from unittest.mock import MagicMock, patch
+from unittest.mock import patch
 from urllib.parse import quote_plus
 from service import app, status
-from service.models import db, init_db, Address, Customer
+from service.models import db, init_db, Address, ChangeEvent, Customer
+from service.cache import cache
+from service.metrics import count_queries
+from service.resilience import CircuitBreaker, policy
 from .factories import CustomerFactory, AddressFactory
 
 # Disable all but critical errors during normal test run
@@ -65,6 +71,8 @@ class TestCustomerServer(unittest.TestCase):
         self.app = app.test_client()
         db.session.query(Address).delete()
         db.session.query(Customer).delete()
+        db.session.commit()
+        cache.clear()
 
     def tearDown(self):
         db.session.remove()
@@ -90,6 +98,16 @@ class TestCustomerServer(unittest.TestCase):
             customers.append(test_customer)
         return customers
 
+    def assertQueryCount(self, expected, url, method="GET", expected_status=status.HTTP_200_OK, **kwargs):
+        """Asserts that a request of url runs exactly the expected number of statements"""
+        with count_queries() as queries:
+            resp = self.app.open(url, method=method, **kwargs)
+        self.assertEqual(resp.status_code, expected_status)
+        self.assertEqual(
+            queries.count, expected, f"{method} {url} ran:\n" + "\n".join(queries.statements)
+        )
+        return resp
+
     ######################################################################
     #  T E S T   C A S E S
     ######################################################################
@@ -138,6 +156,140 @@ class TestCustomerServer(unittest.TestCase):
 
 
 
+    def test_create_customer_batch(self):
+        """Create a batch of Customers in one request"""
+        batch = []
+        for customer in CustomerFactory.create_batch(3):
+            data = customer.serialize()
+            data["addresses"] = [address.serialize() for address in AddressFactory.create_batch(2)]
+            batch.append(data)
+        resp = self.app.post(f"{BASE_URL}:batch", json=batch, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        created = resp.get_json()
+        self.assertEqual([customer["email"] for customer in created], [data["email"] for data in batch])
+        for customer in created:
+            self.assertIsNotNone(customer["id"])
+            self.assertEqual(len(customer["addresses"]), 2)
+            for address in customer["addresses"]:
+                self.assertEqual(address["customer_id"], customer["id"])
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_create_customer_batch_query_count(self):
+        """Create a batch of Customers with one INSERT per table, however many there are"""
+        batch = []
+        for customer in CustomerFactory.create_batch(50):
+            data = customer.serialize()
+            data["addresses"] = [AddressFactory().serialize()]
+            batch.append(data)
+        # the Customers, their Addresses and the outbox, with nothing read back for the response;
+        # SQLite cannot return the new ids of a multi-row INSERT, so it inserts them one at a time
+        expected = 3 if db.engine.dialect.name == "postgresql" else len(batch) * 2 + 1
+        resp = self.assertQueryCount(
+            expected, f"{BASE_URL}:batch", method="POST", expected_status=status.HTTP_201_CREATED, json=batch
+        )
+        self.assertEqual(len(resp.get_json()), 50)
+        self.assertTrue(all(len(customer["addresses"]) == 1 for customer in resp.get_json()))
+
+    def test_create_customer_batch_ndjson(self):
+        """Create a batch of Customers from NDJSON"""
+        lines = [json.dumps(customer.serialize()) for customer in CustomerFactory.create_batch(2)]
+        resp = self.app.post(
+            f"{BASE_URL}:batch", data="\n".join(lines) + "\n", content_type="application/x-ndjson"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(resp.get_json()), 2)
+
+        resp = self.app.post(f"{BASE_URL}:batch", data="{not json", content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_customer_batch_with_errors(self):
+        """Create nothing when any Customer in a batch is not valid"""
+        batch = [customer.serialize() for customer in CustomerFactory.create_batch(3)]
+        del batch[1]["email"]
+        resp = self.app.post(f"{BASE_URL}:batch", json=batch, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = resp.get_json()["errors"]
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]["index"], 1)
+        self.assertIn("email", errors[0]["message"])
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.get_json(), [])
+
+    def test_create_customer_batch_bad_requests(self):
+        """Reject batches that are too large or not a list"""
+        batch = [customer.serialize() for customer in CustomerFactory.create_batch(3)]
+        max_batch_size = app.config["MAX_BATCH_SIZE"]
+        app.config["MAX_BATCH_SIZE"] = 2
+        try:
+            resp = self.app.post(f"{BASE_URL}:batch", json=batch, content_type=CONTENT_TYPE_JSON)
+        finally:
+            app.config["MAX_BATCH_SIZE"] = max_batch_size
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        resp = self.app.post(f"{BASE_URL}:batch", json=batch[0], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # the line after the last one allowed is never parsed, so it being broken does not matter
+        lines = [json.dumps(customer) for customer in batch[:2]] + ["{not json"]
+        with patch.dict(app.config, {"MAX_BATCH_SIZE": 2}):
+            resp = self.app.post(f"{BASE_URL}:batch", data="\n".join(lines), content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        with patch.dict(app.config, {"MAX_BATCH_BYTES": 100}):
+            resp = self.app.post(f"{BASE_URL}:batch", json=batch, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            self.assertIn("bytes", resp.get_json()["message"])
+            # a chunked body has no Content-Length, so it is cut off as it is read
+            for content_type in (CONTENT_TYPE_JSON, "application/x-ndjson"):
+                resp = self.app.post(
+                    f"{BASE_URL}:batch",
+                    input_stream=io.BytesIO(json.dumps(batch).encode("utf-8")),
+                    content_type=content_type,
+                    headers={"Transfer-Encoding": "chunked"},
+                    environ_overrides={"wsgi.input_terminated": True},
+                )
+                self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        body = json.dumps(batch[:1]).encode("utf-8")
+        resp = self.app.post(
+            f"{BASE_URL}:batch", input_stream=io.BytesIO(body), content_type=CONTENT_TYPE_JSON,
+            headers={"Transfer-Encoding": "chunked"}, environ_overrides={"wsgi.input_terminated": True},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.post(f"{BASE_URL}:batch", data="[not json", content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(f"{BASE_URL}:batch", data="name,email", content_type="text/csv")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_export_customers_ndjson(self):
+        """Export all Customers as NDJSON"""
+        customers = self.create_customers(3)
+        resp = self.app.get(f"{BASE_URL}/export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([row["id"] for row in rows], [customer.id for customer in customers])
+        self.assertEqual(rows[0]["email"], customers[0].email)
+        self.assertEqual(rows[0]["addresses"], [])
+
+    def test_export_customers_csv(self):
+        """Export all Customers as CSV"""
+        customer = self.create_customers(1)[0]
+        for address in AddressFactory.create_batch(2):
+            resp = self.app.post(
+                f"{BASE_URL}/{customer.id}/addresses",
+                json=address.serialize(),
+                content_type="application/json"
+            )
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get(f"{BASE_URL}/export", query_string="format=csv")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/csv")
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual({row["id"] for row in rows}, {str(customer.id)})
+        self.assertEqual(rows[0]["email"], customer.email)
+
+        resp = self.app.get(f"{BASE_URL}/export", query_string="format=xml")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     #Test create customer account with missing data
     def test_create_a_customer_no_data(self):
         """Create a Customer with missing data"""
@@ -168,6 +320,48 @@ class TestCustomerServer(unittest.TestCase):
         logging.debug(updated_customer)
         self.assertEqual(updated_customer["email"], "new@email.com")
 
+    def test_delete_customers_by_ids(self):
+        """Delete the Customers with a list of ids"""
+        customers = self.create_customers(4)
+        ids = f"{customers[0].id},{customers[2].id}"
+        resp = self.app.delete(f"{BASE_URL}?id={ids}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"deleted": 2})
+        remaining = [customer["id"] for customer in self.app.get(BASE_URL).get_json()]
+        self.assertEqual(remaining, [customers[1].id, customers[3].id])
+
+    def test_delete_customers_by_filter(self):
+        """Delete the Customers matching a filter with their addresses"""
+        customers = self.create_customers(3)
+        address = AddressFactory(customer_id=customers[1].id, postalcode="10012")
+        resp = self.app.post(f"{BASE_URL}/{customers[1].id}/addresses", json=address.serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        address_url = f"{BASE_URL}/{customers[1].id}/addresses/{resp.get_json()['id']}"
+        self.assertEqual(self.app.get(address_url).status_code, status.HTTP_200_OK)
+        resp = self.app.delete(f"{BASE_URL}?postalcode=10012")
+        self.assertEqual(resp.get_json(), {"deleted": 1})
+        self.assertEqual(self.app.get(address_url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 2)
+
+    def test_delete_customers_bad_ids(self):
+        """Reject a list of ids that are not numbers"""
+        resp = self.app.delete(f"{BASE_URL}?id=1,two")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_delete_all_customers(self):
+        """Delete every Customer only where it is allowed"""
+        self.create_customers(3)
+        resp = self.app.delete(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 3)
+        app.config["ALLOW_DELETE_ALL"] = True
+        try:
+            resp = self.app.delete(BASE_URL)
+        finally:
+            app.config["ALLOW_DELETE_ALL"] = False
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.app.get(BASE_URL).get_json(), [])
+
     def test_update_customer_id_not_found(self):
         """ Update customer id that does not exist """
         # create a customer to update
@@ -196,6 +390,111 @@ class TestCustomerServer(unittest.TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 5)
 
+    def test_get_customer_list_shape(self):
+        """List Customers in the same shape as reading them one at a time"""
+        customer = self.create_customers(1)[0]
+        resp = self.app.post(
+            f"{BASE_URL}/{customer.id}/addresses", json=AddressFactory().serialize()
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.content_type, CONTENT_TYPE_JSON)
+        self.assertEqual(resp.get_json(), [self.app.get(f"{BASE_URL}/{customer.id}").get_json()])
+        resp = self.app.get(f"{BASE_URL}/{customer.id}/addresses")
+        self.assertEqual(resp.get_json(), self.app.get(BASE_URL).get_json()[0]["addresses"])
+
+    def test_get_customer_fields(self):
+        """Return only the requested fields of Customers and Addresses"""
+        customer = self.create_customers(1)[0]
+        resp = self.app.post(
+            f"{BASE_URL}/{customer.id}/addresses", json=AddressFactory().serialize()
+        )
+        address_id = resp.get_json()["id"]
+
+        resp = self.assertQueryCount(1, f"{BASE_URL}?fields=id,email,account_status")
+        self.assertEqual(resp.get_json(), [
+            {"id": customer.id, "email": customer.email, "account_status": customer.account_status}
+        ])
+        resp = self.assertQueryCount(2, f"{BASE_URL}?fields=email,addresses")
+        self.assertEqual(list(resp.get_json()[0]), ["email", "addresses"])
+        self.assertEqual(resp.get_json()[0]["addresses"][0]["id"], address_id)
+
+        resp = self.assertQueryCount(1, f"{BASE_URL}/{customer.id}?fields=email")
+        self.assertEqual(resp.get_json(), {"email": customer.email})
+        self.app.get(f"{BASE_URL}/{customer.id}")
+        resp = self.assertQueryCount(0, f"{BASE_URL}/{customer.id}?fields=name")
+        self.assertEqual(resp.get_json(), {"name": customer.name})
+
+        resp = self.assertQueryCount(1, f"{BASE_URL}/{customer.id}/addresses?fields=city")
+        self.assertEqual(list(resp.get_json()[0]), ["city"])
+        resp = self.app.get(f"{BASE_URL}/{customer.id}/addresses/{address_id}?fields=id,state")
+        self.assertEqual(list(resp.get_json()), ["id", "state"])
+
+    def test_get_customer_bad_fields(self):
+        """Reject fields that do not exist"""
+        customer = self.create_customers(1)[0]
+        resp = self.app.get(BASE_URL, query_string="fields=id,password")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("password", resp.get_json()["message"])
+        resp = self.app.get(f"{BASE_URL}/{customer.id}", query_string="fields=addresses.city")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(f"{BASE_URL}/{customer.id}/addresses", query_string="fields=addresses")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_customer_list_pages(self):
+        """Page through the Customers with limit and cursor"""
+        customers = self.create_customers(5)
+        resp = self.app.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        ids = [customer["id"] for customer in resp.get_json()]
+        while "Link" in resp.headers:
+            link = resp.headers["Link"]
+            self.assertTrue(link.endswith('>; rel="next"'))
+            resp = self.app.get(link[1:link.index(">")])
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            page = resp.get_json()
+            self.assertLessEqual(len(page), 2)
+            ids += [customer["id"] for customer in page]
+        self.assertEqual(ids, sorted(customer.id for customer in customers))
+
+    def test_get_customer_list_last_page(self):
+        """The last page of Customers has no Link header"""
+        self.create_customers(2)
+        resp = self.app.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertNotIn("Link", resp.headers)
+
+    def test_get_customer_list_bad_paging(self):
+        """Reject a bad limit or cursor"""
+        resp = self.app.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL, query_string="cursor=not-a-cursor")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_customer_list_embed(self):
+        """List Customers with and without their addresses"""
+        customer = self.create_customers(1)[0]
+        address = AddressFactory()
+        resp = self.app.post(
+            f"{BASE_URL}/{customer.id}/addresses",
+            json=address.serialize(),
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()[0]["addresses"]), 1)
+
+        resp = self.app.get(BASE_URL, query_string="embed=none")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIsNone(resp.get_json()[0]["addresses"])
+
+        resp = self.app.get(BASE_URL, query_string="embed=orders")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_customer(self):
         """Get a single customer"""
         # get the id of a customer
@@ -207,11 +506,128 @@ class TestCustomerServer(unittest.TestCase):
         data = resp.get_json()
         self.assertEqual(data["first_name"], test_customer.first_name)
 
+    def test_get_customer_cached(self):
+        """Serve repeated reads of a Customer from the cache until it changes"""
+        test_customer = self.create_customers(1)[0]
+        url = f"{BASE_URL}/{test_customer.id}"
+        misses = cache.misses
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        hits = cache.hits
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertEqual(cache.misses, misses + 1)
+
+        data = resp.get_json()
+        data["email"] = "cached@example.com"
+        resp = self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(url)
+        self.assertEqual(resp.get_json()["email"], "cached@example.com")
+
+        resp = self.app.get("/stats/cache")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["hits"], cache.hits)
+
+    def test_get_customer_cache_sees_new_address(self):
+        """Invalidate the cached Customer when an Address is added"""
+        customer = self.create_customers(1)[0]
+        resp = self.app.get(f"{BASE_URL}/{customer.id}")
+        self.assertEqual(resp.get_json()["addresses"], [])
+        resp = self.app.post(
+            f"{BASE_URL}/{customer.id}/addresses",
+            json=AddressFactory().serialize(),
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get(f"{BASE_URL}/{customer.id}")
+        self.assertEqual(len(resp.get_json()["addresses"]), 1)
+
+    def test_get_customer_not_modified(self):
+        """Return 304 for a Customer the client already has"""
+        test_customer = self.create_customers(1)[0]
+        url = f"{BASE_URL}/{test_customer.id}"
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["ETag"], etag)
+
+        data = self.app.get(url).get_json()
+        data["email"] = "etag@example.com"
+        resp = self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.get_json()["email"], "etag@example.com")
+
+    def test_pool_stats(self):
+        """Report the connection pool of this worker"""
+        self.create_customers(1)
+        resp = self.app.get("/stats/pool")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["pid"], os.getpid())
+        self.assertIn("pool", data)
+
+    def test_query_counts(self):
+        """Pin the number of statements each read runs, whatever the number of rows"""
+        customers = self.create_customers(5)
+        for customer in customers:
+            for address in AddressFactory.create_batch(2):
+                resp = self.app.post(
+                    f"{BASE_URL}/{customer.id}/addresses",
+                    json=address.serialize(),
+                    content_type="application/json"
+                )
+                self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        cache.clear()
+        resp = self.assertQueryCount(2, BASE_URL)
+        self.assertEqual(len(resp.get_json()), 5)
+        self.assertQueryCount(1, f"{BASE_URL}?embed=none")
+        self.assertQueryCount(2, f"{BASE_URL}/{customers[0].id}")
+        self.assertQueryCount(0, f"{BASE_URL}/{customers[0].id}")
+        self.assertQueryCount(2, f"{BASE_URL}/{customers[1].id}/addresses")
+        resp = self.assertQueryCount(0, f"{BASE_URL}/{customers[0].id}")
+        self.assertIn('db;dur=', resp.headers["Server-Timing"])
+
     def test_get_customer_not_found(self):
         """Get a customer thats not found"""
         resp = self.app.get("/customers/0")
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_get_customer_zero_padded_id(self):
+        """Get a changed or deleted customer by a zero padded id"""
+        customer = self.create_customers(1)[0]
+        url = f"{BASE_URL}/0{customer.id}"
+        resp = self.app.get(url)
+        self.assertEqual(resp.get_json()["email"], customer.email)
+        data = resp.get_json()
+        data["email"] = "padded@example.com"
+        resp = self.app.put(f"{BASE_URL}/{customer.id}", json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(url).get_json()["email"], "padded@example.com")
+        self.app.delete(f"{BASE_URL}/{customer.id}")
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.app.get(f"{BASE_URL}/abc").status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_customer_breaker_open(self):
+        """Fail fast with 503 while the database circuit breaker is open"""
+        saved = policy.breaker
+        policy.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        policy.breaker.record_failure()
+        try:
+            with count_queries() as queries:
+                resp = self.app.get(f"{BASE_URL}/1")
+        finally:
+            policy.breaker = saved
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(queries.count, 0)
+        self.assertGreater(int(resp.headers["Retry-After"]), 0)
 
     def test_query_customer_list_by_email(self):
         """Query Customers by Email"""
@@ -274,6 +690,46 @@ class TestCustomerServer(unittest.TestCase):
         for customer in data:
             self.assertEqual(customer["name"], test_name)
 
+    def test_query_customer_list_by_combined_filters(self):
+        """Query Customers matching every given filter"""
+        customers = self.create_customers(10)
+        test_customer = customers[0]
+        resp = self.app.get(
+            BASE_URL,
+            query_string={"first_name": test_customer.first_name, "last_name": test_customer.last_name}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        expected = [
+            customer for customer in customers
+            if customer.first_name == test_customer.first_name and customer.last_name == test_customer.last_name
+        ]
+        self.assertEqual(len(data), len(expected))
+        for customer in data:
+            self.assertEqual(customer["first_name"], test_customer.first_name)
+            self.assertEqual(customer["last_name"], test_customer.last_name)
+
+        resp = self.app.get(
+            BASE_URL, query_string={"email": test_customer.email, "account_status": "suspended"}
+        )
+        self.assertEqual(resp.get_json(), [])
+
+    def test_query_customer_list_by_address(self):
+        """Query Customers by address fields and customer fields together"""
+        customers = self.create_customers(2)
+        address = AddressFactory()
+        for customer in customers:
+            resp = self.app.post(
+                f"{BASE_URL}/{customer.id}/addresses",
+                json=address.serialize(),
+                content_type="application/json"
+            )
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get(BASE_URL, query_string={"postalcode": address.postalcode, "city": address.city})
+        self.assertEqual(len(resp.get_json()), 2)
+        resp = self.app.get(BASE_URL, query_string={"postalcode": address.postalcode, "email": customers[1].email})
+        self.assertEqual([customer["id"] for customer in resp.get_json()], [customers[1].id])
+
     # def test_create_customer_no_content_type(self):
     #     """Create a customer with no content type"""
     #     resp = self.app.post(BASE_URL)
@@ -352,6 +808,26 @@ class TestCustomerServer(unittest.TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 2)
 
+    def test_get_address_list_pages(self):
+        """ Page through the Addresses of a Customer """
+        customer = self.create_customers(1)[0]
+        for address in AddressFactory.create_batch(3):
+            resp = self.app.post(
+                f"{BASE_URL}/{customer.id}/addresses",
+                json=address.serialize(),
+                content_type="application/json"
+            )
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+        resp = self.app.get(f"{BASE_URL}/{customer.id}/addresses", query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        link = resp.headers["Link"]
+        resp = self.app.get(link[1:link.index(">")])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 1)
+        self.assertNotIn("Link", resp.headers)
+
 
     def test_add_address(self):
         """ Add an address to an customer """
@@ -404,6 +880,22 @@ class TestCustomerServer(unittest.TestCase):
         self.assertEqual(data["state"], address.state)
         self.assertEqual(data["postalcode"], address.postalcode)
 
+    def test_get_address_not_modified(self):
+        """ Return 304 for an Address the client already has """
+        customer = self.create_customers(1)[0]
+        resp = self.app.post(
+            f"{BASE_URL}/{customer.id}/addresses",
+            json=AddressFactory().serialize(),
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        url = f"{BASE_URL}/{customer.id}/addresses/{resp.get_json()['id']}"
+        etag = self.app.get(url).headers["ETag"]
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get(url, headers={"If-None-Match": '"stale"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
     def test_update_address(self):
         """ Update an address on a customer """
         # create a known address
@@ -552,6 +1044,10 @@ class TestCustomerServer(unittest.TestCase):
         # suspend the customer
         new_customer = resp.get_json()
         logging.debug(new_customer)
+        resp = self.app.put("/customers/{}/suspend".format(new_customer["id"]))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        # restore the customer
         resp = self.app.put(
             "/customers/{}/restore".format(new_customer["id"]),
             json=new_customer,
@@ -563,6 +1059,37 @@ class TestCustomerServer(unittest.TestCase):
         logging.debug(updated_customer)
         self.assertEqual(updated_customer["account_status"],"active")
 
+    def test_suspend_and_restore_conflict(self):
+        """Refuse to suspend or restore a Customer that already has that status"""
+        customer = self.create_customers(1)[0]
+        resp = self.app.put(f"{BASE_URL}/{customer.id}/restore")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.put(f"{BASE_URL}/{customer.id}/suspend")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.put(f"{BASE_URL}/{customer.id}/suspend")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.app.get(f"{BASE_URL}/{customer.id}").get_json()["account_status"], "suspended")
+
+    def test_suspend_customer_in_one_statement(self):
+        """Suspend a Customer without a body, reading nothing before the update"""
+        address = AddressFactory()
+        customer = self.create_customers(1)[0]
+        resp = self.app.post(f"{BASE_URL}/{customer.id}/addresses", json=address.serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        # cache the Customer so the suspend has to invalidate it
+        self.assertEqual(self.app.get(f"{BASE_URL}/{customer.id}").get_json()["account_status"], "active")
+        with count_queries() as queries:
+            resp = self.app.put(f"{BASE_URL}/{customer.id}/suspend")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(queries.statements[0].startswith("UPDATE customer"), queries.statements)
+        # the UPDATE, its event in the outbox, then the addresses of the response
+        self.assertTrue(queries.statements[1].startswith("INSERT INTO outbox"), queries.statements)
+        self.assertEqual(queries.count, 3)
+        suspended = resp.get_json()
+        self.assertEqual(suspended["account_status"], "suspended")
+        self.assertEqual(len(suspended["addresses"]), 1)
+        self.assertEqual(self.app.get(f"{BASE_URL}/{customer.id}").get_json(), suspended)
+
     def test_restore_customer_not_found(self):
         """Restore a non-existent customer"""
         # create a customer to update
@@ -581,3 +1108,108 @@ class TestCustomerServer(unittest.TestCase):
             content_type=CONTENT_TYPE_JSON,
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    ######################################################################
+    #  C H A N G E   F E E D   T E S T   C A S E S
+    ######################################################################
+
+    def last_event_id(self) -> int:
+        """Returns the id of the newest change in the outbox"""
+        last = ChangeEvent.query.order_by(ChangeEvent.id.desc()).first()
+        db.session.commit()
+        return last.id if last else 0
+
+    def test_query_customer_list_updated_since(self):
+        """List only the Customers updated after a time"""
+        customers = self.create_customers(3)
+        resp = self.app.get(f"{BASE_URL}/{customers[1].id}")
+        since = resp.get_json()["updated_at"]
+        resp = self.app.put(f"{BASE_URL}/{customers[0].id}/suspend")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(BASE_URL, query_string={"updated_since": since})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([customer["id"] for customer in resp.get_json()], [customers[0].id, customers[2].id])
+        self.assertEqual(resp.get_json()[0]["version"], 2)
+        resp = self.app.get(BASE_URL, query_string={"updated_since": "yesterday"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_customer_list_updated_since_address_changes(self):
+        """List the Customers whose Addresses were added, changed or deleted after a time"""
+        customers = self.create_customers(3)
+        since = self.app.get(f"{BASE_URL}/{customers[2].id}").get_json()["updated_at"]
+
+        def updated_ids() -> list:
+            resp = self.app.get(BASE_URL, query_string={"updated_since": since})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            return [customer["id"] for customer in resp.get_json()]
+
+        self.assertEqual(updated_ids(), [])
+        url = f"{BASE_URL}/{customers[0].id}/addresses"
+        resp = self.app.post(url, json=AddressFactory().serialize(), content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        address = resp.get_json()
+        self.assertEqual(updated_ids(), [customers[0].id])
+        since = self.app.get(f"{BASE_URL}/{customers[0].id}").get_json()["updated_at"]
+        self.assertEqual(updated_ids(), [])
+        address["city"] = "Hoboken"
+        resp = self.app.put(f"{url}/{address['id']}", json=address, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(updated_ids(), [customers[0].id])
+        customer = self.app.get(f"{BASE_URL}/{customers[0].id}").get_json()
+        self.assertEqual(customer["version"], 1)
+        since = customer["updated_at"]
+        resp = self.app.delete(f"{url}/{address['id']}")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(updated_ids(), [customers[0].id])
+
+    @patch.dict(app.config, {"OUTBOX_GAP_TIMEOUT": 0})
+    def test_list_changes(self):
+        """Page through the changes after an event id"""
+        last = self.last_event_id()
+        customer = self.create_customers(1)[0]
+        self.app.put(f"{BASE_URL}/{customer.id}/suspend")
+        self.app.delete(f"{BASE_URL}/{customer.id}")
+        resp = self.app.get(f"{BASE_URL}/changes", query_string={"after": last, "limit": 2})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        changes = resp.get_json()
+        self.assertEqual([change["operation"] for change in changes], ["created", "updated"])
+        self.assertEqual(changes[0]["entity_id"], customer.id)
+        self.assertEqual(changes[1]["record"]["account_status"], "suspended")
+        self.assertIn(f"after={changes[1]['id']}", resp.headers["Link"])
+        resp = self.app.get(f"{BASE_URL}/changes", query_string={"after": changes[1]["id"]})
+        self.assertEqual([change["operation"] for change in resp.get_json()], ["deleted"])
+        resp = self.app.get(f"{BASE_URL}/changes", query_string={"after": resp.get_json()[0]["id"]})
+        self.assertEqual(resp.get_json(), [])
+        self.assertIn(f"after={changes[1]['id'] + 1}", resp.headers["Link"])
+
+    @patch.dict(app.config, {"OUTBOX_GAP_TIMEOUT": 0, "CHANGE_STREAM_TIMEOUT": 0.2, "CHANGE_POLL_INTERVAL": 0.05})
+    def test_stream_changes(self):
+        """Stream the changes as Server-Sent Events, resuming after Last-Event-ID"""
+        last = self.last_event_id()
+        customers = self.create_customers(2)
+        resp = self.app.get(f"{BASE_URL}/changes/stream", query_string={"after": last})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        body = resp.get_data(as_text=True)
+        self.assertTrue(body.startswith("retry: "))
+        events = [block for block in body.split("\n\n") if block.startswith("id: ")]
+        self.assertEqual(len(events), 2)
+        first_id = int(events[0].split("\n")[0][len("id: "):])
+        self.assertIn("event: created", events[0])
+        data = json.loads(events[1].split("\n")[2][len("data: "):])
+        self.assertEqual(data["entity_id"], customers[1].id)
+        resp = self.app.get(f"{BASE_URL}/changes/stream", headers={"Last-Event-ID": str(first_id)})
+        events = [block for block in resp.get_data(as_text=True).split("\n\n") if block.startswith("id: ")]
+        self.assertEqual(len(events), 1)
+        self.assertIn(f'"entity_id": {customers[1].id}', events[0])
+
+    @patch.dict(app.config, {"OUTBOX_GAP_TIMEOUT": 0, "CHANGE_STREAM_TIMEOUT": 0, "CHANGE_POLL_INTERVAL": 10})
+    def test_stream_changes_short_poll(self):
+        """Send the pending changes and close at once when streams may not stay open"""
+        last = self.last_event_id()
+        self.create_customers(2)
+        resp = self.app.get(f"{BASE_URL}/changes/stream", query_string={"after": last})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        body = resp.get_data(as_text=True)
+        self.assertTrue(body.startswith("retry: "))
+        self.assertEqual(len([block for block in body.split("\n\n") if block.startswith("id: ")]), 2)